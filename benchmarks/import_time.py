@@ -0,0 +1,70 @@
+"""
+Measures how long importing the package takes in a fresh interpreter, and which heavy dependencies it imports.
+
+Each measurement starts a new Python process with `-X importtime`, and the time of the package's own import
+is read from its report, so interpreter startup isn't included. The fastest of several runs is reported,
+since it is the least affected by noise from other processes.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --max-ms 150
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+PACKAGE = "openai_messages_token_helper"
+# The dependencies that are slow to import, and should only be imported when first needed
+HEAVY_MODULES = ["openai", "tiktoken", "PIL", "asyncio"]
+
+
+def time_import(statement: str) -> float:
+    """Get the cumulative time in seconds of importing the package, when running the statement."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True
+    )
+    # Each line of the report is "import time: self [us] | cumulative | module", with nested modules indented
+    for line in process.stderr.splitlines():
+        _, cumulative, module = line.split("|")
+        if module.rstrip() == f" {PACKAGE}":
+            return int(cumulative) / 1e6
+    raise RuntimeError(f"{PACKAGE} was not imported:\n{process.stderr}")
+
+
+def imported_heavy_modules(statement: str) -> list[str]:
+    """Get the heavy modules that are imported after running the statement."""
+    check = f"{statement}; import sys; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    process = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    return process.stdout.split()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10, help="The number of fresh interpreters to time")
+    parser.add_argument("--max-ms", type=float, help="Exit with status 1 if the fastest import is slower than this")
+    args = parser.parse_args(argv)
+
+    statements = {
+        "import": f"import {PACKAGE}",
+        "get_token_limit": f"import {PACKAGE}; {PACKAGE}.get_token_limit('gpt-4o')",
+    }
+    timings = [time_import(statements["import"]) for _ in range(args.repeat)]
+    print(
+        f"import {PACKAGE}: {min(timings) * 1e3:.1f} ms (median {statistics.median(timings) * 1e3:.1f} ms)",
+        file=sys.stderr,
+    )
+    for name, statement in statements.items():
+        print(f"heavy modules after {name}: {', '.join(imported_heavy_modules(statement)) or 'none'}", file=sys.stderr)
+
+    if args.max_ms is not None and min(timings) * 1e3 > args.max_ms:
+        print(f"Import is slower than {args.max_ms} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
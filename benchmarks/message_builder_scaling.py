@@ -0,0 +1,47 @@
+"""
+Measures how build_messages scales with the length of the history.
+
+Token counts are served from a warm cache, so the timings show the cost of assembling the
+message list itself, which should grow linearly with the number of kept messages.
+
+Usage: python benchmarks/message_builder_scaling.py
+"""
+
+import time
+
+from openai.types.chat import ChatCompletionMessageParam
+
+from openai_messages_token_helper import LRUCache, build_messages
+
+SIZES = [1_000, 2_000, 5_000, 10_000]
+
+
+def make_history(size: int) -> list[ChatCompletionMessageParam]:
+    history: list[ChatCompletionMessageParam] = []
+    for i in range(size // 2):
+        history.append({"role": "tool", "tool_call_id": f"call_{i}", "content": f"Search results for query {i}"})
+        history.append({"role": "assistant", "content": f"Here is what I found for query {i}."})
+    return history
+
+
+def time_build(history: list[ChatCompletionMessageParam], cache: LRUCache[int], repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build_messages("gpt-4o", "You are a bot.", past_messages=history, cache=cache)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    cache: LRUCache[int] = LRUCache(max_entries=max(SIZES) + 1)
+    print(f"{'messages':>10} {'seconds':>10} {'us/message':>12}")
+    for size in SIZES:
+        history = make_history(size)
+        build_messages("gpt-4o", "You are a bot.", past_messages=history, cache=cache)  # warm the cache
+        seconds = time_build(history, cache)
+        print(f"{size:>10} {seconds:>10.4f} {seconds / size * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Benchmarks the hot paths of the library across realistic scenarios, and compares the results against a baseline.
+
+Each scenario is timed several times and the fastest time per call is reported, since it is the least
+affected by noise from other processes. Results are written as JSON, and when a baseline is given,
+scenarios that got slower by more than the threshold are reported and the script exits with status 1.
+
+Usage:
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json
+    python benchmarks/suite.py -k build_messages
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import io
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from typing import Any
+
+import tiktoken
+from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
+from PIL import Image
+
+from openai_messages_token_helper import (
+    ToolSet,
+    build_messages,
+    count_tokens_for_image,
+    count_tokens_for_message,
+    count_tokens_for_system_and_tools,
+    warmup,
+)
+
+MODEL = "gpt-4o"
+# Scenarios are only compared when they ran with the same parameters, so change the version when changing them
+SUITE_VERSION = 1
+
+
+def make_history(size: int) -> list[ChatCompletionMessageParam]:
+    rng = random.Random(size)
+    words = ["climbing", "gear", "harness", "rope", "shoes", "outdoor", "trail", "weather", "price", "rating"]
+    history: list[ChatCompletionMessageParam] = []
+    for i in range(size // 2):
+        question = " ".join(rng.choice(words) for _ in range(rng.randint(5, 30)))
+        answer = " ".join(rng.choice(words) for _ in range(rng.randint(20, 120)))
+        history.append({"role": "user", "content": f"Question {i}: {question}?"})
+        history.append({"role": "assistant", "content": f"Answer {i}: {answer}."})
+    return history
+
+
+def make_image_uri(width: int, height: int, format: str) -> str:
+    rng = random.Random(width * height)
+    # Noise doesn't compress, so the data URI is as large as a photo of the same size
+    image = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def make_tools(count: int) -> list[ChatCompletionToolParam]:
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": f"search_catalog_{i}",
+                "description": f"Search catalog {i} for products that match the query and filters.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "query": {"type": "string", "description": "The search query"},
+                        "category": {"type": "string", "enum": ["shoes", "ropes", "harnesses", "tents"]},
+                        "max_price": {"type": "number", "description": "The maximum price in dollars"},
+                        "in_stock": {"type": "boolean", "description": "Whether to only include items in stock"},
+                    },
+                    "required": ["query"],
+                },
+            },
+        }
+        for i in range(count)
+    ]
+
+
+UNICODE_TEXT = (
+    "Ünïcödé façade naïve café. 日本語のテキストと絵文字 🎉🧗‍♀️🏔️. "
+    "Русский текст и العربية والعبرית. 한국어 문장도 포함됩니다. "
+) * 200
+
+
+def scenarios() -> dict[str, tuple[Callable[[], Any], int]]:
+    """Each scenario's function to time, and the number of calls per timing."""
+    system_prompt = "You are a helpful assistant that helps people find climbing gear."
+    histories = {size: make_history(size) for size in (10, 100, 10_000)}
+    png_uri = make_image_uri(2048, 2048, "PNG")
+    jpeg_uri = make_image_uri(2048, 2048, "JPEG")
+    bmp_uri = make_image_uri(512, 512, "BMP")
+    tools = make_tools(50)
+    tool_set = ToolSet(tools)
+    system_message: ChatCompletionMessageParam = {"role": "system", "content": system_prompt}
+    short_message: ChatCompletionMessageParam = {"role": "user", "content": "What shoes should I buy for bouldering?"}
+    unicode_message: ChatCompletionMessageParam = {"role": "user", "content": UNICODE_TEXT}
+    # About 3 MB, like a large tool result or pasted document
+    large_message: ChatCompletionMessageParam = {
+        "role": "tool",
+        "tool_call_id": "call_1",
+        "content": " ".join(m["content"] for m in histories[10_000]),  # type: ignore[misc]
+    }
+    image_message: ChatCompletionMessageParam = {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": "What gear is in this picture?"},
+            {"type": "image_url", "image_url": {"url": png_uri, "detail": "high"}},
+        ],
+    }
+
+    def build(size: int, **kwargs):
+        return lambda: build_messages(
+            MODEL, system_prompt, past_messages=histories[size], new_user_content="Any other gear?", **kwargs
+        )
+
+    return {
+        "build_messages/history_10": (build(10), 100),
+        "build_messages/history_100": (build(100), 10),
+        "build_messages/history_10000": (build(10_000), 1),
+        "build_messages/history_10000_truncated": (build(10_000, max_tokens=8000), 10),
+        "build_messages/history_100_tools_50": (build(100, tools=tools), 10),
+        "build_messages/image": (
+            lambda: build_messages(MODEL, system_prompt, new_user_content=image_message["content"]),  # type: ignore
+            10,
+        ),
+        "count_tokens_for_message/short": (lambda: count_tokens_for_message(MODEL, short_message), 1000),
+        "count_tokens_for_message/unicode": (lambda: count_tokens_for_message(MODEL, unicode_message), 10),
+        "count_tokens_for_message/large_3mb": (lambda: count_tokens_for_message(MODEL, large_message), 1),
+        "count_tokens_for_message/large_3mb_parallel": (
+            lambda: count_tokens_for_message(MODEL, large_message, parallel_min_chars=100_000),
+            1,
+        ),
+        "count_tokens_for_message/image_png_2048": (lambda: count_tokens_for_message(MODEL, image_message), 10),
+        "count_tokens_for_image/png_2048": (lambda: count_tokens_for_image(png_uri, "high", MODEL), 10),
+        "count_tokens_for_image/jpeg_2048": (lambda: count_tokens_for_image(jpeg_uri, "high", MODEL), 10),
+        "count_tokens_for_image/bmp_512": (lambda: count_tokens_for_image(bmp_uri, "high", MODEL), 10),
+        "count_tokens_for_system_and_tools/tools_50": (
+            lambda: count_tokens_for_system_and_tools(MODEL, system_message, tools, "auto"),  # type: ignore
+            10,
+        ),
+        "count_tokens_for_system_and_tools/toolset_50": (
+            lambda: count_tokens_for_system_and_tools(MODEL, system_message, tool_set, "auto"),  # type: ignore
+            1000,
+        ),
+    }
+
+
+def time_scenario(func: Callable[[], Any], number: int, repeat: int) -> dict[str, float]:
+    func()  # warm up any lazy initialization and caches
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return {"min": min(timings), "median": statistics.median(timings), "number": number, "repeat": repeat}
+
+
+def run(name_filter: str | None, repeat: int) -> dict[str, Any]:
+    warmup([MODEL])
+    results = {}
+    for name, (func, number) in scenarios().items():
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = time_scenario(func, number, repeat)
+        print(f"{name:<50} {results[name]['min'] * 1e3:>10.3f} ms", file=sys.stderr)
+    return {
+        "suite_version": SUITE_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tiktoken": tiktoken.__version__,
+        "results": results,
+    }
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+    """Get the names of the scenarios that are slower than the baseline by more than the threshold ratio."""
+    if baseline.get("suite_version") != results["suite_version"]:
+        print("Baseline was recorded with a different suite version, skipping comparison", file=sys.stderr)
+        return []
+    regressions = []
+    print(f"\n{'scenario':<50} {'baseline':>10} {'current':>10} {'ratio':>7}", file=sys.stderr)
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        baseline_min = baseline["results"][name]["min"]
+        ratio = result["min"] / baseline_min
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(
+            f"{name:<50} {baseline_min * 1e3:>8.3f}ms {result['min'] * 1e3:>8.3f}ms {ratio:>7.2f}{flag}",
+            file=sys.stderr,
+        )
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="Write the results as JSON to this file, or - for stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="Compare the results against this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.5, help="The slowdown ratio that counts as a regression")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of timings for each scenario")
+    parser.add_argument("-k", dest="name_filter", help="Only run the scenarios whose name contains this text")
+    args = parser.parse_args(argv)
+
+    results = run(args.name_filter, args.repeat)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} scenario(s) regressed: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
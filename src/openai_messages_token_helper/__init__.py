@@ -1,11 +1,67 @@
-from .images_helper import count_tokens_for_image
-from .message_builder import build_messages
-from .model_helper import count_tokens_for_message, count_tokens_for_system_and_tools, get_token_limit
+from .async_helper import async_build_messages, async_count_tokens_for_message
+from .bpe_helper import export_bpe_files, set_bpe_directory
+from .cache import CacheBackend, CacheStats, LRUCache, SQLiteCache
+from .conversation import Conversation
+from .estimate_helper import TokenEstimate, estimate_tokens
+from .images_helper import count_tokens_for_image, set_image_dims_cache
+from .instrumentation import RecordingTracer, set_tracer
+from .message_builder import (
+    BuildResult,
+    SourcePack,
+    build_messages,
+    build_messages_many,
+    build_messages_with_report,
+    pack_sources,
+)
+from .model_helper import (
+    count_tokens_for_message,
+    count_tokens_for_messages,
+    count_tokens_for_system_and_tools,
+    get_token_limit,
+    preload,
+    truncate_text_to_tokens,
+    warmup,
+)
+from .scheduler import Deployment, Reservation, TPMScheduler
+from .stream_helper import StreamingTokenCounter
+from .text_splitter import split_text_by_tokens
+from .token_counter import TokenCounter
+from .tools_helper import ToolSet
 
 __all__ = [
+    "TokenCounter",
     "build_messages",
+    "build_messages_many",
+    "build_messages_with_report",
+    "BuildResult",
+    "pack_sources",
+    "SourcePack",
+    "async_build_messages",
+    "Conversation",
     "count_tokens_for_message",
+    "count_tokens_for_messages",
+    "estimate_tokens",
+    "TokenEstimate",
+    "StreamingTokenCounter",
+    "async_count_tokens_for_message",
     "count_tokens_for_image",
+    "truncate_text_to_tokens",
+    "split_text_by_tokens",
     "get_token_limit",
+    "preload",
+    "warmup",
+    "set_bpe_directory",
+    "export_bpe_files",
     "count_tokens_for_system_and_tools",
+    "LRUCache",
+    "SQLiteCache",
+    "CacheBackend",
+    "set_image_dims_cache",
+    "CacheStats",
+    "ToolSet",
+    "TPMScheduler",
+    "Deployment",
+    "Reservation",
+    "set_tracer",
+    "RecordingTracer",
 ]
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import contextvars
+import functools
+from typing import TYPE_CHECKING, Any, Callable, TypeVar
+
+from .message_builder import build_messages
+from .model_helper import count_tokens_for_message
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    from openai.types.chat import ChatCompletionMessageParam
+
+T = TypeVar("T")
+
+
+async def run_in_executor(executor: Executor | None, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a blocking function in an executor without blocking the event loop,
+    propagating the current context variables to the worker thread.
+    Args:
+        executor (Executor): The executor to run the function in, or None for the event loop's default executor.
+        func (Callable): The function to run.
+    Returns:
+        The result of the function.
+    """
+    # asyncio is slow to import, and only needed once a coroutine is running
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def async_build_messages(
+    model: str, system_prompt: str, *, executor: Executor | None = None, **kwargs: Any
+) -> list[ChatCompletionMessageParam]:
+    """
+    Build a list of messages for a chat conversation without blocking the event loop.
+    Token counting and image decoding run in an executor, and tiktoken releases the GIL while encoding,
+    so other coroutines keep being served while a large prompt is counted.
+    Args:
+        model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+        system_prompt (str): The initial system prompt message.
+        executor (Executor): The executor to run in, or None for the event loop's default executor.
+        **kwargs: The same keyword arguments as `build_messages`.
+    Returns:
+        list[ChatCompletionMessageParam]: The same messages as `build_messages`.
+    """
+    return await run_in_executor(executor, build_messages, model, system_prompt, **kwargs)
+
+
+async def async_count_tokens_for_message(
+    model: str,
+    message: ChatCompletionMessageParam,
+    default_to_cl100k=False,
+    *,
+    executor: Executor | None = None,
+    **kwargs: Any,
+) -> int:
+    """
+    Calculate the number of tokens required to encode a message without blocking the event loop.
+    Args:
+        model (str): The name of the model to use for encoding.
+        message (Mapping): The message to encode, in a dictionary-like object.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        executor (Executor): The executor to run in, or None for the event loop's default executor.
+        **kwargs: The same keyword arguments as `count_tokens_for_message`.
+    Returns:
+        int: The total number of tokens required to encode the message.
+    """
+    return await run_in_executor(executor, count_tokens_for_message, model, message, default_to_cl100k, **kwargs)
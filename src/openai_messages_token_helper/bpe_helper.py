@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# The environment variable with the directory of compact rank files, used when set_bpe_directory isn't called
+BPE_DIRECTORY_ENV = "OPENAI_MESSAGES_TOKEN_HELPER_BPE_DIR"
+COMPACT_RANKS_SUFFIX = ".ranks"
+COMPACT_RANKS_MAGIC = b"TKRANKS1"
+DEFAULT_ENCODING_NAMES = ("cl100k_base", "o200k_base")
+
+_bpe_directory: str | None = None
+_local_encodings: dict[str, tiktoken.Encoding] = {}
+_local_encodings_lock = threading.Lock()
+
+
+def set_bpe_directory(directory: str | os.PathLike[str] | None) -> None:
+    """
+    Set a directory of compact rank files to load encodings from, instead of downloading them,
+    like for containers without internet access. Encodings without a file in the directory are still
+    loaded by tiktoken. Without a directory, the OPENAI_MESSAGES_TOKEN_HELPER_BPE_DIR environment variable is used.
+    Encodings that were already loaded for a model are reloaded on their next use.
+    Args:
+        directory (str): The directory, as written by `export_bpe_files`, or None to stop using one.
+    """
+    # model_helper imports this module to load encodings, so it can only be imported once both are loaded
+    from .model_helper import _ENCODINGS
+
+    global _bpe_directory
+    _bpe_directory = os.fspath(directory) if directory is not None else None
+    with _local_encodings_lock:
+        _local_encodings.clear()
+    # Models that were already resolved would keep their encodings from the previous directory
+    _ENCODINGS.clear()
+
+
+def write_compact_ranks(encoding: tiktoken.Encoding, path: str | os.PathLike[str]) -> None:
+    """
+    Write an encoding to a compact rank file, which holds its pattern, special tokens and the bytes of every rank,
+    so that it can be loaded without downloading anything and without parsing base64.
+    The file has a JSON header followed by little-endian offsets of each rank's bytes into one blob.
+    Args:
+        encoding (tiktoken.Encoding): The encoding to write.
+        path (str): The path of the file to write.
+    """
+    # tiktoken doesn't expose the constructor arguments, but pickles encodings with the same attributes
+    mergeable_ranks: dict[bytes, int] = encoding._mergeable_ranks  # type: ignore[attr-defined]
+    tokens: list[bytes] = [b""] * (max(mergeable_ranks.values()) + 1)
+    for token, rank in mergeable_ranks.items():
+        tokens[rank] = token
+    header = json.dumps(
+        {
+            "name": encoding.name,
+            "pat_str": encoding._pat_str,  # type: ignore[attr-defined]
+            "special_tokens": encoding._special_tokens,  # type: ignore[attr-defined]
+        }
+    ).encode("utf-8")
+    offsets = array("I", [0])
+    for token in tokens:
+        offsets.append(offsets[-1] + len(token))
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    with open(path, "wb") as file:
+        file.write(COMPACT_RANKS_MAGIC)
+        file.write(struct.pack("<II", len(header), len(tokens)))
+        file.write(header)
+        file.write(offsets.tobytes())
+        file.write(b"".join(tokens))
+
+
+def read_compact_ranks(path: str | os.PathLike[str]) -> tiktoken.Encoding:
+    """
+    Load an encoding from a compact rank file written by `write_compact_ranks`.
+    The file is read in one call and each rank is sliced out of it without decoding,
+    which loads much faster than parsing tiktoken's base64 files.
+    Args:
+        path (str): The path of the file.
+    Returns:
+        tiktoken.Encoding: The encoding.
+    """
+    import tiktoken
+
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[: len(COMPACT_RANKS_MAGIC)] != COMPACT_RANKS_MAGIC:
+        raise ValueError(f"Not a compact rank file: {os.fspath(path)}")
+    position = len(COMPACT_RANKS_MAGIC)
+    header_length, token_count = struct.unpack_from("<II", data, position)
+    position += 8
+    header = json.loads(data[position : position + header_length])
+    position += header_length
+    offsets = array("I")
+    offsets.frombytes(data[position : position + 4 * (token_count + 1)])
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    blob = data[position + 4 * (token_count + 1) :]
+    # Slicing every token out of the blob at C speed is much faster than decoding base64 lines
+    tokens = map(blob.__getitem__, map(slice, offsets, offsets[1:]))
+    mergeable_ranks = dict(zip(tokens, range(token_count)))
+    # Ranks without a token, like the gaps before special tokens, have no bytes
+    mergeable_ranks.pop(b"", None)
+    return tiktoken.Encoding(
+        name=header["name"],
+        pat_str=header["pat_str"],
+        mergeable_ranks=mergeable_ranks,
+        special_tokens=header["special_tokens"],
+    )
+
+
+def export_bpe_files(
+    directory: str | os.PathLike[str], encoding_names: Iterable[str] = DEFAULT_ENCODING_NAMES
+) -> list[str]:
+    """
+    Write a compact rank file for each encoding into a directory, like when building a container image,
+    so that `set_bpe_directory` can load them later without internet access.
+    The encodings are loaded by tiktoken, so this needs internet access or tiktoken's cache.
+    Args:
+        directory (str): The directory to write the files to, which is created if needed.
+        encoding_names (list[str]): The names of the encodings to write. Defaults to those of the supported models.
+    Returns:
+        list[str]: The paths of the written files.
+    """
+    import tiktoken
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name in encoding_names:
+        path = os.path.join(directory, name + COMPACT_RANKS_SUFFIX)
+        write_compact_ranks(tiktoken.get_encoding(name), path)
+        paths.append(path)
+    return paths
+
+
+def load_local_encoding(name: str) -> tiktoken.Encoding | None:
+    """
+    Load an encoding from the BPE directory, or get None if there is no directory or no file for the encoding.
+    Each encoding is only loaded once, and shared by all the models that use it.
+    """
+    directory = _bpe_directory if _bpe_directory is not None else os.environ.get(BPE_DIRECTORY_ENV)
+    if not directory:
+        return None
+    with _local_encodings_lock:
+        if name not in _local_encodings:
+            path = os.path.join(directory, name + COMPACT_RANKS_SUFFIX)
+            if not os.path.exists(path):
+                return None
+            _local_encodings[name] = read_compact_ranks(path)
+        return _local_encodings[name]
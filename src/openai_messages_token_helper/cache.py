@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Generic, Protocol, TypeVar
+
+if TYPE_CHECKING:
+    import sqlite3
+
+V = TypeVar("V")
+
+# Connections that a process inherited from its parent when it forked. SQLite must not use or close
+# a connection in a forked child, since closing one can release the parent's locks on a WAL database,
+# so they are kept referenced here to stop the garbage collector from closing them.
+_INHERITED_CONNECTIONS: list[sqlite3.Connection] = []
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """
+    A snapshot of the statistics of a cache.
+    Attributes:
+        hits (int): The number of lookups that found a value.
+        misses (int): The number of lookups that did not find a value.
+        evictions (int): The number of entries removed to stay within the size bounds.
+        entries (int): The number of entries currently stored.
+        total_bytes (int): The total size of the entries currently stored.
+    """
+
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    total_bytes: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class CacheBackend(Protocol[V]):
+    """
+    The interface of the caches that token counts and image dimensions can be stored in, like `LRUCache`
+    for a single process or `SQLiteCache` for all the processes on a machine.
+    Keys are content hashes, so a backend can evict any entry at any time without affecting correctness.
+    """
+
+    def get(self, key: str) -> V | None: ...
+
+    def put(self, key: str, value: V, size: int = 0) -> None: ...
+
+
+class LRUCache(Generic[V]):
+    """
+    A thread-safe least-recently-used cache, bounded by both entry count and total size.
+    Attributes:
+        max_entries (int): The maximum number of entries to keep.
+        max_bytes (int): The maximum total size of the entries to keep, as reported to `put`.
+    """
+
+    def __init__(self, max_entries: int = 10_000, max_bytes: int = 64 * 1024 * 1024):
+        if max_entries <= 0 or max_bytes <= 0:
+            raise ValueError("Cache bounds must be positive")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[V, int]] = OrderedDict()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> V | None:
+        """
+        Look up a value, marking it as most recently used.
+        Args:
+            key (str): The key to look up.
+        Returns:
+            The cached value, or None if the key is not in the cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key: str, value: V, size: int = 0) -> None:
+        """
+        Store a value, evicting the least recently used entries if the cache is over its bounds.
+        Args:
+            key (str): The key to store the value under.
+            value: The value to store.
+            size (int): The size of the entry in bytes, counted against `max_bytes`.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self._total_bytes += size
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+                self._evictions += 1
+
+    def clear(self) -> None:
+        """Remove all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self._hits = self._misses = self._evictions = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                entries=len(self._entries),
+                total_bytes=self._total_bytes,
+            )
+
+
+class SQLiteCache(Generic[V]):
+    """
+    A cache in a local SQLite database, shared by all the processes on a machine that open the same file,
+    like the workers of a web server, so that a message counted by any of them is never counted again.
+    The database is in WAL mode, so reads don't block each other or the writer.
+    Entries are evicted by least recent use, which is only tracked to within `touch_interval` seconds
+    so that most reads don't write. The bounds are checked every `check_interval` puts in each process,
+    so the cache can briefly grow past them. Values must be JSON-serializable, and lists are read back as tuples.
+    Attributes:
+        path (str): The path of the database file.
+        max_entries (int): The maximum number of entries to keep.
+        max_bytes (int): The maximum total size of the entries to keep, as reported to `put`.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike[str],
+        max_entries: int = 1_000_000,
+        max_bytes: int = 1024 * 1024 * 1024,
+        *,
+        touch_interval: float = 60.0,
+        check_interval: int = 100,
+        timeout: float = 5.0,
+    ):
+        if max_entries <= 0 or max_bytes <= 0:
+            raise ValueError("Cache bounds must be positive")
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._puts_since_check = 0
+        self._lock = threading.Lock()
+        # The connection is opened on first use, so a server that creates the cache before forking its workers
+        # doesn't hold a connection for them to inherit
+        self._connection: sqlite3.Connection | None = None
+        self._connection_pid = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection can't be used across a fork, so each process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            if self._connection is not None:
+                _INHERITED_CONNECTIONS.append(self._connection)
+            # sqlite3 is imported when a cache is first used, so that importing this package stays fast
+            import sqlite3
+
+            connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+            self._connection = connection
+            self._connection_pid = os.getpid()
+            # Check the bounds on the first put, since other processes may have filled the cache
+            self._puts_since_check = self.check_interval
+        return self._connection
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._connect().execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key: str) -> V | None:
+        """
+        Look up a value, marking it as recently used.
+        Args:
+            key (str): The key to look up.
+        Returns:
+            The cached value, or None if the key is not in the cache.
+        """
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, used FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            now = time.time()
+            if now - row[1] > self.touch_interval:
+                connection.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        value = json.loads(row[0])
+        return tuple(value) if isinstance(value, list) else value  # type: ignore[return-value]
+
+    def put(self, key: str, value: V, size: int = 0) -> None:
+        """
+        Store a value, evicting the least recently used entries if the cache is over its bounds.
+        Args:
+            key (str): The key to store the value under.
+            value: The value to store, which must be JSON-serializable.
+            size (int): The size of the entry in bytes, counted against `max_bytes`.
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT INTO entries (key, value, size, used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, used = excluded.used",
+                (key, json.dumps(value), size, time.time()),
+            )
+            self._puts_since_check += 1
+            if self._puts_since_check >= self.check_interval:
+                self._puts_since_check = 0
+                self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        entries, total_bytes = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        # Keep the most recently used entries that fit within the bounds
+        cursor = connection.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM ("
+            "SELECT key, ROW_NUMBER() OVER newest AS position, SUM(size) OVER newest AS kept_bytes FROM entries "
+            "WINDOW newest AS (ORDER BY used DESC, key)) WHERE position > ? OR kept_bytes > ?)",
+            (self.max_entries, self.max_bytes),
+        )
+        self._evictions += cursor.rowcount
+
+    def clear(self) -> None:
+        """Remove all entries, for every process, and reset this process's statistics."""
+        with self._lock:
+            self._connect().execute("DELETE FROM entries")
+            self._hits = self._misses = self._evictions = 0
+
+    def close(self) -> None:
+        """Close this process's connection to the database. It is reopened if the cache is used again."""
+        with self._lock:
+            if self._connection is not None:
+                if self._connection_pid == os.getpid():
+                    self._connection.close()
+                else:
+                    _INHERITED_CONNECTIONS.append(self._connection)
+                self._connection = None
+
+    def stats(self) -> CacheStats:
+        """Get the statistics of this process's lookups, and the size of the cache shared by all processes."""
+        with self._lock:
+            entries, total_bytes = (
+                self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            )
+            return CacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                entries=entries,
+                total_bytes=total_bytes,
+            )
+
+
+def _json_value(value: Any) -> Any:
+    """Convert a value that JSON can't serialize to one that it can, for the cache key of a message."""
+    if hasattr(value, "model_dump"):
+        # Pydantic models, like the message types of the openai package
+        return value.model_dump(mode="json")
+    if isinstance(value, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    # Other values, like arbitrary objects, have no stable serialization, and their repr can hold a memory address
+    raise TypeError(f"Could not compute a cache key for message value of type {type(value).__name__}")
+
+
+def message_cache_key(namespace: str, message: Mapping[str, Any]) -> tuple[str, int]:
+    """
+    Compute a stable, content-addressed cache key for a message.
+    Args:
+        namespace (str): A prefix that separates counts that are not interchangeable, like the encoding name.
+        message (Mapping): The message to compute the key for, with JSON values, pydantic models or bytes.
+    Returns:
+        tuple[str, int]: The key, and the size in bytes of the serialized message.
+    Raises:
+        TypeError: If the message holds a value of any other type.
+    """
+    serialized = json.dumps(
+        message, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=_json_value
+    ).encode()
+    return f"{namespace}:{hashlib.blake2b(serialized, digest_size=16).hexdigest()}", len(serialized)
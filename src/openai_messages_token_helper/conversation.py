@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import logging
+from bisect import bisect_left
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from .message_builder import _MessageBuilder
+from .model_helper import count_tokens_for_message, count_tokens_for_system_and_tools, get_token_limit
+from .tools_helper import ToolSet
+
+if TYPE_CHECKING:
+    from openai.types.chat import (
+        ChatCompletionContentPartParam,
+        ChatCompletionMessageParam,
+        ChatCompletionToolChoiceOptionParam,
+        ChatCompletionToolParam,
+    )
+
+
+class Conversation:
+    """
+    A chat conversation that keeps a ledger of the token count of every message in its history,
+    so that each turn only counts the newly appended messages.
+    Attributes:
+        model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+        max_tokens (int): The maximum number of tokens allowed for the built messages.
+        prefix_token_count (int): The number of tokens in the system prompt, tools and few-shots.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        system_prompt: str,
+        *,
+        tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+        tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+        few_shots: list[ChatCompletionMessageParam] = [],
+        max_tokens: int | None = None,
+        fallback_to_default: bool = False,
+    ):
+        """
+        Args:
+            model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+            system_prompt (str): The initial system prompt message.
+            tools (list[ChatCompletionToolParam] | ToolSet): A list of tools to include in the conversation,
+            or a ToolSet that memoizes their token count across calls.
+            tool_choice (ChatCompletionToolChoiceOptionParam): The tool to use in the conversation.
+            few_shots (list[ChatCompletionMessageParam]): A few-shot list of messages to insert after the system prompt.
+            max_tokens (int): The maximum number of tokens allowed for the conversation.
+            fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        """
+        self.model = model
+        self.fallback_to_default = fallback_to_default
+        if max_tokens is None:
+            max_tokens = get_token_limit(model, default_to_minimum=fallback_to_default)
+        self.max_tokens = max_tokens
+
+        # The system prompt, tools and few-shots never change, so they are only counted once
+        self._message_builder = _MessageBuilder(system_prompt)
+        for shot in few_shots:
+            self._message_builder.add_few_shot(shot)
+        self._prefix_messages = self._message_builder.all_messages
+        self.prefix_token_count = count_tokens_for_system_and_tools(
+            model, self._message_builder.system_message, tools, tool_choice, default_to_cl100k=fallback_to_default
+        )
+        for shot in self._message_builder.few_shots:
+            self.prefix_token_count += self._count(shot)
+
+        self._messages: list[ChatCompletionMessageParam] = []
+        self._token_counts: list[int] = []
+        # The cumulative token counts of the history, where _cumulative_counts[i] is the sum of the first i counts
+        self._cumulative_counts: list[int] = [0]
+        # The last new user message passed to build_messages, which is usually appended next
+        self._pending_message: tuple[ChatCompletionMessageParam, int] | None = None
+
+    def _count(self, message: ChatCompletionMessageParam) -> int:
+        return count_tokens_for_message(self.model, message, default_to_cl100k=self.fallback_to_default)
+
+    @property
+    def messages(self) -> list[ChatCompletionMessageParam]:
+        """The full history of the conversation, not including the system prompt and few-shots."""
+        return list(self._messages)
+
+    @property
+    def token_counts(self) -> list[int]:
+        """The token count of each message in the history."""
+        return list(self._token_counts)
+
+    @property
+    def total_token_count(self) -> int:
+        """The number of tokens in the system prompt, tools, few-shots and the full history."""
+        return self.prefix_token_count + self._cumulative_counts[-1]
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def append(self, message: ChatCompletionMessageParam):
+        """
+        Appends a message to the history, counting only that message's tokens.
+        Args:
+            message (ChatCompletionMessageParam): The message to append, like a user message or an assistant reply.
+        """
+        normalized_message = _MessageBuilder.copy_message(message, "Conversation")
+        if self._pending_message is not None and self._pending_message[0] == message:
+            token_count = self._pending_message[1]
+        else:
+            token_count = self._count(message)
+        self._pending_message = None
+        self._messages.append(normalized_message)
+        self._token_counts.append(token_count)
+        self._cumulative_counts.append(self._cumulative_counts[-1] + token_count)
+
+    def extend(self, messages: Iterable[ChatCompletionMessageParam]):
+        """
+        Appends several messages to the history, in order.
+        Args:
+            messages (list[ChatCompletionMessageParam]): The messages to append.
+        """
+        for message in messages:
+            self.append(message)
+
+    def build_messages(
+        self, new_user_content: str | list[ChatCompletionContentPartParam] | None = None
+    ) -> list[ChatCompletionMessageParam]:
+        """
+        Build a list of messages for the next turn of the conversation, truncating the oldest history
+        if necessary to stay within the token limit. The result is the same as calling `build_messages`
+        with the whole history, but the truncation point is found by binary search over the
+        cumulative token counts, so only the newest messages that are kept are visited.
+        Args:
+            new_user_content (str | List[ChatCompletionContentPartParam]): Content of new user message to append.
+        Returns:
+            list[ChatCompletionMessageParam]: The system prompt, few-shots, kept history and new user message.
+        """
+        total_token_count = self.prefix_token_count
+        new_messages: list[ChatCompletionMessageParam] = []
+        if new_user_content:
+            new_user_message = _MessageBuilder.create_message("user", new_user_content)
+            new_user_token_count = self._count(new_user_message)
+            self._pending_message = (new_user_message, new_user_token_count)
+            total_token_count += new_user_token_count
+            new_messages.append(new_user_message)
+
+        # The kept history starts at the first message whose suffix of counts fits in the remaining budget
+        history_token_count = self._cumulative_counts[-1]
+        remaining_tokens = self.max_tokens - total_token_count
+        start = min(bisect_left(self._cumulative_counts, history_token_count - remaining_tokens), len(self._messages))
+        if start > 0:
+            logging.info("Reached max tokens of %d, history will be truncated", self.max_tokens)
+        return self._prefix_messages + self._messages[start:] + new_messages
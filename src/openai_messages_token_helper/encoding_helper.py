@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import re
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
+
+from . import instrumentation
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# The encodings whose pre-tokenizer never merges text across a SAFE_BOUNDARY,
+# so that the pieces on either side of one can be encoded separately
+SAFE_SPLIT_ENCODINGS = {"cl100k_base", "o200k_base", "o200k_harmony"}
+# Punctuation that is never a letter, digit or combining mark, and never joins the letter piece before it
+_PUNCTUATION = (
+    '!"#$%&()*+,\\-./:;<=>?@\\[\\\\\\]^_`{|}~'  # ASCII, but the apostrophe of contractions
+    "‐-‧‰-⁞"  # General punctuation
+    "،؛؟۔।॥"  # Arabic and Devanagari
+    "、。〈-】〔-〟！-／：-＠［-｀｛-･"  # CJK and full-width
+)
+# Positions where a piece always ends: after a line break and before a letter or digit,
+# after a non-whitespace character and before a space followed by a letter,
+# or after a letter and before punctuation, which is what separates words in scripts without spaces.
+# A "/" can't follow the line break, since o200k's punctuation pieces absorb it.
+SAFE_BOUNDARY = re.compile(rf"(?<=[\r\n])(?=[^\W_])|(?<=\S)(?= [^\W\d_])|(?<=[^\W\d_])(?=[{_PUNCTUATION}])")
+
+DEFAULT_CHUNK_SIZE = 16_384
+
+
+def iter_text_chunks(encoding: tiktoken.Encoding, text: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Split a text into chunks of about `chunk_size` characters at safe boundaries,
+    so that encoding the chunks separately gives the same tokens as encoding the whole text.
+    Texts for encodings without known safe boundaries, and texts without any boundary, are kept whole.
+    Args:
+        encoding (tiktoken.Encoding): The encoding the chunks will be encoded with.
+        text (str): The text to split.
+        chunk_size (int): The target number of characters in each chunk. Chunks are longer when boundaries are sparse.
+    Returns:
+        Iterator[str]: The chunks, which concatenate to the text.
+    """
+    start = 0
+    if encoding.name in SAFE_SPLIT_ENCODINGS:
+        while len(text) - start > chunk_size:
+            boundary = SAFE_BOUNDARY.search(text, start + chunk_size)
+            if boundary is None:
+                break
+            yield text[start : boundary.start()]
+            start = boundary.start()
+    yield text[start:]
+
+
+def find_stable_cut(encoding: tiktoken.Encoding, text: str, tail_tokens: int) -> tuple[int, int]:
+    """
+    Find where to cut a text that has no safe boundary, at a token before its last `tail_tokens` tokens
+    where the text after the cut encodes to the same tokens as it does at the end of the whole text.
+    Tokens only merge differently across such a cut if text added later changes the merges more than
+    `tail_tokens` tokens back, within a single piece of the pre-tokenizer.
+    Args:
+        encoding (tiktoken.Encoding): The encoding to use.
+        text (str): The text to cut.
+        tail_tokens (int): The number of tokens at the end of the text to keep after the cut.
+    Returns:
+        tuple[int, int]: The number of characters and tokens before the cut, or zeros if no cut was found.
+    """
+    tokens = encoding.encode_ordinary(text)
+    last_cut = len(tokens) - tail_tokens
+    for cut in range(last_cut, max(last_cut - tail_tokens, 0), -1):
+        try:
+            head = encoding.decode_bytes(tokens[:cut]).decode()
+        except UnicodeDecodeError:
+            # The cut is inside a multi-byte character
+            continue
+        if encoding.encode_ordinary(text[len(head) :]) == tokens[cut:]:
+            return len(head), cut
+    return 0, 0
+
+
+def count_tokens_bounded(
+    encoding: tiktoken.Encoding, text: str, limit: int, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> int:
+    """
+    Count the tokens in a text, encoding it in chunks and stopping as soon as the count exceeds the limit,
+    so that the cost of counting a huge text is bounded by the limit rather than by the text's size.
+    Args:
+        encoding (tiktoken.Encoding): The encoding to use.
+        text (str): The text to count tokens for.
+        limit (int): The number of tokens to stop counting after.
+        chunk_size (int): The target number of characters to encode at a time.
+    Returns:
+        int: The number of tokens if it is at most the limit, otherwise a partial count greater than the limit.
+    """
+    num_tokens = 0
+    for chunk in iter_text_chunks(encoding, text, chunk_size):
+        if instrumentation.tracer is not None:
+            instrumentation.record_encode(chunk)
+        num_tokens += len(encoding.encode(chunk))
+        if num_tokens > limit:
+            break
+    return num_tokens
+
+
+def split_for_threads(encoding: tiktoken.Encoding, text: str, num_threads: int) -> list[str]:
+    """Split a large text at safe boundaries into chunks to encode on a number of threads."""
+    # A few chunks per thread balance the load, since some text encodes slower than other text
+    return list(iter_text_chunks(encoding, text, max(len(text) // (num_threads * 4), DEFAULT_CHUNK_SIZE)))
+
+
+def count_tokens_parallel(
+    encoding: tiktoken.Encoding, text: str, num_threads: int = 8, limit: int | None = None
+) -> int:
+    """
+    Count the tokens in a large text by splitting it at safe boundaries and encoding the chunks on a thread pool.
+    tiktoken releases the GIL while encoding, so the count takes about as long as the text divided by the threads.
+    Texts for encodings without known safe boundaries are encoded whole, on one thread.
+    Args:
+        encoding (tiktoken.Encoding): The encoding to use.
+        text (str): The text to count tokens for.
+        num_threads (int): The number of threads to encode the chunks with.
+        limit (int): If given, encode the chunks in rounds of one per thread, and stop once the count exceeds it.
+    Returns:
+        int: The number of tokens if it is at most the limit, otherwise a partial count greater than the limit.
+    """
+    if limit is None:
+        chunks = split_for_threads(encoding, text, num_threads)
+        round_size = len(chunks)
+    else:
+        chunks = list(iter_text_chunks(encoding, text))
+        round_size = num_threads
+    num_tokens = 0
+    for start in range(0, len(chunks), round_size):
+        batch = chunks[start : start + round_size]
+        if instrumentation.tracer is not None:
+            instrumentation.record_encode(*batch)
+        num_tokens += sum(len(tokens) for tokens in encoding.encode_batch(batch, num_threads=num_threads))
+        if limit is not None and num_tokens > limit:
+            break
+    return num_tokens
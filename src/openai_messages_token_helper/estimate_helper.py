@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import math
+import re
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from .model_helper import _split_message, encoding_for_model
+
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import ChatCompletionMessageParam
+
+# The typical number of UTF-8 bytes per token for English prose and code, used for the expected count
+BYTES_PER_TOKEN = {
+    "o200k_base": 4.3,
+    "o200k_harmony": 4.3,
+    "cl100k_base": 4.2,
+    "p50k_base": 3.4,
+    "p50k_edit": 3.4,
+    "r50k_base": 3.4,
+}
+DEFAULT_BYTES_PER_TOKEN = 4.0
+
+# The encodings whose pre-tokenizer never puts two words (runs of non-whitespace) in the same piece,
+# except for o200k's "/" after a newline, so that the number of words is a lower bound on the number of tokens
+WORD_BOUNDED_ENCODINGS = set(BYTES_PER_TOKEN)
+# The Unicode White_Space characters, which the pre-tokenizer's \s matches.
+# Python's \s also matches the \x1c-\x1f separators, which the pre-tokenizer treats as punctuation.
+WHITESPACE = r"\t\n\x0b\x0c\r \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000"
+# The first character of each word, not preceded by a non-whitespace character
+WORD_START = re.compile(f"(?<![^{WHITESPACE}])[^{WHITESPACE}/]")
+
+# The byte length of the longest token of each encoding, computed once per encoding
+_MAX_TOKEN_BYTES: dict[str, int] = {}
+
+
+@dataclass(frozen=True)
+class TokenEstimate:
+    """
+    An estimate of the number of tokens in a message, with bounds that the exact count is guaranteed to be within.
+    Attributes:
+        lower (int): A lower bound on the number of tokens.
+        upper (int): An upper bound on the number of tokens.
+        expected (int): The expected number of tokens, from the typical bytes per token of the encoding.
+    """
+
+    lower: int
+    upper: int
+    expected: int
+
+    def fits(self, max_tokens: int) -> bool | None:
+        """
+        Check whether the message fits within a number of tokens, if that can be decided from the bounds.
+        Returns:
+            bool | None: True if it surely fits, False if it surely doesn't, or None if an exact count is needed.
+        """
+        if self.upper <= max_tokens:
+            return True
+        if self.lower > max_tokens:
+            return False
+        return None
+
+
+def _max_token_bytes(encoding: tiktoken.Encoding) -> int:
+    max_token_bytes = _MAX_TOKEN_BYTES.get(encoding.name)
+    if max_token_bytes is None:
+        max_token_bytes = _MAX_TOKEN_BYTES[encoding.name] = max(len(token) for token in encoding.token_byte_values())
+    return max_token_bytes
+
+
+def _text_byte_length(text: str) -> int:
+    # ASCII strings are one byte per character, and checking for them doesn't scan the string
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+def estimate_text_lower_bound(encoding: tiktoken.Encoding, text: str) -> int:
+    """
+    Get a lower bound on the number of tokens in a text: the larger of the byte length divided by the length
+    of the longest token, and, for the OpenAI encodings, the number of whitespace-separated words.
+    """
+    lower = math.ceil(_text_byte_length(text) / _max_token_bytes(encoding))
+    if encoding.name in WORD_BOUNDED_ENCODINGS:
+        lower = max(lower, len(WORD_START.findall(text)))
+    return lower
+
+
+def estimate_tokens(model: str, message: ChatCompletionMessageParam, default_to_cl100k=False) -> TokenEstimate:
+    """
+    Quickly estimate the number of tokens required to encode a message, without encoding it.
+    The exact count from `count_tokens_for_message` is guaranteed to be within the lower and upper bounds,
+    so they can decide whether a message surely fits or surely doesn't fit within a budget.
+    The per-message overhead and images are counted exactly.
+    Args:
+        model (str): The name of the model to use for encoding.
+        message (Mapping): The message to estimate, in a dictionary-like object.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+    Returns:
+        TokenEstimate: The lower and upper bounds and the expected number of tokens.
+    """
+    encoding = encoding_for_model(model, default_to_cl100k)
+    texts, num_tokens = _split_message(model, message)
+    byte_length = sum(_text_byte_length(text) for text in texts)
+    lower = num_tokens + sum(estimate_text_lower_bound(encoding, text) for text in texts)
+    upper = num_tokens + byte_length
+    expected = num_tokens + round(byte_length / BYTES_PER_TOKEN.get(encoding.name, DEFAULT_BYTES_PER_TOKEN))
+    return TokenEstimate(lower=lower, upper=upper, expected=min(max(expected, lower), upper))
+
+
+def _estimate_upper_bound(model: str, message: ChatCompletionMessageParam) -> int:
+    """Get an upper bound on the number of tokens in a message, which only needs the byte length of its texts."""
+    texts, num_tokens = _split_message(model, message)
+    return num_tokens + sum(_text_byte_length(text) for text in texts)
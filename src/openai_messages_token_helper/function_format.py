@@ -6,23 +6,29 @@ def format_function_definitions(tools):
     lines.append("namespace functions {")
     lines.append("")
     for tool in tools:
-        function = tool.get("function")
-        if function_description := function.get("description"):
-            lines.append(f"// {function_description}")
-        function_name = function.get("name")
-        parameters = function.get("parameters", {})
-        properties = parameters.get("properties")
-        if properties and properties.keys():
-            lines.append(f"type {function_name} = (_: {{")
-            lines.append(format_object_parameters(parameters, 0))
-            lines.append("}) => any;")
-        else:
-            lines.append(f"type {function_name} = () => any;")
-        lines.append("")
+        lines.append(format_function_definition(tool))
     lines.append("} // namespace functions")
     return "\n".join(lines)
 
 
+def format_function_definition(tool):
+    lines = []
+    function = tool.get("function")
+    if function_description := function.get("description"):
+        lines.append(f"// {function_description}")
+    function_name = function.get("name")
+    parameters = function.get("parameters", {})
+    properties = parameters.get("properties")
+    if properties and properties.keys():
+        lines.append(f"type {function_name} = (_: {{")
+        lines.append(format_object_parameters(parameters, 0))
+        lines.append("}) => any;")
+    else:
+        lines.append(f"type {function_name} = () => any;")
+    lines.append("")
+    return "\n".join(lines)
+
+
 def format_object_parameters(parameters, indent):
     properties = parameters.get("properties")
     if not properties:
@@ -1,29 +1,159 @@
 import base64
+import binascii
+import hashlib
 import math
 import re
 from fractions import Fraction
 from io import BytesIO
 from typing import Optional
 
-from PIL import Image
+from .cache import CacheBackend, LRUCache
 
+DATA_URI_PREFIX = re.compile(r"data:image\/\w+;base64,")
 
-def get_image_dims(image_uri: str) -> tuple[int, int]:
+# JPEG start-of-frame markers, which hold the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# JPEG markers that aren't followed by a segment length
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+# How many JPEG segments to skip while looking for a start-of-frame marker, before giving up
+JPEG_MAX_SEGMENTS = 256
+
+# Dimensions of the images that had to be fully decoded, keyed by a digest of their data URI.
+# Dimensions don't depend on the detail level or model, so every token count for an image can reuse them.
+IMAGE_DIMS_CACHE: LRUCache[tuple[int, int]] = LRUCache(max_entries=1024)
+# The cache that count_tokens_for_image uses, which can be replaced with one shared by several processes
+_image_dims_cache: Optional[CacheBackend[tuple[int, int]]] = IMAGE_DIMS_CACHE
+
+
+def set_image_dims_cache(cache: Optional[CacheBackend[tuple[int, int]]]) -> None:
+    """
+    Set the cache of the dimensions of images that had to be fully decoded, used when counting image tokens,
+    like a `SQLiteCache` shared by all the worker processes on a machine.
+    Args:
+        cache (CacheBackend[tuple[int, int]]): The cache to use, or None to not cache dimensions.
+    """
+    global _image_dims_cache
+    _image_dims_cache = cache
+
+
+def _read_base64(image_uri: str, payload_start: int, start: int, length: int) -> bytes:
+    """
+    Decode a range of bytes from the base64 payload of a data URI, without decoding the rest of it.
+    Args:
+        image_uri (str): The data URI.
+        payload_start (int): The index in the URI where the base64 payload starts.
+        start (int): The offset of the first decoded byte to return.
+        length (int): The number of decoded bytes to return.
+    Returns:
+        bytes: The decoded bytes, which are shorter than `length` if the payload ends first.
+    """
+    # Every 4 base64 characters decode to 3 bytes, so decode the smallest aligned group of characters
+    first_group = start // 3
+    last_group = -(-(start + length) // 3)
+    chars = image_uri[payload_start + first_group * 4 : payload_start + last_group * 4]
+    decoded = base64.b64decode(chars)
+    offset = start - first_group * 3
+    return decoded[offset : offset + length]
+
+
+def sniff_image_dims(image_uri: str, payload_start: int) -> Optional[tuple[int, int]]:
+    """
+    Read the dimensions of a PNG, GIF, WebP or JPEG image from its header,
+    decoding only the few bytes that are needed from the base64 payload.
+    Args:
+        image_uri (str): The data URI of the image.
+        payload_start (int): The index in the URI where the base64 payload starts.
+    Returns:
+        tuple[int, int]: The width and height, or None if the format isn't recognized.
+    """
+    try:
+        header = _read_base64(image_uri, payload_start, 0, 30)
+        if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+            return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+        if header[:6] in (b"GIF87a", b"GIF89a"):
+            return int.from_bytes(header[6:8], "little"), int.from_bytes(header[8:10], "little")
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return _webp_dims(header)
+        if header[:2] == b"\xff\xd8":
+            return _jpeg_dims(image_uri, payload_start)
+    except (binascii.Error, ValueError):
+        pass
+    return None
+
+
+def _webp_dims(header: bytes) -> Optional[tuple[int, int]]:
+    chunk = header[12:16]
+    if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+        # Lossy: 14-bit dimensions in the frame header
+        return int.from_bytes(header[26:28], "little") & 0x3FFF, int.from_bytes(header[28:30], "little") & 0x3FFF
+    if chunk == b"VP8L" and header[20] == 0x2F:
+        # Lossless: 14-bit dimensions minus one, packed after the signature byte
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        # Extended: 24-bit dimensions minus one
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    return None
+
+
+def _jpeg_dims(image_uri: str, payload_start: int) -> Optional[tuple[int, int]]:
+    # Walk the segments after the start-of-image marker, decoding only each segment's header
+    position = 2
+    for _ in range(JPEG_MAX_SEGMENTS):
+        segment = _read_base64(image_uri, payload_start, position, 9)
+        if len(segment) < 4 or segment[0] != 0xFF:
+            return None
+        marker = segment[1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            position += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if len(segment) < 9:
+                return None
+            return int.from_bytes(segment[7:9], "big"), int.from_bytes(segment[5:7], "big")
+        position += 2 + int.from_bytes(segment[2:4], "big")
+    return None
+
+
+def get_image_dims(
+    image_uri: str, cache: Optional[CacheBackend[tuple[int, int]]] = IMAGE_DIMS_CACHE
+) -> tuple[int, int]:
     # From https://github.com/openai/openai-cookbook/pull/881/files
-    if re.match(r"data:image\/\w+;base64", image_uri):
-        image_uri = re.sub(r"data:image\/\w+;base64,", "", image_uri)
-        image = Image.open(BytesIO(base64.b64decode(image_uri)))
+    if match := DATA_URI_PREFIX.match(image_uri):
+        # Most formats store their dimensions in the first few bytes, so avoid decoding the whole image
+        if dims := sniff_image_dims(image_uri, match.end()):
+            return dims
+        # Hashing the image is much cheaper than decoding it again
+        if cache is not None:
+            cache_key = hashlib.blake2b(image_uri.encode(), digest_size=16).hexdigest()
+            if cached_dims := cache.get(cache_key):
+                return cached_dims
+        # Pillow is only imported for the formats that can't be sniffed, since importing it is slow
+        from PIL import Image
+
+        image = Image.open(BytesIO(base64.b64decode(image_uri[match.end() :])))
+        if cache is not None:
+            cache.put(cache_key, image.size)
         return image.size
     else:
         raise ValueError("Image must be a base64 string.")
 
 
+def image_cost_multiplier(model: Optional[str] = None) -> Fraction:
+    # gpt-4o-mini charges more tokens per image tile than the other vision models
+    if model == "gpt-4o-mini":
+        return Fraction(100, 3)
+    return Fraction(1, 1)
+
+
 def count_tokens_for_image(image_uri: str, detail: str = "auto", model: Optional[str] = None) -> int:
     # From https://github.com/openai/openai-cookbook/pull/881/files
     # Based on https://platform.openai.com/docs/guides/vision
-    multiplier = Fraction(1, 1)
-    if model == "gpt-4o-mini":
-        multiplier = Fraction(100, 3)
+    multiplier = image_cost_multiplier(model)
     COST_PER_TILE = 85 * multiplier
     LOW_DETAIL_COST = COST_PER_TILE
     HIGH_DETAIL_COST_PER_TILE = COST_PER_TILE * 2
@@ -37,7 +167,7 @@ def count_tokens_for_image(image_uri: str, detail: str = "auto", model: Optional
         return int(LOW_DETAIL_COST)
     elif detail == "high":
         # Calculate token cost for high detail images
-        width, height = get_image_dims(image_uri)
+        width, height = get_image_dims(image_uri, _image_dims_cache)
         # Check if resizing is needed to fit within a 2048 x 2048 square
         if max(width, height) > 2048:
             # Resize dimensions to fit within a 2048 x 2048 square
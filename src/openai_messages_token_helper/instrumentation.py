@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import time
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Protocol
+
+ATTRIBUTE_PREFIX = "token_helper."
+
+
+class Span(Protocol):
+    def set_attribute(self, key: str, value: Any) -> Any: ...
+
+
+class Tracer(Protocol):
+    """The subset of an OpenTelemetry tracer that is used, like the one returned by `opentelemetry.trace.get_tracer`."""
+
+    def start_as_current_span(self, name: str) -> AbstractContextManager[Span]: ...
+
+
+@dataclass
+class OperationStats:
+    """
+    The counters of one traced operation, set as attributes on its span when it ends.
+    Attributes:
+        encode_calls (int): The number of calls to the encoder, where a batch counts as one call.
+        encoded_bytes (int): The number of UTF-8 bytes passed to the encoder.
+        cache_hits (int): The number of message token counts found in the cache.
+        cache_misses (int): The number of message token counts not found in the cache.
+        messages_kept (int): The number of past messages kept.
+        messages_dropped (int): The number of past messages dropped by truncation.
+    """
+
+    encode_calls: int = 0
+    encoded_bytes: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    messages_kept: int = 0
+    messages_dropped: int = 0
+
+
+# The tracer that spans are started on, or None when instrumentation is disabled
+tracer: Tracer | None = None
+_current_stats: ContextVar[OperationStats | None] = ContextVar("openai_messages_token_helper_stats", default=None)
+_NULL_CONTEXT: nullcontext[None] = nullcontext()
+
+
+def set_tracer(new_tracer: Tracer | None) -> None:
+    """
+    Set the tracer to instrument the library with, or None to disable instrumentation.
+    `build_messages` and `build_messages_many` each start a span with counters like the number of encode calls
+    and dropped messages as attributes, and phases like counting and truncation are child spans.
+    Args:
+        new_tracer (Tracer): An OpenTelemetry tracer, or any object with a compatible `start_as_current_span`.
+    """
+    global tracer
+    tracer = new_tracer
+
+
+def operation(name: str) -> AbstractContextManager[OperationStats | None]:
+    """Start a span for a public operation that collects counters, or do nothing if instrumentation is disabled."""
+    if tracer is None:
+        return _NULL_CONTEXT
+    return _traced_operation(tracer, name)
+
+
+@contextmanager
+def _traced_operation(active_tracer: Tracer, name: str) -> Iterator[OperationStats]:
+    stats = OperationStats()
+    token = _current_stats.set(stats)
+    try:
+        with active_tracer.start_as_current_span(name) as span:
+            try:
+                yield stats
+            finally:
+                for key, value in asdict(stats).items():
+                    span.set_attribute(ATTRIBUTE_PREFIX + key, value)
+    finally:
+        _current_stats.reset(token)
+
+
+def phase(name: str) -> AbstractContextManager[Any]:
+    """Start a span for a phase of an operation, or do nothing if instrumentation is disabled."""
+    if tracer is None:
+        return _NULL_CONTEXT
+    return tracer.start_as_current_span(name)
+
+
+def record_encode(*texts: str) -> None:
+    """Count one call to the encoder with the given texts, in the current operation."""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.encode_calls += 1
+        stats.encoded_bytes += sum(len(text.encode("utf-8")) for text in texts)
+
+
+def record_cache_lookup(hit: bool) -> None:
+    """Count a lookup of a message token count in the cache, in the current operation."""
+    stats = _current_stats.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+@dataclass
+class RecordedSpan:
+    """
+    A span recorded by a `RecordingTracer`.
+    Attributes:
+        name (str): The name of the span.
+        attributes (dict): The attributes set on the span.
+        duration (float): How long the span took, in seconds.
+    """
+
+    name: str
+    attributes: dict[str, Any] = field(default_factory=dict)
+    duration: float = 0.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+
+class RecordingTracer:
+    """
+    A tracer that keeps the spans in memory, for debugging and tests without OpenTelemetry.
+    Attributes:
+        spans (list[RecordedSpan]): The finished spans, in the order they ended.
+    """
+
+    def __init__(self):
+        self.spans: list[RecordedSpan] = []
+
+    @contextmanager
+    def start_as_current_span(self, name: str) -> Iterator[RecordedSpan]:
+        span = RecordedSpan(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span.duration = time.perf_counter() - start
+            self.spans.append(span)
@@ -1,25 +1,42 @@
+from __future__ import annotations
+
 import logging
 import unicodedata
-from collections.abc import Iterable
-from typing import Optional, Union
-
-from openai.types.chat import (
-    ChatCompletionAssistantMessageParam,
-    ChatCompletionContentPartParam,
-    ChatCompletionMessageParam,
-    ChatCompletionMessageToolCallParam,
-    ChatCompletionRole,
-    ChatCompletionSystemMessageParam,
-    ChatCompletionToolChoiceOptionParam,
-    ChatCompletionToolMessageParam,
-    ChatCompletionToolParam,
-    ChatCompletionUserMessageParam,
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import TYPE_CHECKING, Any, Literal
+
+from . import instrumentation
+from .cache import CacheBackend
+from .estimate_helper import _estimate_upper_bound, estimate_text_lower_bound, estimate_tokens
+from .model_helper import (
+    _count_message,
+    _truncate_tokens,
+    _warn_if_reasoning_model,
+    count_tokens_for_messages,
+    count_tokens_for_tools,
+    encoding_for_model,
+    get_token_limit,
 )
+from .tools_helper import ToolSet
 
-from .model_helper import count_tokens_for_message, count_tokens_for_system_and_tools, get_token_limit
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import (
+        ChatCompletionContentPartParam,
+        ChatCompletionMessageParam,
+        ChatCompletionMessageToolCallParam,
+        ChatCompletionRole,
+        ChatCompletionSystemMessageParam,
+        ChatCompletionToolChoiceOptionParam,
+        ChatCompletionToolParam,
+    )
 
 
-def normalize_content(content: Union[str, Iterable[ChatCompletionContentPartParam], None]):
+def normalize_content(content: str | Iterable[ChatCompletionContentPartParam] | None):
     if content is None:
         return None
     if isinstance(content, str):
@@ -34,66 +51,258 @@ def normalize_content(content: Union[str, Iterable[ChatCompletionContentPartPara
 class _MessageBuilder:
     """
     A class for building and managing messages in a chat conversation.
+    Messages are kept in separate collections for each section of the conversation,
+    so that every message is added in constant time and the final list is assembled once.
     Attributes:
-        message (list): A list of dictionaries representing chat messages.
-        model (str): The name of the ChatGPT model.
-        token_count (int): The total number of tokens in the conversation.
+        system_message (ChatCompletionSystemMessageParam): The system prompt message.
+        few_shots (list): The few-shot messages, which always follow the system prompt.
+        past_messages (deque): The kept history of past messages, from oldest to newest.
+        new_messages (list): The messages that always come last, like the new user message.
     Methods:
-        __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
-        insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        __init__(self, system_content: str): Initializes the MessageBuilder instance.
+        add_few_shot(self, message): Appends a message to the few-shots.
+        prepend_past_message(self, message): Adds a message before the kept history, for walking newest to oldest.
+        append_new_message(self, message): Appends a message after the kept history.
     """
 
     def __init__(self, system_content: str):
-        self.system_message = ChatCompletionSystemMessageParam(role="system", content=normalize_content(system_content))
-        self.messages: list[ChatCompletionMessageParam] = []
+        self.system_message: ChatCompletionSystemMessageParam = {
+            "role": "system",
+            "content": normalize_content(system_content),
+        }
+        self.few_shots: list[ChatCompletionMessageParam] = []
+        self.past_messages: deque[ChatCompletionMessageParam] = deque()
+        self.new_messages: list[ChatCompletionMessageParam] = []
+
+    @property
+    def required_messages(self) -> list[ChatCompletionMessageParam]:
+        """The messages after the system prompt that are never truncated."""
+        return self.few_shots + self.new_messages
 
     @property
     def all_messages(self) -> list[ChatCompletionMessageParam]:
-        return [self.system_message] + self.messages
+        messages: list[ChatCompletionMessageParam] = [self.system_message]
+        messages.extend(self.few_shots)
+        messages.extend(self.past_messages)
+        messages.extend(self.new_messages)
+        return messages
 
-    def insert_message(
-        self,
+    @staticmethod
+    def create_message(
         role: ChatCompletionRole,
-        content: Union[str, Iterable[ChatCompletionContentPartParam], None],
-        index: int = 0,
-        tool_calls: Optional[Iterable[ChatCompletionMessageToolCallParam]] = None,
-        tool_call_id: Optional[str] = None,
-    ):
+        content: str | Iterable[ChatCompletionContentPartParam] | None,
+        tool_calls: Iterable[ChatCompletionMessageToolCallParam] | None = None,
+        tool_call_id: str | None = None,
+    ) -> ChatCompletionMessageParam:
         """
-        Inserts a message into the conversation at the specified index,
-        or at index 0 if no index is specified.
+        Creates a message with normalized content, validating that the fields match the role.
         Args:
-            role (str): The role of the message sender (either "user", "system", or "assistant").
+            role (str): The role of the message sender (either "user", "assistant", or "tool").
             content (str | List[ChatCompletionContentPartParam]): The content of the message.
-            index (int): The index at which to insert the message.
+            tool_calls (list[ChatCompletionMessageToolCallParam]): The tool calls of an assistant message.
+            tool_call_id (str): The ID of the tool call that a tool message responds to.
         """
+        # The message types are only imported for type checking, so messages are built as dict literals
         message: ChatCompletionMessageParam
         if role == "user":
-            message = ChatCompletionUserMessageParam(role="user", content=normalize_content(content))
+            message = {"role": "user", "content": normalize_content(content)}
         elif role == "assistant" and isinstance(content, str):
-            message = ChatCompletionAssistantMessageParam(role="assistant", content=normalize_content(content))
+            message = {"role": "assistant", "content": normalize_content(content)}
         elif role == "assistant" and tool_calls is not None:
-            message = ChatCompletionAssistantMessageParam(role="assistant", tool_calls=tool_calls)
+            message = {"role": "assistant", "tool_calls": tool_calls}
         elif role == "tool" and tool_call_id is not None:
-            message = ChatCompletionToolMessageParam(
-                role="tool", tool_call_id=tool_call_id, content=normalize_content(content)
-            )
+            message = {"role": "tool", "tool_call_id": tool_call_id, "content": normalize_content(content)}
         else:
             raise ValueError("Invalid message for builder")
-        self.messages.insert(index, message)
+        return message
+
+    @classmethod
+    def copy_message(cls, message: ChatCompletionMessageParam, kind: str) -> ChatCompletionMessageParam:
+        """
+        Validates a message passed in by the caller and creates a normalized copy of it.
+        Args:
+            message (ChatCompletionMessageParam): The message to copy.
+            kind (str): The kind of message, like "Few-shot", used in error messages.
+        """
+        if message["role"] is None or (message.get("content") is None and message.get("tool_calls") is None):
+            raise ValueError(f"{kind} messages must have role and either content or tool_calls")
+        tool_call_id = message.get("tool_call_id")
+        if tool_call_id is not None and not isinstance(tool_call_id, str):
+            raise ValueError("tool_call_id must be a string value")
+        tool_calls = message.get("tool_calls")
+        if tool_calls is not None and not isinstance(tool_calls, Iterable):
+            raise ValueError("tool_calls must be a list of tool calls")
+        return cls.create_message(
+            message["role"], message.get("content"), tool_calls=tool_calls, tool_call_id=tool_call_id  # type: ignore
+        )
+
+    def add_few_shot(self, message: ChatCompletionMessageParam):
+        self.few_shots.append(self.copy_message(message, "Few-shot"))
+
+    def prepend_past_message(self, message: ChatCompletionMessageParam):
+        self.past_messages.appendleft(self.copy_message(message, "Past"))
+
+    def append_new_message(self, message: ChatCompletionMessageParam):
+        self.new_messages.append(message)
+
+
+def _count_kept_messages(newest_to_oldest_counts: Iterable[int], budget: int) -> int:
+    """
+    Find how many of the newest messages fit within the budget, given their token counts from newest to oldest.
+    Since every message has a positive count, the cumulative sums are increasing and can be binary searched.
+    """
+    return bisect_right(list(accumulate(newest_to_oldest_counts)), budget)
+
+
+def _start_message_builder(
+    system_prompt: str,
+    few_shots: list[ChatCompletionMessageParam],
+    new_user_content: str | list[ChatCompletionContentPartParam] | None,
+) -> _MessageBuilder:
+    message_builder = _MessageBuilder(system_prompt)
+    for shot in few_shots:
+        message_builder.add_few_shot(shot)
+    if new_user_content:
+        message_builder.append_new_message(_MessageBuilder.create_message("user", new_user_content))
+    return message_builder
+
+
+def _keep_newest_messages(
+    message_builder: _MessageBuilder,
+    past_messages: Sequence[ChatCompletionMessageParam],
+    past_message_counts: Sequence[int],
+    budget: int,
+) -> list[int]:
+    """
+    Add the newest past messages that fit within the budget to the builder, given their token counts.
+    Returns the token counts of the kept messages, from oldest to newest.
+    """
+    kept_count = _count_kept_messages(reversed(past_message_counts), budget)
+    kept_start = len(past_messages) - kept_count
+    for message in reversed(past_messages[kept_start:]):
+        message_builder.prepend_past_message(message)
+    return list(past_message_counts[kept_start:])
+
+
+def _truncate_message_to_tokens(
+    model: str,
+    message: ChatCompletionMessageParam,
+    token_count: int | None,
+    max_tokens: int,
+    keep: Literal["head", "tail", "middle"],
+    fallback_to_default: bool,
+) -> tuple[ChatCompletionMessageParam, int]:
+    """
+    Truncate the text of a message, or its last text part, so that the whole message fits within max_tokens.
+    Returns the message, which is a truncated copy if it didn't fit, and its token count.
+    Without a known token count, the message is counted from the tokens of its text and the count of the rest of it,
+    so that the text is only encoded once whether it is truncated or not.
+    """
+    if keep not in ("head", "tail", "middle"):
+        raise ValueError(f"Unsupported keep value: {keep}")
+    encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
+    content = message.get("content")
+    parts: list[Any] = [] if isinstance(content, str) else list(content or [])
+    text_indexes = [index for index, part in enumerate(parts) if part["type"] == "text"]
+
+    def with_text(text: str) -> ChatCompletionMessageParam:
+        new_message: Any = dict(message)
+        if isinstance(content, str):
+            new_message["content"] = text
+        else:
+            new_message["content"] = list(parts)
+            new_message["content"][text_indexes[-1]] = {"type": "text", "text": text}
+        return new_message
+
+    if isinstance(content, str):
+        text = content
+    elif text_indexes:
+        text = parts[text_indexes[-1]]["text"]
+    else:
+        if token_count is None:
+            token_count = _count_message(model, encoding, message)
+        return message, token_count
+    if token_count is not None and token_count <= max_tokens:
+        return message, token_count
+    if instrumentation.tracer is not None:
+        instrumentation.record_encode(text)
+    tokens = encoding.encode(text)
+    if token_count is None:
+        # Message counts add up over their texts, so the rest of the message is counted with the text left out
+        rest_token_count = _count_message(model, encoding, with_text(""))
+        token_count = rest_token_count + len(tokens)
+        if token_count <= max_tokens:
+            return message, token_count
+    # The message's count only changes by the tokens dropped from the text
+    text_token_budget = max(len(tokens) - (token_count - max_tokens), 0)
+    truncated_text, truncated_token_count = _truncate_tokens(encoding, text, tokens, text_token_budget, keep)
+    return with_text(truncated_text), token_count - len(tokens) + truncated_token_count
+
+
+def _count_and_keep_newest_messages(
+    message_builder: _MessageBuilder,
+    model: str,
+    past_messages: Sequence[ChatCompletionMessageParam],
+    budget: int,
+    *,
+    fallback_to_default: bool,
+    cache: CacheBackend[int] | None,
+    use_estimates: bool,
+    newest_token_count: int | None = None,
+) -> list[int]:
+    """
+    Add the newest past messages that fit within the budget to the builder, counting them from newest to oldest.
+    Returns the token counts of the kept messages that were counted, from oldest to newest,
+    which leaves out the oldest messages that were kept by their estimates.
+    The newest message is not counted again if its token count is given.
+    """
+    encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
+    kept_counts: list[int] = []
+    if use_estimates:
+        # The upper bound of the oldest messages up to each index, where older_upper_bounds[i] covers the first i
+        older_upper_bounds = [0, *accumulate(_estimate_upper_bound(model, message) for message in past_messages)]
+
+    for index in reversed(range(len(past_messages))):
+        message = past_messages[index]
+        if use_estimates:
+            if older_upper_bounds[index + 1] <= budget:
+                # This message and all the older ones surely fit, so they are kept without encoding them
+                for older_message in reversed(past_messages[: index + 1]):
+                    message_builder.prepend_past_message(older_message)
+                break
+            if estimate_tokens(model, message, fallback_to_default).lower > budget:
+                break
+
+        if newest_token_count is not None and index == len(past_messages) - 1:
+            potential_message_count = newest_token_count
+        else:
+            # Messages over the remaining budget are only encoded until they cross it
+            potential_message_count = _count_message(model, encoding, message, cache=cache, limit=budget)
+        if potential_message_count > budget:
+            break
+
+        message_builder.prepend_past_message(message)
+        kept_counts.append(potential_message_count)
+        budget -= potential_message_count
+    kept_counts.reverse()
+    return kept_counts
 
 
 def build_messages(
     model: str,
     system_prompt: str,
     *,
-    tools: Optional[list[ChatCompletionToolParam]] = None,
-    tool_choice: Optional[ChatCompletionToolChoiceOptionParam] = None,
-    new_user_content: Union[str, list[ChatCompletionContentPartParam], None] = None,  # list is for GPT4v usage
+    tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+    tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+    new_user_content: str | list[ChatCompletionContentPartParam] | None = None,  # list is for GPT4v usage
     past_messages: list[ChatCompletionMessageParam] = [],  # *not* including system prompt
     few_shots: list[ChatCompletionMessageParam] = [],  # will always be inserted after system prompt
-    max_tokens: Optional[int] = None,
+    max_tokens: int | None = None,
     fallback_to_default: bool = False,
+    cache: CacheBackend[int] | None = None,
+    past_message_counts: Sequence[int] | None = None,
+    use_estimates: bool = False,
+    truncate_newest_message: Literal["head", "tail", "middle"] | None = None,
 ) -> list[ChatCompletionMessageParam]:
     """
     Build a list of messages for a chat conversation, given the system prompt, new user message,
@@ -102,53 +311,491 @@ def build_messages(
     Args:
         model (str): The model name to use for token calculation, like gpt-3.5-turbo.
         system_prompt (str): The initial system prompt message.
-        tools (list[ChatCompletionToolParam]): A list of tools to include in the conversation.
+        tools (list[ChatCompletionToolParam] | ToolSet): A list of tools to include in the conversation,
+            or a ToolSet that memoizes their token count across calls.
         tool_choice (ChatCompletionToolChoiceOptionParam): The tool to use in the conversation.
         new_user_content (str | List[ChatCompletionContentPartParam]): Content of new user message to append.
         past_messages (list[ChatCompletionMessageParam]): The list of past messages in the conversation.
         few_shots (list[ChatCompletionMessageParam]): A few-shot list of messages to insert after the system prompt.
         max_tokens (int): The maximum number of tokens allowed for the conversation.
         fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, shared across calls
+            so that past messages are only encoded once.
+        past_message_counts (list[int]): The token count of each past message, if already known,
+            like from `count_tokens_for_messages`. The truncation point is then found by binary search.
+        use_estimates (bool): Whether to use the bounds from `estimate_tokens` to skip encoding past messages
+            that surely fit or surely don't fit. The result is the same as with exact counts.
+        truncate_newest_message (str): If given, the text of the newest message is truncated with
+            `truncate_text_to_tokens` when it doesn't fit on its own, keeping its "head", "tail" or "middle",
+            so that the request always fits. The newest message is the new user message,
+            or without one, the last past message if it is a user or tool message, like a large tool result.
+            A tool result is truncated to leave room for the assistant message that called it.
+    """
+    message_builder, _, _ = _build_messages(
+        model,
+        system_prompt,
+        tools=tools,
+        tool_choice=tool_choice,
+        new_user_content=new_user_content,
+        past_messages=past_messages,
+        few_shots=few_shots,
+        max_tokens=max_tokens,
+        fallback_to_default=fallback_to_default,
+        cache=cache,
+        past_message_counts=past_message_counts,
+        use_estimates=use_estimates,
+        truncate_newest_message=truncate_newest_message,
+        reserve_tokens=None,
+    )
+    return message_builder.all_messages
+
+
+@dataclass(frozen=True)
+class BuildResult:
     """
+    The messages built by `build_messages_with_report`, along with the token counts that were computed to build them.
+    Attributes:
+        messages (list[ChatCompletionMessageParam]): The messages, the same as `build_messages`.
+        message_token_counts (list[int]): The number of tokens in each of the messages, in order.
+        tools_token_count (int): The number of tokens added by the tools and tool choice, on top of the system message.
+        prompt_tokens (int): The total number of tokens in the messages and tools.
+        truncation_index (int | None): The index in `past_messages` of the oldest message that was kept,
+            or None if no past messages were dropped.
+        dropped_count (int): The number of past messages that were dropped to stay within the token limit.
+    """
+
+    messages: list[ChatCompletionMessageParam]
+    message_token_counts: list[int]
+    tools_token_count: int
+    prompt_tokens: int
+    truncation_index: int | None
+    dropped_count: int
+
+    @property
+    def system_and_tools_token_count(self) -> int:
+        """The number of tokens in the system message and tools, as returned by `count_tokens_for_system_and_tools`."""
+        return self.message_token_counts[0] + self.tools_token_count
+
+
+def build_messages_with_report(
+    model: str,
+    system_prompt: str,
+    *,
+    tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+    tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+    new_user_content: str | list[ChatCompletionContentPartParam] | None = None,
+    past_messages: list[ChatCompletionMessageParam] = [],
+    few_shots: list[ChatCompletionMessageParam] = [],
+    max_tokens: int | None = None,
+    fallback_to_default: bool = False,
+    cache: CacheBackend[int] | None = None,
+    past_message_counts: Sequence[int] | None = None,
+    truncate_newest_message: Literal["head", "tail", "middle"] | None = None,
+) -> BuildResult:
+    """
+    Build a list of messages like `build_messages`, and report the token counts that were computed to build it,
+    like the total prompt tokens for setting `max_completion_tokens`, so they don't need to be counted again.
+    Every kept message is counted exactly, so `use_estimates` isn't supported.
+    Args:
+        model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+        system_prompt (str): The initial system prompt message.
+        tools (list[ChatCompletionToolParam] | ToolSet): A list of tools to include in the conversation,
+            or a ToolSet that memoizes their token count across calls.
+        tool_choice (ChatCompletionToolChoiceOptionParam): The tool to use in the conversation.
+        new_user_content (str | List[ChatCompletionContentPartParam]): Content of new user message to append.
+        past_messages (list[ChatCompletionMessageParam]): The list of past messages in the conversation.
+        few_shots (list[ChatCompletionMessageParam]): A few-shot list of messages to insert after the system prompt.
+        max_tokens (int): The maximum number of tokens allowed for the conversation.
+        fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, shared across calls.
+        past_message_counts (list[int]): The token count of each past message, if already known.
+        truncate_newest_message (str): If given, the part of the newest message's text to keep when it doesn't fit.
+    Returns:
+        BuildResult: The messages, the token count of each message, and how the history was truncated.
+    """
+    message_builder, message_token_counts, tools_token_count = _build_messages(
+        model,
+        system_prompt,
+        tools=tools,
+        tool_choice=tool_choice,
+        new_user_content=new_user_content,
+        past_messages=past_messages,
+        few_shots=few_shots,
+        max_tokens=max_tokens,
+        fallback_to_default=fallback_to_default,
+        cache=cache,
+        past_message_counts=past_message_counts,
+        use_estimates=False,
+        truncate_newest_message=truncate_newest_message,
+        reserve_tokens=None,
+    )
+    dropped_count = len(past_messages) - len(message_builder.past_messages)
+    return BuildResult(
+        messages=message_builder.all_messages,
+        message_token_counts=message_token_counts,
+        tools_token_count=tools_token_count,
+        prompt_tokens=sum(message_token_counts) + tools_token_count,
+        truncation_index=dropped_count if dropped_count else None,
+        dropped_count=dropped_count,
+    )
+
+
+def _build_messages(
+    model: str,
+    system_prompt: str,
+    *,
+    tools: list[ChatCompletionToolParam] | ToolSet | None,
+    tool_choice: ChatCompletionToolChoiceOptionParam | None,
+    new_user_content: str | list[ChatCompletionContentPartParam] | None,
+    past_messages: list[ChatCompletionMessageParam],
+    few_shots: list[ChatCompletionMessageParam],
+    max_tokens: int | None,
+    fallback_to_default: bool,
+    cache: CacheBackend[int] | None,
+    past_message_counts: Sequence[int] | None,
+    use_estimates: bool,
+    truncate_newest_message: Literal["head", "tail", "middle"] | None,
+    reserve_tokens: Callable[[int], int] | None,
+) -> tuple[_MessageBuilder, list[int], int]:
+    """
+    Build the messages for `build_messages`, `build_messages_with_report` and `pack_sources`.
+    Returns the builder, the token count of each message in order, and the token count of the tools.
+    The counts leave out past messages that were kept by their estimates without being counted.
+    If given, reserve_tokens is called with the number of tokens left after the required messages,
+    and returns the number of them to hold back from the history.
+    """
+    if past_message_counts is not None and len(past_message_counts) != len(past_messages):
+        raise ValueError("past_message_counts must have one count for each past message")
+    # The messages are counted without warnings, so that the model's warnings are logged once per build
+    _warn_if_reasoning_model(model)
     if max_tokens is None:
         max_tokens = get_token_limit(model, default_to_minimum=fallback_to_default)
+    encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
 
-    # Start with the required messages: system prompt, few-shots, and new user message
-    message_builder = _MessageBuilder(system_prompt)
+    with instrumentation.operation("build_messages") as stats:
+        # Start with the required messages: system prompt, few-shots, and new user message
+        with instrumentation.phase("normalize"):
+            message_builder = _start_message_builder(system_prompt, few_shots, new_user_content)
 
-    for shot in reversed(few_shots):
-        if shot["role"] is None or (shot.get("content") is None and shot.get("tool_calls") is None):
-            raise ValueError("Few-shot messages must have role and either content or tool_calls")
-        tool_call_id = shot.get("tool_call_id")
-        if tool_call_id is not None and not isinstance(tool_call_id, str):
-            raise ValueError("tool_call_id must be a string value")
-        tool_calls = shot.get("tool_calls")
-        if tool_calls is not None and not isinstance(tool_calls, Iterable):
-            raise ValueError("tool_calls must be a list of tool calls")
-        message_builder.insert_message(
-            shot["role"], shot.get("content"), tool_calls=tool_calls, tool_call_id=tool_call_id  # type: ignore[arg-type]
-        )
+        with instrumentation.phase("count_required"):
+            # The same as count_tokens_for_system_and_tools, but keeping the system message's own count
+            system_token_count = _count_message(model, encoding, message_builder.system_message, cache=cache)
+            tools_token_count = count_tokens_for_tools(encoding, tools, tool_choice, has_system_message=True)
+            # A new message that may be truncated is counted while truncating it, so its text is encoded once
+            truncates_new_message = truncate_newest_message is not None and bool(message_builder.new_messages)
+            required_messages = message_builder.required_messages
+            required_token_counts = [
+                _count_message(model, encoding, message, cache=cache)
+                for message in (required_messages[:-1] if truncates_new_message else required_messages)
+            ]
+            total_token_count = system_token_count + tools_token_count + sum(required_token_counts)
 
-    append_index = len(few_shots)
+        newest_token_count = None
+        if truncate_newest_message is not None:
+            with instrumentation.phase("truncate_newest_message"):
+                if message_builder.new_messages:
+                    message_builder.new_messages[-1], new_message_token_count = _truncate_message_to_tokens(
+                        model,
+                        message_builder.new_messages[-1],
+                        None,
+                        max_tokens - total_token_count,
+                        truncate_newest_message,
+                        fallback_to_default,
+                    )
+                    required_token_counts.append(new_message_token_count)
+                    total_token_count += new_message_token_count
+                elif past_messages and past_messages[-1]["role"] in ("user", "tool"):
+                    # A tool result is only valid after the assistant message that called it,
+                    # so room is left for that message and the other results of its tool calls
+                    group_start = len(past_messages) - 1
+                    if past_messages[-1]["role"] == "tool":
+                        while group_start > 0 and past_messages[group_start - 1]["role"] == "tool":
+                            group_start -= 1
+                        if group_start > 0 and past_messages[group_start - 1].get("tool_calls"):
+                            group_start -= 1
+                    # Without known counts, the newest message is counted while truncating it, so it is encoded once
+                    if past_message_counts is not None:
+                        group_token_counts = list(past_message_counts[group_start:-1])
+                    else:
+                        group_token_counts = [
+                            _count_message(model, encoding, message, cache=cache)
+                            for message in past_messages[group_start:-1]
+                        ]
+                    newest_message, newest_token_count = _truncate_message_to_tokens(
+                        model,
+                        past_messages[-1],
+                        None if past_message_counts is None else past_message_counts[-1],
+                        max_tokens - total_token_count - sum(group_token_counts),
+                        truncate_newest_message,
+                        fallback_to_default,
+                    )
+                    past_messages = [*past_messages[:-1], newest_message]
+                    if past_message_counts is not None:
+                        past_message_counts = [*past_message_counts[:-1], newest_token_count]
 
-    if new_user_content:
-        message_builder.insert_message("user", new_user_content, index=append_index)
+        if reserve_tokens is not None:
+            total_token_count += reserve_tokens(max_tokens - total_token_count)
 
-    total_token_count = count_tokens_for_system_and_tools(
-        model, message_builder.system_message, tools, tool_choice, default_to_cl100k=fallback_to_default
-    )
-    for existing_message in message_builder.messages:
-        total_token_count += count_tokens_for_message(model, existing_message, default_to_cl100k=fallback_to_default)
+        with instrumentation.phase("truncate_history"):
+            if past_message_counts is not None:
+                kept_token_counts = _keep_newest_messages(
+                    message_builder, past_messages, past_message_counts, max_tokens - total_token_count
+                )
+            else:
+                kept_token_counts = _count_and_keep_newest_messages(
+                    message_builder,
+                    model,
+                    past_messages,
+                    max_tokens - total_token_count,
+                    fallback_to_default=fallback_to_default,
+                    cache=cache,
+                    use_estimates=use_estimates,
+                    newest_token_count=newest_token_count,
+                )
 
-    newest_to_oldest = list(reversed(past_messages))
-    for message in newest_to_oldest:
-        potential_message_count = count_tokens_for_message(model, message, default_to_cl100k=fallback_to_default)
-        if (total_token_count + potential_message_count) > max_tokens:
+        kept_count = len(message_builder.past_messages)
+        if kept_count < len(past_messages):
             logging.info("Reached max tokens of %d, history will be truncated", max_tokens)
+        if stats is not None:
+            stats.messages_kept = kept_count
+            stats.messages_dropped = len(past_messages) - kept_count
+
+    few_shot_count = len(message_builder.few_shots)
+    message_token_counts = [
+        system_token_count,
+        *required_token_counts[:few_shot_count],
+        *kept_token_counts,
+        *required_token_counts[few_shot_count:],
+    ]
+    return message_builder, message_token_counts, tools_token_count
+
+
+@dataclass(frozen=True)
+class SourcePack:
+    """
+    The messages and retrieved sources packed by `pack_sources`.
+    Attributes:
+        messages (list[ChatCompletionMessageParam]): The messages, the same as `build_messages`
+            except that the history is truncated to leave room for the sources.
+        sources (list[str]): The best-ranked sources that fit, in rank order. The last one may be truncated.
+        source_token_counts (list[int]): The number of tokens in each of the packed sources.
+        truncated (bool): Whether the last packed source was truncated to fit.
+    """
+
+    messages: list[ChatCompletionMessageParam]
+    sources: list[str]
+    source_token_counts: list[int]
+    truncated: bool
+
+    @property
+    def sources_token_count(self) -> int:
+        """The total number of tokens in the packed sources."""
+        return sum(self.source_token_counts)
+
+
+def _pack_ranked_sources(
+    encoding: tiktoken.Encoding, sources: Sequence[str], budget: int, truncate_last_source: bool, num_threads: int
+) -> SourcePack:
+    """
+    Pack the best-ranked sources that fit within the budget, truncating the first one that doesn't fit.
+    Only the sources that could fit by their lower bounds are encoded, in one batch.
+    Returns a pack without messages, which are added once the history is truncated.
+    """
+    candidates: list[str] = []
+    lower_bound = 0
+    for source in sources:
+        if lower_bound >= budget:
             break
+        candidates.append(source)
+        lower_bound += estimate_text_lower_bound(encoding, source)
+    if instrumentation.tracer is not None and candidates:
+        instrumentation.record_encode(*candidates)
+    candidate_tokens = encoding.encode_batch(candidates, num_threads=num_threads) if candidates else []
 
-        if message["role"] is None or message["content"] is None:
-            raise ValueError("Few-shot messages must have both role and content")
-        message_builder.insert_message(message["role"], message["content"], index=append_index)  # type: ignore[arg-type]
-        total_token_count += potential_message_count
-    return message_builder.all_messages
+    packed_sources: list[str] = []
+    source_token_counts: list[int] = []
+    truncated = False
+    for source, tokens in zip(candidates, candidate_tokens):
+        if len(tokens) > budget:
+            if truncate_last_source and budget > 0:
+                source, token_count = _truncate_tokens(encoding, source, tokens, budget, "head")
+                if source:
+                    packed_sources.append(source)
+                    source_token_counts.append(token_count)
+                    truncated = True
+            break
+        packed_sources.append(source)
+        source_token_counts.append(len(tokens))
+        budget -= len(tokens)
+    return SourcePack(messages=[], sources=packed_sources, source_token_counts=source_token_counts, truncated=truncated)
+
+
+def pack_sources(
+    model: str,
+    system_prompt: str,
+    *,
+    sources: Sequence[str],
+    sources_share: float = 0.6,
+    truncate_last_source: bool = True,
+    tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+    tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+    new_user_content: str | list[ChatCompletionContentPartParam] | None = None,
+    past_messages: list[ChatCompletionMessageParam] = [],
+    few_shots: list[ChatCompletionMessageParam] = [],
+    max_tokens: int | None = None,
+    fallback_to_default: bool = False,
+    cache: CacheBackend[int] | None = None,
+    past_message_counts: Sequence[int] | None = None,
+    use_estimates: bool = False,
+    truncate_newest_message: Literal["head", "tail", "middle"] | None = None,
+    num_threads: int = 8,
+) -> SourcePack:
+    """
+    Build a list of messages like `build_messages`, and pack the best-ranked retrieved sources that fit alongside them,
+    like for retrieval-augmented generation. The sources get up to `sources_share` of the tokens left after
+    the system prompt, tools, few-shots and new user message, and the history gets the rest,
+    including whatever the sources didn't use. Everything is counted once, and the sources are encoded in one batch.
+    The sources are counted as plain text, so leave room for any separators or labels added when inserting them.
+    Args:
+        model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+        system_prompt (str): The initial system prompt message.
+        sources (list[str]): The texts of the retrieved sources, from best to worst ranked.
+        sources_share (float): The fraction of the remaining tokens that the sources can use, from 0 to 1.
+        truncate_last_source (bool): Whether to truncate the first source that doesn't fit to the tokens left for it,
+            instead of leaving it out.
+        tools (list[ChatCompletionToolParam] | ToolSet): A list of tools to include in the conversation,
+            or a ToolSet that memoizes their token count across calls.
+        tool_choice (ChatCompletionToolChoiceOptionParam): The tool to use in the conversation.
+        new_user_content (str | List[ChatCompletionContentPartParam]): Content of new user message to append.
+        past_messages (list[ChatCompletionMessageParam]): The list of past messages in the conversation.
+        few_shots (list[ChatCompletionMessageParam]): A few-shot list of messages to insert after the system prompt.
+        max_tokens (int): The maximum number of tokens allowed for the conversation, including the sources.
+        fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, shared across calls.
+        past_message_counts (list[int]): The token count of each past message, if already known.
+        use_estimates (bool): Whether to use the bounds from `estimate_tokens` to skip encoding past messages.
+        truncate_newest_message (str): If given, the part of the newest message's text to keep when it doesn't fit.
+        num_threads (int): The number of threads to encode the sources with.
+    Returns:
+        SourcePack: The messages with the truncated history, and the packed sources with their token counts.
+    """
+    if not 0 <= sources_share <= 1:
+        raise ValueError("sources_share must be between 0 and 1")
+    encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
+    packed = SourcePack(messages=[], sources=[], source_token_counts=[], truncated=False)
+
+    def reserve_tokens(remaining_tokens: int) -> int:
+        nonlocal packed
+        with instrumentation.phase("pack_sources"):
+            budget = int(max(remaining_tokens, 0) * sources_share)
+            packed = _pack_ranked_sources(encoding, sources, budget, truncate_last_source, num_threads)
+        return packed.sources_token_count
+
+    message_builder, _, _ = _build_messages(
+        model,
+        system_prompt,
+        tools=tools,
+        tool_choice=tool_choice,
+        new_user_content=new_user_content,
+        past_messages=past_messages,
+        few_shots=few_shots,
+        max_tokens=max_tokens,
+        fallback_to_default=fallback_to_default,
+        cache=cache,
+        past_message_counts=past_message_counts,
+        use_estimates=use_estimates,
+        truncate_newest_message=truncate_newest_message,
+        reserve_tokens=reserve_tokens,
+    )
+    return SourcePack(
+        messages=message_builder.all_messages,
+        sources=packed.sources,
+        source_token_counts=packed.source_token_counts,
+        truncated=packed.truncated,
+    )
+
+
+# The keyword arguments of build_messages that can be given for each conversation in build_messages_many
+CONVERSATION_KEYS = {
+    "system_prompt",
+    "tools",
+    "tool_choice",
+    "new_user_content",
+    "past_messages",
+    "few_shots",
+    "max_tokens",
+}
+
+
+def build_messages_many(
+    model: str,
+    conversations: Iterable[Mapping[str, Any]],
+    *,
+    max_tokens: int | None = None,
+    fallback_to_default: bool = False,
+    cache: CacheBackend[int] | None = None,
+    num_threads: int = 8,
+) -> list[list[ChatCompletionMessageParam]]:
+    """
+    Build the lists of messages for many chat conversations at once, like for batch inference or evaluation.
+    The texts of all the conversations are encoded together in one batch over a thread pool,
+    and then each conversation is truncated from the precomputed counts.
+    Args:
+        model (str): The model name to use for token calculation, like gpt-3.5-turbo.
+        conversations (list[Mapping]): The conversations, each a mapping of the keyword arguments of `build_messages`:
+            system_prompt (required), tools, tool_choice, new_user_content, past_messages, few_shots and max_tokens.
+        max_tokens (int): The maximum number of tokens allowed for conversations that don't specify their own,
+            or whose max_tokens is None. Defaults to the model's token limit.
+        fallback_to_default (bool): Whether to fallback to default model if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts.
+        num_threads (int): The number of threads to encode the batch with.
+    Returns:
+        list[list[ChatCompletionMessageParam]]: The messages for each conversation, the same as `build_messages`.
+    """
+    if max_tokens is None:
+        max_tokens = get_token_limit(model, default_to_minimum=fallback_to_default)
+    encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
+
+    with instrumentation.operation("build_messages_many") as stats:
+        # Gather the messages of every conversation into one batch: system message, required messages, past messages
+        batch: list[ChatCompletionMessageParam] = []
+        builders: list[tuple[Mapping[str, Any], _MessageBuilder, int]] = []
+        with instrumentation.phase("normalize"):
+            for conversation in conversations:
+                if unknown_keys := conversation.keys() - CONVERSATION_KEYS:
+                    raise ValueError(f"Unsupported conversation keys: {', '.join(sorted(unknown_keys))}")
+                message_builder = _start_message_builder(
+                    conversation["system_prompt"],
+                    conversation.get("few_shots", []),
+                    conversation.get("new_user_content"),
+                )
+                builders.append((conversation, message_builder, len(batch)))
+                batch.append(message_builder.system_message)
+                batch.extend(message_builder.required_messages)
+                batch.extend(conversation.get("past_messages", []))
+
+        with instrumentation.phase("count"):
+            counts = count_tokens_for_messages(
+                model, batch, default_to_cl100k=fallback_to_default, cache=cache, num_threads=num_threads
+            )
+
+        all_messages = []
+        with instrumentation.phase("truncate_history"):
+            for conversation, message_builder, batch_start in builders:
+                past_start = batch_start + 1 + len(message_builder.required_messages)
+                past_messages = conversation.get("past_messages", [])
+                total_token_count = sum(counts[batch_start:past_start]) + count_tokens_for_tools(
+                    encoding, conversation.get("tools"), conversation.get("tool_choice"), has_system_message=True
+                )
+                # A conversation's max_tokens of None falls back to the shared one, like build_messages' default
+                conversation_max_tokens = conversation.get("max_tokens")
+                if conversation_max_tokens is None:
+                    conversation_max_tokens = max_tokens
+                remaining_tokens = conversation_max_tokens - total_token_count
+                past_message_counts = counts[past_start : past_start + len(past_messages)]
+                _keep_newest_messages(message_builder, past_messages, past_message_counts, remaining_tokens)
+                if stats is not None:
+                    stats.messages_kept += len(message_builder.past_messages)
+                    stats.messages_dropped += len(past_messages) - len(message_builder.past_messages)
+                all_messages.append(message_builder.all_messages)
+        return all_messages
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import logging
-from typing import Any
-
-import tiktoken
-from openai.types.chat import (
-    ChatCompletionMessageParam,
-    ChatCompletionSystemMessageParam,
-    ChatCompletionToolChoiceOptionParam,
-    ChatCompletionToolParam,
-)
+from collections.abc import Iterable, Sequence
+from typing import TYPE_CHECKING, Any, Literal
 
+from . import instrumentation
+from .bpe_helper import load_local_encoding
+from .cache import CacheBackend, message_cache_key
+from .encoding_helper import count_tokens_bounded, count_tokens_parallel, split_for_threads
 from .function_format import format_function_definitions
-from .images_helper import count_tokens_for_image
+from .images_helper import count_tokens_for_image, image_cost_multiplier
+from .tools_helper import ToolSet
+
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import (
+        ChatCompletionMessageParam,
+        ChatCompletionSystemMessageParam,
+        ChatCompletionToolChoiceOptionParam,
+        ChatCompletionToolParam,
+    )
 
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
@@ -74,15 +81,11 @@ def get_token_limit(model: str, default_to_minimum=False) -> int:
     return MODELS_2_TOKEN_LIMITS[model]
 
 
-def encoding_for_model(model: str, default_to_cl100k=False) -> tiktoken.Encoding:
-    """
-    Get the encoding for a given GPT model name (OpenAI.com or Azure OpenAI supported).
-    Args:
-        model (str): The name of the model to get the encoding for.
-        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
-    Returns:
-        tiktoken.Encoding: The encoding for the model.
-    """
+# Resolved encodings by (model, default_to_cl100k), along with whether the lookup fell back to CL100k
+_ENCODINGS: dict[tuple[str, bool], tuple[tiktoken.Encoding, bool]] = {}
+
+
+def _load_encoding(model: str, default_to_cl100k: bool) -> tuple[tiktoken.Encoding, bool]:
     if (
         model == ""
         or model is None
@@ -90,45 +93,92 @@ def encoding_for_model(model: str, default_to_cl100k=False) -> tiktoken.Encoding
     ):
         raise ValueError("Expected valid OpenAI GPT model name")
     model = AOAI_2_OAI.get(model, model)
+    # tiktoken is imported when the first encoding is loaded, so that importing this package stays fast
+    import tiktoken
+
     try:
-        return tiktoken.encoding_for_model(model)
+        encoding_name, is_fallback = tiktoken.encoding_name_for_model(model), False
     except KeyError:
         if default_to_cl100k:
-            logger.warning("Model %s not found, defaulting to CL100k encoding", model)
-            return tiktoken.get_encoding("cl100k_base")
+            encoding_name, is_fallback = "cl100k_base", True
         else:
             raise
+    return load_local_encoding(encoding_name) or tiktoken.get_encoding(encoding_name), is_fallback
 
 
-def count_tokens_for_message(model: str, message: ChatCompletionMessageParam, default_to_cl100k=False) -> int:
+def encoding_for_model(model: str, default_to_cl100k=False) -> tiktoken.Encoding:
     """
-    Calculate the number of tokens required to encode a message. Based off cookbook:
-    https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-
+    Get the encoding for a given GPT model name (OpenAI.com or Azure OpenAI supported).
+    Encodings are memoized per model, so only the first call for each model resolves and loads it.
     Args:
-        model (str): The name of the model to use for encoding.
-        message (Mapping): The message to encode, in a dictionary-like object.
+        model (str): The name of the model to get the encoding for.
         default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
     Returns:
-        int: The total number of tokens required to encode the message.
+        tiktoken.Encoding: The encoding for the model.
+    """
+    resolved = _ENCODINGS.get((model, default_to_cl100k))
+    if resolved is None:
+        resolved = _ENCODINGS[(model, default_to_cl100k)] = _load_encoding(model, default_to_cl100k)
+    encoding, is_fallback = resolved
+    if is_fallback:
+        logger.warning("Model %s not found, defaulting to CL100k encoding", AOAI_2_OAI.get(model, model))
+    return encoding
 
-    >> model = 'gpt-3.5-turbo'
-    >> message = {'role': 'user', 'content': 'Hello, how are you?'}
-    >> count_tokens_for_message(model, message)
-    13
+
+def preload(models: Iterable[str] | None = None, default_to_cl100k=False) -> dict[str, tiktoken.Encoding]:
     """
-    # Warn if using a reasoning model
+    Load the encodings for the given models ahead of time, so that the first request doesn't pay for
+    downloading and parsing the BPE files. Call it at process start, and in pre-forking servers like
+    gunicorn (with --preload) call it before the workers are forked, so they all share the loaded encodings.
+    Args:
+        models (list[str]): The names of the models to load encodings for. Defaults to all known models.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if a model is not found.
+    Returns:
+        dict[str, tiktoken.Encoding]: The encoding for each model.
+    """
+    if models is None:
+        models = MODELS_2_TOKEN_LIMITS.keys()
+    return {model: encoding_for_model(model, default_to_cl100k) for model in models}
+
+
+def warmup(models: Iterable[str] | None = None, default_to_cl100k=False) -> None:
+    """
+    Preload the encodings for the given models and encode a short text with each of them,
+    so that any lazy initialization happens before the first real request.
+    Args:
+        models (list[str]): The names of the models to warm up. Defaults to all known models.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if a model is not found.
+    """
+    encodings = {encoding.name: encoding for encoding in preload(models, default_to_cl100k).values()}
+    for encoding in encodings.values():
+        encoding.encode("Hello, world!")
+
+
+def _cache_namespace(model: str, encoding: tiktoken.Encoding) -> str:
+    # Text counts only depend on the encoding, but image counts also depend on the model's tile cost
+    multiplier = image_cost_multiplier(model)
+    if multiplier == 1:
+        return encoding.name
+    return f"{encoding.name}*{multiplier}"
+
+
+def _warn_if_reasoning_model(model: str):
     if model in REASONING_MODELS:
         logger.warning(
             "Model %s is a reasoning model. Token usage estimates may not reflect actual costs due to reasoning tokens.",
             model,
         )
 
-    encoding = encoding_for_model(model, default_to_cl100k)
 
+def _split_message(model: str, message: ChatCompletionMessageParam) -> tuple[list[str], int]:
+    """
+    Split a message into the texts that need to be encoded and the number of tokens that don't,
+    like the per-message overhead and images.
+    """
     # Assumes we're using a recent model
     tokens_per_message = 3
 
+    texts: list[str] = []
     num_tokens = tokens_per_message
     for key, value in message.items():
         if isinstance(value, list):
@@ -136,27 +186,249 @@ def count_tokens_for_message(model: str, message: ChatCompletionMessageParam, de
             for item in value:
                 # Note: item[type] does not seem to be counted in the token count
                 if item["type"] == "text":
-                    num_tokens += len(encoding.encode(item["text"]))
+                    texts.append(item["text"])
                 elif item["type"] == "image_url":
-                    num_tokens += count_tokens_for_image(
-                        item["image_url"]["url"], item["image_url"].get("detail", "auto"), model
-                    )
+                    with instrumentation.phase("count_tokens_for_image"):
+                        num_tokens += count_tokens_for_image(
+                            item["image_url"]["url"], item["image_url"].get("detail", "auto"), model
+                        )
         elif isinstance(value, str):
-            num_tokens += len(encoding.encode(value))
+            texts.append(value)
         else:
             raise ValueError(f"Could not encode unsupported message value type: {type(value)}")
         if key == "name":
             num_tokens += 1
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return texts, num_tokens
+
+
+def count_tokens_for_message(
+    model: str,
+    message: ChatCompletionMessageParam,
+    default_to_cl100k=False,
+    *,
+    cache: CacheBackend[int] | None = None,
+    limit: int | None = None,
+    parallel_min_chars: int | None = None,
+    num_threads: int = 8,
+) -> int:
+    """
+    Calculate the number of tokens required to encode a message. Based off cookbook:
+    https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+    Args:
+        model (str): The name of the model to use for encoding.
+        message (Mapping): The message to encode, in a dictionary-like object.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, keyed by encoding and message content.
+        limit (int): If given, stop encoding as soon as the count exceeds the limit, like when the message
+            only needs to be checked against a budget. Counts over the limit are then partial, and not cached.
+        parallel_min_chars (int): If given, texts of at least this many characters, like large tool results,
+            are split at safe boundaries and encoded on a thread pool. The count is the same.
+        num_threads (int): The number of threads to encode large texts with.
+    Returns:
+        int: The total number of tokens required to encode the message, or a count over the limit.
+
+    >> model = 'gpt-3.5-turbo'
+    >> message = {'role': 'user', 'content': 'Hello, how are you?'}
+    >> count_tokens_for_message(model, message)
+    13
+    """
+    # Warn if using a reasoning model
+    _warn_if_reasoning_model(model)
+
+    encoding = encoding_for_model(model, default_to_cl100k)
+    return _count_message(
+        model,
+        encoding,
+        message,
+        cache=cache,
+        limit=limit,
+        parallel_min_chars=parallel_min_chars,
+        num_threads=num_threads,
+    )
+
+
+def _count_message(
+    model: str,
+    encoding: tiktoken.Encoding,
+    message: ChatCompletionMessageParam,
+    *,
+    cache: CacheBackend[int] | None = None,
+    limit: int | None = None,
+    parallel_min_chars: int | None = None,
+    num_threads: int = 8,
+) -> int:
+    """
+    Count the tokens in a message with an already resolved encoding, as in `count_tokens_for_message`,
+    without logging the model's warnings again.
+    """
+    if cache is not None:
+        cache_key, cache_size = message_cache_key(_cache_namespace(model, encoding), message)
+        cached_tokens = cache.get(cache_key)
+        if instrumentation.tracer is not None:
+            instrumentation.record_cache_lookup(cached_tokens is not None)
+        if cached_tokens is not None:
+            return cached_tokens
+
+    texts, num_tokens = _split_message(model, message)
+    for text in texts:
+        remaining = None if limit is None else limit - num_tokens
+        if parallel_min_chars is not None and len(text) >= parallel_min_chars:
+            num_tokens += count_tokens_parallel(encoding, text, num_threads, remaining)
+        elif remaining is None:
+            if instrumentation.tracer is not None:
+                instrumentation.record_encode(text)
+            num_tokens += len(encoding.encode(text))
+        else:
+            num_tokens += count_tokens_bounded(encoding, text, remaining)
+        if limit is not None and num_tokens > limit:
+            # A partial count, which is only known to be over the limit
+            return num_tokens
+    if cache is not None:
+        cache.put(cache_key, num_tokens, cache_size)
     return num_tokens
 
 
+def _decode_kept_tokens(encoding: tiktoken.Encoding, tokens: list[int], kept_count: int, keep: str) -> str:
+    # Slicing can split a multi-byte character, so partial characters at the cut are dropped
+    if keep == "head":
+        kept_bytes = encoding.decode_bytes(tokens[:kept_count])
+    elif keep == "tail":
+        kept_bytes = encoding.decode_bytes(tokens[len(tokens) - kept_count :])
+    else:
+        tail_count = kept_count // 2
+        kept_bytes = encoding.decode_bytes(tokens[: kept_count - tail_count]).decode("utf-8", errors="ignore").encode()
+        kept_bytes += encoding.decode_bytes(tokens[len(tokens) - tail_count :])
+    return kept_bytes.decode("utf-8", errors="ignore")
+
+
+def truncate_text_to_tokens(
+    text: str,
+    max_tokens: int,
+    model: str,
+    keep: Literal["head", "tail", "middle"] = "head",
+    default_to_cl100k=False,
+) -> str:
+    """
+    Truncate a text to at most a number of tokens, by encoding it once and decoding a slice of its tokens.
+    Args:
+        text (str): The text to truncate.
+        max_tokens (int): The maximum number of tokens to keep.
+        model (str): The name of the model to use for encoding.
+        keep (str): Which part of the text to keep: "head" for the beginning, "tail" for the end,
+            or "middle" to drop the middle and keep both the beginning and the end.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+    Returns:
+        str: The text if it already fits, otherwise the kept part of it, which encodes to at most `max_tokens` tokens.
+    """
+    if keep not in ("head", "tail", "middle"):
+        raise ValueError(f"Unsupported keep value: {keep}")
+    encoding = encoding_for_model(model, default_to_cl100k)
+    truncated_text, _ = _truncate_tokens(encoding, text, encoding.encode(text), max_tokens, keep)
+    return truncated_text
+
+
+def _truncate_tokens(
+    encoding: tiktoken.Encoding, text: str, tokens: list[int], max_tokens: int, keep: str
+) -> tuple[str, int]:
+    """
+    Truncate a text that is already encoded to at most max_tokens tokens.
+    Returns the text if it fits, otherwise the kept part of it, and its number of tokens.
+    """
+    if len(tokens) <= max_tokens:
+        return text, len(tokens)
+    # Decoded text can occasionally encode to more tokens than were kept, if tokens merge differently at the cut
+    for kept_count in range(max_tokens, 0, -1):
+        truncated_text = _decode_kept_tokens(encoding, tokens, kept_count, keep)
+        truncated_token_count = len(encoding.encode(truncated_text))
+        if truncated_token_count <= max_tokens:
+            return truncated_text, truncated_token_count
+    return "", 0
+
+
+def count_tokens_for_messages(
+    model: str,
+    messages: Sequence[ChatCompletionMessageParam],
+    default_to_cl100k=False,
+    *,
+    cache: CacheBackend[int] | None = None,
+    num_threads: int = 8,
+    parallel_min_chars: int | None = None,
+) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of a list of messages,
+    encoding all of their texts in one batch. The counts are the same as `count_tokens_for_message`.
+
+    Args:
+        model (str): The name of the model to use for encoding.
+        messages (list[Mapping]): The messages to encode, in dictionary-like objects.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, keyed by encoding and message content.
+        num_threads (int): The number of threads to encode the batch with.
+        parallel_min_chars (int): If given, texts of at least this many characters are split at safe boundaries
+            into several texts of the batch, so that one large text is also encoded on several threads.
+    Returns:
+        list[int]: The number of tokens required to encode each message.
+    """
+    _warn_if_reasoning_model(model)
+
+    encoding = encoding_for_model(model, default_to_cl100k)
+    namespace = _cache_namespace(model, encoding)
+
+    counts: list[int] = [0] * len(messages)
+    # For each message that still needs encoding: its index, cache key, and the range of its texts in the batch
+    pending: list[tuple[int, tuple[str, int] | None, int, int]] = []
+    # With a cache, messages repeated within the batch are only encoded once: the index of each repeat and its original
+    pending_indexes: dict[str, int] = {}
+    repeats: list[tuple[int, int]] = []
+    texts: list[str] = []
+    for index, message in enumerate(messages):
+        cache_key = None
+        if cache is not None:
+            cache_key = message_cache_key(namespace, message)
+            if cache_key[0] in pending_indexes:
+                repeats.append((index, pending_indexes[cache_key[0]]))
+                continue
+            cached_tokens = cache.get(cache_key[0])
+            if instrumentation.tracer is not None:
+                instrumentation.record_cache_lookup(cached_tokens is not None)
+            if cached_tokens is not None:
+                counts[index] = cached_tokens
+                continue
+            pending_indexes[cache_key[0]] = index
+        message_texts, counts[index] = _split_message(model, message)
+        if parallel_min_chars is not None:
+            message_texts = [
+                chunk
+                for text in message_texts
+                for chunk in (
+                    split_for_threads(encoding, text, num_threads) if len(text) >= parallel_min_chars else [text]
+                )
+            ]
+        pending.append((index, cache_key, len(texts), len(texts) + len(message_texts)))
+        texts.extend(message_texts)
+
+    if instrumentation.tracer is not None and texts:
+        instrumentation.record_encode(*texts)
+    token_lengths = [len(tokens) for tokens in encoding.encode_batch(texts, num_threads=num_threads)] if texts else []
+    for index, cache_key, texts_start, texts_end in pending:
+        counts[index] += sum(token_lengths[texts_start:texts_end])
+        if cache is not None and cache_key is not None:
+            cache.put(cache_key[0], counts[index], cache_key[1])
+    for index, original_index in repeats:
+        counts[index] = counts[original_index]
+    return counts
+
+
 def count_tokens_for_system_and_tools(
     model: str,
     system_message: ChatCompletionSystemMessageParam | None = None,
-    tools: list[ChatCompletionToolParam] | None = None,
+    tools: list[ChatCompletionToolParam] | ToolSet | None = None,
     tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
     default_to_cl100k: bool = False,
+    *,
+    cache: CacheBackend[int] | None = None,
 ) -> int:
     """
     Calculate the number of tokens required to encode a system message and tools.
@@ -165,10 +437,11 @@ def count_tokens_for_system_and_tools(
 
     Args:
         model (str): The name of the model to use for encoding.
-        tools (list[dict[str, dict]]): The tools to encode.
+        tools (list[dict[str, dict]] | ToolSet): The tools to encode, or a ToolSet with their memoized count.
         tool_choice (str | dict): The tool choice to encode.
         system_message (dict): The system message to encode.
         default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        cache (CacheBackend[int]): An optional cache of message token counts, used for the system message.
     Returns:
         int: The total number of tokens required to encode the system message and tools.
     """
@@ -176,12 +449,41 @@ def count_tokens_for_system_and_tools(
 
     tokens = 0
     if system_message:
-        tokens += count_tokens_for_message(model, system_message, default_to_cl100k)
+        tokens += count_tokens_for_message(model, system_message, default_to_cl100k, cache=cache)
+    return tokens + count_tokens_for_tools(encoding, tools, tool_choice, has_system_message=bool(system_message))
+
+
+def count_tokens_for_tools(
+    encoding: tiktoken.Encoding,
+    tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+    tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+    has_system_message: bool = False,
+) -> int:
+    """
+    Calculate the number of tokens required to encode tools, on top of the system message.
+    See `count_tokens_for_system_and_tools`.
+
+    Args:
+        encoding (tiktoken.Encoding): The encoding to use.
+        tools (list[dict[str, dict]] | ToolSet): The tools to encode, or a ToolSet with their memoized count.
+        tool_choice (str | dict): The tool choice to encode.
+        has_system_message (bool): Whether the tools are sent along with a system message.
+    Returns:
+        int: The number of tokens required to encode the tools.
+    """
+    tokens = 0
     if tools:
-        tokens += len(encoding.encode(format_function_definitions(tools)))
+        if isinstance(tools, ToolSet):
+            tokens += tools.token_count(encoding)
+        else:
+            with instrumentation.phase("format_tools"):
+                formatted_tools = format_function_definitions(tools)
+            if instrumentation.tracer is not None:
+                instrumentation.record_encode(formatted_tools)
+            tokens += len(encoding.encode(formatted_tools))
         tokens += 9  # Additional tokens for function definition of tools
     # If there's a system message and tools are present, subtract four tokens
-    if tools and system_message:
+    if tools and has_system_message:
         tokens -= 4
     # If tool_choice is 'none', add one token.
     # If it's an object, add 4 + the number of tokens in the function name.
@@ -195,5 +497,7 @@ def count_tokens_for_system_and_tools(
         fn_name = fn.get("name") if isinstance(fn, dict) else None
         if isinstance(fn_name, str):
             tokens += 7
+            if instrumentation.tracer is not None:
+                instrumentation.record_encode(fn_name)
             tokens += len(encoding.encode(fn_name))
     return tokens
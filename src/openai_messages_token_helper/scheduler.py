@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Mapping, Sequence
+from dataclasses import dataclass
+from typing import Any, Callable
+
+# The longest time to sleep at once while waiting for capacity, so that capacity freed by
+# reconciling or releasing other reservations is noticed soon
+MAX_WAIT_SECONDS = 1.0
+
+
+@dataclass(frozen=True)
+class Deployment:
+    """
+    A deployment of a model and its rate limits, like an Azure OpenAI deployment with a tokens-per-minute quota.
+    Attributes:
+        name (str): The name of the deployment.
+        tokens_per_minute (int): The number of tokens the deployment allows per minute.
+        requests_per_minute (int | None): The number of requests the deployment allows per minute, if limited.
+    """
+
+    name: str
+    tokens_per_minute: int
+    requests_per_minute: int | None = None
+
+
+@dataclass(frozen=True)
+class Reservation:
+    """
+    Tokens reserved against a deployment for one request, to reconcile with its usage when the response comes back.
+    Attributes:
+        deployment (str): The name of the deployment to send the request to.
+        prompt_tokens (int): The number of prompt tokens that were reserved.
+        completion_tokens (int): The number of completion tokens that were reserved.
+        id (int): A number that identifies the reservation within its scheduler.
+    """
+
+    deployment: str
+    prompt_tokens: int
+    completion_tokens: int
+    id: int
+
+    @property
+    def tokens(self) -> int:
+        """The total number of tokens that were reserved."""
+        return self.prompt_tokens + self.completion_tokens
+
+
+class _Window:
+    """The amounts admitted within the last window of time, which must stay within a limit."""
+
+    def __init__(self, limit: float, seconds: float):
+        self.limit = limit
+        self.seconds = seconds
+        # The time and amount of each admission, oldest first. Reconciling changes the amounts.
+        self.entries: deque[list[float]] = deque()
+        self.total = 0.0
+
+    def expire(self, now: float) -> None:
+        while self.entries and self.entries[0][0] <= now - self.seconds:
+            self.total -= self.entries.popleft()[1]
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Get how long to wait until the amount fits, as the oldest admissions leave the window."""
+        excess = self.total + amount - self.limit
+        if excess <= 0:
+            return 0.0
+        for admitted_at, admitted_amount in self.entries:
+            excess -= admitted_amount
+            if excess <= 0:
+                return admitted_at + self.seconds - now
+        return self.seconds
+
+    def add(self, amount: float, now: float) -> list[float]:
+        entry = [now, amount]
+        self.entries.append(entry)
+        self.total += amount
+        return entry
+
+    def adjust(self, entry: list[float], amount: float, now: float) -> None:
+        # Admissions that already left the window no longer count against it
+        self.expire(now)
+        if entry[0] > now - self.seconds:
+            self.total += amount - entry[1]
+            entry[1] = amount
+
+
+class _DeploymentState:
+    def __init__(self, deployment: Deployment, window_seconds: float):
+        self.deployment = deployment
+        self.tokens = _Window(deployment.tokens_per_minute * window_seconds / 60, window_seconds)
+        self.requests: _Window | None = None
+        if deployment.requests_per_minute is not None:
+            # A window too short for one request is lengthened to the time of one request, keeping the rate
+            request_window_seconds = max(window_seconds, 60 / deployment.requests_per_minute)
+            self.requests = _Window(
+                deployment.requests_per_minute * request_window_seconds / 60, request_window_seconds
+            )
+        self.cooldown_until = -math.inf
+
+    def expire(self, now: float) -> None:
+        self.tokens.expire(now)
+        if self.requests is not None:
+            self.requests.expire(now)
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        wait = max(self.cooldown_until - now, self.tokens.wait_time(tokens, now))
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        return wait
+
+
+def _usage_tokens(usage: Any) -> int:
+    if isinstance(usage, Mapping):
+        return usage["total_tokens"]
+    return usage.total_tokens
+
+
+class TPMScheduler:
+    """
+    A scheduler that reserves the tokens of each request against the rate limits of several deployments before
+    it is sent, so that requests are spread across the deployments and wait for capacity instead of being
+    rejected with 429 errors. Each reservation is for the prompt tokens, as counted by `build_messages_with_report`
+    or `count_tokens_for_messages`, plus the maximum completion tokens sent with the request,
+    and is reconciled with the actual usage once the response comes back.
+    A request is admitted to a deployment when the tokens admitted to it within the last window, plus its own,
+    fit within the deployment's tokens per minute scaled to the window. Requests go to the deployment with
+    the most tokens left in its window. The scheduler is thread-safe, and takes clock and sleep functions
+    so that it can be tested without waiting.
+    """
+
+    def __init__(
+        self,
+        deployments: Sequence[Deployment],
+        *,
+        window_seconds: float = 60.0,
+        refund_unused: bool = True,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+        async_sleep: Callable[[float], Awaitable[Any]] | None = None,
+    ):
+        """
+        Args:
+            deployments (list[Deployment]): The deployments to spread requests across.
+            window_seconds (float): The length of the window that rate limits are enforced over.
+                A shorter window, like 10 seconds, also keeps bursts within the limits of services that enforce them
+                over shorter windows than a minute. The window of a request limit is lengthened to fit at least one request.
+            refund_unused (bool): Whether reconciling frees the reserved tokens that a request didn't use.
+                Turn it off for services that count the maximum completion tokens of a request against its limits,
+                like Azure OpenAI, so that only usage beyond the reservation is reconciled.
+            clock (Callable): A function that returns the current time in seconds, like `time.monotonic`.
+            sleep (Callable): A function that waits for a number of seconds, used by `acquire`.
+            async_sleep (Callable): A coroutine function that waits for a number of seconds, used by `async_acquire`.
+                Defaults to `asyncio.sleep`.
+        """
+        if not deployments:
+            raise ValueError("At least one deployment is required")
+        if len({deployment.name for deployment in deployments}) != len(deployments):
+            raise ValueError("Deployment names must be unique")
+        if window_seconds <= 0 or any(
+            deployment.tokens_per_minute <= 0
+            or (deployment.requests_per_minute is not None and deployment.requests_per_minute <= 0)
+            for deployment in deployments
+        ):
+            raise ValueError("Rate limits and window_seconds must be positive")
+        self.deployments = list(deployments)
+        self.window_seconds = window_seconds
+        self.refund_unused = refund_unused
+        self._clock = clock
+        self._sleep = sleep
+        self._async_sleep = async_sleep
+        self._states = {deployment.name: _DeploymentState(deployment, window_seconds) for deployment in deployments}
+        # The reservations that haven't been reconciled or released yet, by id,
+        # with their entries in the token and request windows
+        self._outstanding: dict[int, tuple[Reservation, list[float], list[float] | None]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def try_reserve(self, prompt_tokens: int, max_completion_tokens: int = 0) -> Reservation | None:
+        """
+        Reserve tokens for a request against the deployment with the most tokens left, without waiting.
+        Args:
+            prompt_tokens (int): The number of tokens in the prompt.
+            max_completion_tokens (int): The maximum number of tokens in the completion, as sent with the request.
+        Returns:
+            Reservation: The reservation, or None if no deployment has enough tokens left now.
+        """
+        reservation, _ = self._reserve_or_wait_time(prompt_tokens, max_completion_tokens)
+        return reservation
+
+    def acquire(self, prompt_tokens: int, max_completion_tokens: int = 0, timeout: float | None = None) -> Reservation:
+        """
+        Reserve tokens for a request, waiting until a deployment has enough tokens left.
+        Args:
+            prompt_tokens (int): The number of tokens in the prompt.
+            max_completion_tokens (int): The maximum number of tokens in the completion, as sent with the request.
+            timeout (float): The maximum number of seconds to wait, or None to wait as long as needed.
+        Returns:
+            Reservation: The reservation.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            reservation, wait = self._reserve_or_wait_time(prompt_tokens, max_completion_tokens)
+            if reservation is not None:
+                return reservation
+            self._sleep(self._next_wait(wait, deadline))
+
+    async def async_acquire(
+        self, prompt_tokens: int, max_completion_tokens: int = 0, timeout: float | None = None
+    ) -> Reservation:
+        """
+        Reserve tokens for a request, waiting without blocking the event loop until a deployment has enough tokens left.
+        Args:
+            prompt_tokens (int): The number of tokens in the prompt.
+            max_completion_tokens (int): The maximum number of tokens in the completion, as sent with the request.
+            timeout (float): The maximum number of seconds to wait, or None to wait as long as needed.
+        Returns:
+            Reservation: The reservation.
+        """
+        async_sleep = self._async_sleep
+        if async_sleep is None:
+            # asyncio is slow to import, and only needed once a coroutine is running
+            import asyncio
+
+            async_sleep = asyncio.sleep
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            reservation, wait = self._reserve_or_wait_time(prompt_tokens, max_completion_tokens)
+            if reservation is not None:
+                return reservation
+            await async_sleep(self._next_wait(wait, deadline))
+
+    def _next_wait(self, wait: float, deadline: float | None) -> float:
+        if deadline is not None:
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for deployment capacity")
+            wait = min(wait, remaining)
+        return min(wait, MAX_WAIT_SECONDS)
+
+    def _reserve_or_wait_time(self, prompt_tokens: int, max_completion_tokens: int) -> tuple[Reservation | None, float]:
+        """Reserve tokens against the deployment with the most left, or get how long to wait until one has enough."""
+        if prompt_tokens < 0 or max_completion_tokens < 0:
+            raise ValueError("Token counts must not be negative")
+        tokens = prompt_tokens + max_completion_tokens
+        with self._lock:
+            now = self._clock()
+            best: _DeploymentState | None = None
+            wait = math.inf
+            for state in self._states.values():
+                if tokens > state.tokens.limit:
+                    continue
+                state.expire(now)
+                state_wait = state.wait_time(tokens, now)
+                if state_wait <= 0 and (best is None or state.tokens.total < best.tokens.total):
+                    best = state
+                wait = min(wait, state_wait)
+            if wait == math.inf:
+                raise ValueError(f"A request of {tokens} tokens is over the rate limit of every deployment")
+            if best is None:
+                return None, wait
+            reservation = Reservation(best.deployment.name, prompt_tokens, max_completion_tokens, next(self._ids))
+            token_entry = best.tokens.add(tokens, now)
+            request_entry = best.requests.add(1, now) if best.requests is not None else None
+            self._outstanding[reservation.id] = (reservation, token_entry, request_entry)
+            return reservation, 0.0
+
+    def reconcile(self, reservation: Reservation, usage: Any) -> None:
+        """
+        Replace the reserved tokens with the tokens the request actually used, which frees the difference
+        for other requests if `refund_unused` is on, or takes more if the request used more than was reserved.
+        Args:
+            reservation (Reservation): The reservation of the request.
+            usage (CompletionUsage | Mapping): The `usage` of the response, with its `total_tokens`,
+                or None to keep the reserved tokens, like when a streamed response doesn't report usage.
+        """
+        used_tokens = reservation.tokens if usage is None else _usage_tokens(usage)
+        if not self.refund_unused:
+            used_tokens = max(used_tokens, reservation.tokens)
+        self._settle(reservation, used_tokens, used_requests=1)
+
+    def release(self, reservation: Reservation) -> None:
+        """
+        Free all the reserved tokens, like when the request failed before the deployment processed it.
+        Args:
+            reservation (Reservation): The reservation of the request.
+        """
+        self._settle(reservation, 0, used_requests=0)
+
+    def _settle(self, reservation: Reservation, used_tokens: int, used_requests: int) -> None:
+        with self._lock:
+            outstanding = self._outstanding.pop(reservation.id, None)
+            if outstanding is None or outstanding[0] != reservation:
+                raise ValueError("Reservation is not outstanding, since it was already reconciled or released")
+            _, token_entry, request_entry = outstanding
+            state = self._states[reservation.deployment]
+            now = self._clock()
+            state.tokens.adjust(token_entry, used_tokens, now)
+            if state.requests is not None and request_entry is not None:
+                state.requests.adjust(request_entry, used_requests, now)
+
+    def cooldown(self, deployment: str, seconds: float) -> None:
+        """
+        Stop sending requests to a deployment for a number of seconds, like after a 429 error with a retry-after.
+        Args:
+            deployment (str): The name of the deployment.
+            seconds (float): The number of seconds to wait before sending it more requests.
+        """
+        with self._lock:
+            state = self._states[deployment]
+            state.cooldown_until = max(state.cooldown_until, self._clock() + seconds)
+
+    def available_tokens(self) -> dict[str, float]:
+        """Get the number of tokens left now in each deployment's window, which is negative when overdrawn."""
+        with self._lock:
+            now = self._clock()
+            available = {}
+            for name, state in self._states.items():
+                state.expire(now)
+                available[name] = state.tokens.limit - state.tokens.total
+            return available
+
+    @property
+    def outstanding(self) -> list[Reservation]:
+        """The reservations that haven't been reconciled or released yet."""
+        with self._lock:
+            return [reservation for reservation, _, _ in self._outstanding.values()]
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from .encoding_helper import SAFE_BOUNDARY, find_stable_cut
+from .model_helper import encoding_for_model
+
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import ChatCompletionChunk
+
+# The number of characters after the last safe boundary to re-encode on each delta, before committing
+# all but the last few tokens of a text without boundaries, like a long run of base64
+MAX_PENDING_CHARS = 256
+# The number of tokens at the end of a text that are kept pending, since more text could still merge into them
+UNSTABLE_TAIL_TOKENS = 16
+
+
+class _StreamedText:
+    """
+    The token count of a text that arrives in pieces. The text up to its last safe boundary is encoded once
+    and only its count is kept, so each delta only re-encodes the short tail after that boundary.
+    When the tail grows past MAX_PENDING_CHARS without a boundary, all but its last few tokens are committed,
+    so that counting stays linear in the length of any text.
+    """
+
+    def __init__(self, encoding: tiktoken.Encoding):
+        self.encoding = encoding
+        self.committed_token_count = 0
+        self.pending = ""
+        self.pending_token_count = 0
+
+    @property
+    def token_count(self) -> int:
+        return self.committed_token_count + self.pending_token_count
+
+    def add(self, delta: str):
+        if not delta:
+            return
+        # A boundary depends on the character before it and the two after it,
+        # so new boundaries can only be found near the end of the old text
+        search_start = max(len(self.pending) - 2, 1)
+        self.pending += delta
+        last_boundary = None
+        for last_boundary in SAFE_BOUNDARY.finditer(self.pending, search_start):
+            pass
+        if last_boundary is not None and last_boundary.start() > 0:
+            self.committed_token_count += len(self.encoding.encode(self.pending[: last_boundary.start()]))
+            self.pending = self.pending[last_boundary.start() :]
+        if len(self.pending) > MAX_PENDING_CHARS:
+            cut_chars, cut_tokens = find_stable_cut(self.encoding, self.pending, UNSTABLE_TAIL_TOKENS)
+            self.committed_token_count += cut_tokens
+            self.pending = self.pending[cut_chars:]
+        self.pending_token_count = len(self.encoding.encode(self.pending))
+
+
+class StreamingTokenCounter:
+    """
+    An exact running count of the tokens generated so far in a streamed response,
+    like for enforcing output quotas or cutting off runaway responses.
+    The count covers the text of the content and the arguments of each tool call, which are counted
+    separately since they are separate texts. Only the tail of each text after its last safe boundary
+    is encoded again on each delta, and that tail is capped for texts without boundaries,
+    so counting is linear in the length of the stream.
+    Attributes:
+        model (str): The model name to use for token calculation, like gpt-4o.
+    """
+
+    def __init__(self, model: str, default_to_cl100k=False):
+        """
+        Args:
+            model (str): The model name to use for token calculation, like gpt-4o.
+            default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        """
+        self.model = model
+        self._encoding = encoding_for_model(model, default_to_cl100k)
+        self._content = _StreamedText(self._encoding)
+        self._tool_call_arguments: dict[int, _StreamedText] = {}
+
+    @property
+    def token_count(self) -> int:
+        """The number of tokens in the content and tool call arguments streamed so far."""
+        return self._content.token_count + sum(text.token_count for text in self._tool_call_arguments.values())
+
+    def add_content(self, delta: str) -> int:
+        """
+        Add a fragment of the streamed content.
+        Args:
+            delta (str): The content of a streamed delta.
+        Returns:
+            int: The number of tokens streamed so far.
+        """
+        self._content.add(delta)
+        return self.token_count
+
+    def add_tool_call_arguments(self, index: int, delta: str) -> int:
+        """
+        Add a fragment of the arguments of a streamed tool call.
+        Args:
+            index (int): The index of the tool call in the response.
+            delta (str): The fragment of the tool call's arguments.
+        Returns:
+            int: The number of tokens streamed so far.
+        """
+        if index not in self._tool_call_arguments:
+            self._tool_call_arguments[index] = _StreamedText(self._encoding)
+        self._tool_call_arguments[index].add(delta)
+        return self.token_count
+
+    def add_chunk(self, chunk: ChatCompletionChunk) -> int:
+        """
+        Add the content and tool call arguments of a chunk from a streamed chat completion.
+        Only the first choice is counted.
+        Args:
+            chunk (ChatCompletionChunk): The chunk, as returned by the OpenAI SDK when streaming.
+        Returns:
+            int: The number of tokens streamed so far.
+        """
+        if chunk.choices:
+            delta = chunk.choices[0].delta
+            if delta.content:
+                self._content.add(delta.content)
+            for tool_call in delta.tool_calls or []:
+                if tool_call.function is not None and tool_call.function.arguments:
+                    self.add_tool_call_arguments(tool_call.index, tool_call.function.arguments)
+        return self.token_count
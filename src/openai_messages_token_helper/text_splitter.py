@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import re
+from bisect import bisect_left, bisect_right
+from collections.abc import Iterator
+from itertools import accumulate, islice
+from typing import TYPE_CHECKING, Protocol
+
+from .encoding_helper import SAFE_BOUNDARY, find_stable_cut
+from .model_helper import encoding_for_model
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# The ranks of the places a chunk can end, where higher ranks are preferred
+WORD, SENTENCE, PARAGRAPH = 1, 2, 3
+SENTENCE_ENDINGS = ".!?;:。！？；："
+CLOSING_PUNCTUATION = "\"')]”’」』）"
+# Positions after a full-width sentence ending and before a word. The ending joins the word's piece,
+# so a chunk can only end there if a token starts there too, and then the text on either side encodes the same.
+FULL_WIDTH_SENTENCE_END = re.compile(r"(?<=[。！？])(?=[^\W\d_])")
+# UTF-8 continuation bytes, which are the only bytes that don't start a character
+CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+# How far from the end of the text read so far to look for the last boundary, before looking further back
+BOUNDARY_SEARCH_WINDOW = 1024
+# The number of tokens to keep after a cut in a text without safe boundaries, since later text could merge into them
+SEAM_TAIL_TOKENS = 16
+
+# For each token of each encoding: the number of characters that start in it, and whether it starts mid-character
+_TOKEN_CHAR_COUNTS: dict[str, tuple[bytearray, bytearray]] = {}
+
+
+class Readable(Protocol):
+    def read(self, size: int, /) -> str: ...
+
+
+def _token_char_counts(encoding: tiktoken.Encoding) -> tuple[bytearray, bytearray]:
+    tables = _TOKEN_CHAR_COUNTS.get(encoding.name)
+    if tables is None:
+        char_counts = bytearray(encoding.n_vocab)
+        starts_mid_char = bytearray(encoding.n_vocab)
+        for token in range(encoding.n_vocab):
+            try:
+                token_bytes = encoding.decode_single_token_bytes(token)
+            except KeyError:
+                continue
+            char_counts[token] = len(token_bytes.translate(None, CONTINUATION_BYTES))
+            starts_mid_char[token] = bool(token_bytes) and token_bytes[0] in CONTINUATION_BYTES
+        tables = _TOKEN_CHAR_COUNTS[encoding.name] = (char_counts, starts_mid_char)
+    return tables
+
+
+def _read_pieces(source: str | Readable, read_size: int) -> Iterator[str]:
+    if isinstance(source, str):
+        for start in range(0, len(source), read_size):
+            yield source[start : start + read_size]
+        return
+    while piece := source.read(read_size):
+        yield piece
+
+
+def _read_blocks(source: str | Readable, read_size: int, encoding: tiktoken.Encoding) -> Iterator[tuple[str, bool]]:
+    """
+    Read the source in blocks that end at safe boundaries, so that each block can be encoded on its own,
+    along with whether each block ends at a safe boundary. Text without boundaries is cut at a stable token
+    once twice read_size characters of it are buffered, so that blocks stay bounded for any text.
+    """
+    buffer = ""
+    for piece in _read_pieces(source, read_size):
+        # Boundaries in the old buffer were already used, except near its end where the lookahead was missing
+        search_start = max(len(buffer) - 2, 1)
+        buffer += piece
+        last_boundary = None
+        for window_start in (max(len(buffer) - BOUNDARY_SEARCH_WINDOW, search_start), search_start):
+            for last_boundary in SAFE_BOUNDARY.finditer(buffer, window_start):
+                pass
+            if last_boundary is not None:
+                break
+        if last_boundary is not None:
+            yield buffer[: last_boundary.start()], True
+            buffer = buffer[last_boundary.start() :]
+        elif len(buffer) >= 2 * read_size:
+            cut, _ = find_stable_cut(encoding, buffer, SEAM_TAIL_TOKENS)
+            if cut > 0:
+                yield buffer[:cut], False
+                buffer = buffer[cut:]
+    if buffer:
+        yield buffer, True
+
+
+class _TokenWindow:
+    """
+    The tokens of the part of a document that hasn't been chunked yet, with their character offsets
+    and the token indexes where a chunk can end without changing how the text on either side is encoded.
+    """
+
+    def __init__(self, encoding: tiktoken.Encoding):
+        self.encoding = encoding
+        self.char_counts, self.starts_mid_char = _token_char_counts(encoding)
+        self.text = ""
+        # The offset in the document of the first character of text
+        self.char_base = 0
+        self.tokens: list[int] = []
+        # offsets[i] is the offset in the document where token i starts, with one more for the end
+        self.offsets: list[int] = [0]
+        self.cut_indexes: list[int] = []
+        self.cut_ranks: list[int] = []
+        # The token indexes where blocks were cut without a safe boundary, which chunks can't be trusted across
+        self.seam_indexes: list[int] = []
+        # The token index where the next chunk starts, and whether it starts at a cut
+        self.start = 0
+        self.start_is_cut = True
+        # The token index where the last chunk ended, which is after the start when chunks overlap
+        self.chunked_until = 0
+
+    @property
+    def unchunked_count(self) -> int:
+        return len(self.tokens) - self.chunked_until
+
+    def _rank(self, position: int) -> int:
+        previous = self.text[position - 1]
+        if previous in "\r\n":
+            return PARAGRAPH if position >= 2 and self.text[position - 2] in "\r\n" else SENTENCE
+        if previous in SENTENCE_ENDINGS or (
+            previous in CLOSING_PUNCTUATION and position >= 2 and self.text[position - 2] in SENTENCE_ENDINGS
+        ):
+            return SENTENCE
+        return WORD
+
+    def extend(self, block: str, starts_at_boundary: bool = True):
+        """Encode a block, and add its tokens and cuts. A block that doesn't start at a safe boundary starts a seam."""
+        first_token = len(self.tokens)
+        first_char = len(self.text)
+        block_tokens = self.encoding.encode_ordinary(block)
+        self.text += block
+        self.tokens.extend(block_tokens)
+        self.offsets.extend(
+            islice(accumulate(map(self.char_counts.__getitem__, block_tokens), initial=self.offsets[-1]), 1, None)
+        )
+        positions = sorted(
+            [boundary.start() for boundary in SAFE_BOUNDARY.finditer(self.text, first_char + 1)]
+            + [end.start() for end in FULL_WIDTH_SENTENCE_END.finditer(self.text, first_char + 1)]
+        )
+        if first_token > 0:
+            if starts_at_boundary:
+                positions.insert(0, first_char)
+            else:
+                self.seam_indexes.append(first_token)
+        for position in positions:
+            index = bisect_left(self.offsets, position + self.char_base, first_token)
+            # A cut must be at the start of a token, and not inside a multi-byte character
+            if (
+                index < len(self.tokens)
+                and self.offsets[index] == position + self.char_base
+                and not self.starts_mid_char[self.tokens[index]]
+            ):
+                self.cut_indexes.append(index)
+                self.cut_ranks.append(self._rank(position))
+
+    def _choose_end(self, max_tokens: int) -> tuple[int, bool]:
+        """Choose where the next chunk ends, and whether that is at a cut."""
+        limit = self.start + max_tokens
+        if limit >= len(self.tokens):
+            return len(self.tokens), True
+        # Prefer the highest ranked cut in the second half of the chunk, so that chunks aren't too short.
+        # The chunk must end after the previous one, which it overlaps.
+        lower = bisect_right(self.cut_indexes, max(self.start + max_tokens // 2, self.chunked_until))
+        upper = bisect_right(self.cut_indexes, limit)
+        if lower < upper:
+            best = max(range(lower, upper), key=lambda k: (self.cut_ranks[k], self.cut_indexes[k]))
+            return self.cut_indexes[best], True
+        if upper > bisect_right(self.cut_indexes, self.chunked_until):
+            return self.cut_indexes[upper - 1], True
+        return limit, False
+
+    def _choose_next_start(self, end: int, overlap: int) -> int:
+        """Choose where the chunk after one that ends at `end` starts, overlapping by at most `overlap` tokens."""
+        lower = bisect_left(self.cut_indexes, max(end - overlap, self.start + 1))
+        upper = bisect_left(self.cut_indexes, end)
+        if overlap == 0 or lower >= upper:
+            return end
+        # Prefer the highest ranked cut, and then the longest overlap
+        best = min(range(lower, upper), key=lambda k: (-self.cut_ranks[k], self.cut_indexes[k]))
+        return self.cut_indexes[best]
+
+    def pop_chunk(self, max_tokens: int, overlap: int) -> str:
+        """Remove the next chunk of at most max_tokens tokens from the window, and return its text."""
+        end, end_is_cut = self._choose_end(max_tokens)
+        chunk_text = self._text_between(self.start, end)
+        if not (self.start_is_cut and end_is_cut) or self._crosses_seam(self.start, end):
+            # Text that is cut in the middle of a piece may encode differently than its tokens, so check it
+            while end > self.start + 1 and len(self.encoding.encode_ordinary(chunk_text)) > max_tokens:
+                end -= 1
+                end_is_cut = False
+                chunk_text = self._text_between(self.start, end)
+            if end < len(self.tokens) and self.starts_mid_char[self.tokens[end]]:
+                end = self._align_end(end)
+                chunk_text = self._text_between(self.start, end)
+
+        next_start = self._choose_next_start(end, overlap) if end_is_cut else end
+        self.start_is_cut = next_start != end or end_is_cut
+        self.start = next_start
+        self.chunked_until = end
+        # Compacting copies what is left, so only do it once most of the window is chunked
+        if self.start > 4096 and self.start * 2 > len(self.tokens):
+            self._compact()
+        return chunk_text
+
+    def _align_end(self, end: int) -> int:
+        """
+        Move an end that is inside a multi-byte character back to the start of the character, or past the character
+        when it is all the chunk has, so that a character that takes more than max_tokens tokens is a chunk of its own.
+        """
+        char_start = end
+        while self.starts_mid_char[self.tokens[char_start]]:
+            char_start -= 1
+        if char_start > self.start:
+            return char_start
+        while end < len(self.tokens) and self.starts_mid_char[self.tokens[end]]:
+            end += 1
+        return end
+
+    def _crosses_seam(self, start: int, end: int) -> bool:
+        return bisect_right(self.seam_indexes, start) < bisect_left(self.seam_indexes, end)
+
+    def _text_between(self, start: int, end: int) -> str:
+        return self.text[self.offsets[start] - self.char_base : self.offsets[end] - self.char_base]
+
+    def _compact(self):
+        """Drop the tokens and text before the start of the next chunk, so memory is bounded by the chunk size."""
+        first_cut = bisect_left(self.cut_indexes, self.start)
+        self.text = self.text[self.offsets[self.start] - self.char_base :]
+        self.char_base = self.offsets[self.start]
+        self.tokens = self.tokens[self.start :]
+        self.offsets = self.offsets[self.start :]
+        self.cut_indexes = [index - self.start for index in self.cut_indexes[first_cut:]]
+        self.cut_ranks = self.cut_ranks[first_cut:]
+        self.seam_indexes = [index - self.start for index in self.seam_indexes if index > self.start]
+        self.chunked_until -= self.start
+        self.start = 0
+
+
+def split_text_by_tokens(
+    source: str | Readable,
+    model: str,
+    max_tokens: int,
+    overlap: int = 0,
+    default_to_cl100k=False,
+    read_size: int = 65_536,
+) -> Iterator[str]:
+    """
+    Split a text into chunks of at most a number of tokens, like for embedding documents.
+    Chunks end at paragraph or sentence boundaries where possible, and otherwise between words.
+    The text is read and encoded in blocks, so each character is only encoded once and only the tokens
+    of about one block and one chunk are held in memory, even for a very large document.
+    Long runs of text without word boundaries are cut into blocks at a token that encodes the same
+    on either side, which re-encodes a little of them, and chunks across those cuts are checked by encoding them.
+    Special tokens like <|endoftext|> are encoded as ordinary text.
+    Args:
+        source (str | file-like): The text, or a file-like object opened in text mode to read it from.
+        model (str): The name of the model to use for encoding, like gpt-4o.
+        max_tokens (int): The maximum number of tokens in each chunk. A single character that takes more tokens,
+            like an emoji when max_tokens is 1, is a chunk of its own.
+        overlap (int): The maximum number of tokens from the end of each chunk to repeat at the start of the next.
+            The overlap starts at a boundary too, so it can be shorter.
+        default_to_cl100k (bool): Whether to default to the CL100k encoding if the model is not found.
+        read_size (int): The number of characters to read from the source at a time.
+    Returns:
+        Iterator[str]: The chunks, which concatenate to the text when there is no overlap.
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive")
+    if not 0 <= overlap < max_tokens:
+        raise ValueError("overlap must be at least 0 and less than max_tokens")
+    encoding = encoding_for_model(model, default_to_cl100k)
+    window = _TokenWindow(encoding)
+    starts_at_boundary = True
+    for block, ends_at_boundary in _read_blocks(source, read_size, encoding):
+        window.extend(block, starts_at_boundary)
+        starts_at_boundary = ends_at_boundary
+        # Only chunk once there are more tokens than fit, since the end of the window may not be a good place to cut
+        while window.unchunked_count > max_tokens:
+            yield window.pop_chunk(max_tokens, overlap)
+    while window.unchunked_count > 0:
+        yield window.pop_chunk(max_tokens, overlap)
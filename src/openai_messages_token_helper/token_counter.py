@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+
+from .cache import CacheBackend, LRUCache
+from .images_helper import count_tokens_for_image
+from .message_builder import build_messages
+from .model_helper import (
+    _count_message,
+    _warn_if_reasoning_model,
+    count_tokens_for_tools,
+    encoding_for_model,
+    get_token_limit,
+)
+from .tools_helper import ToolSet
+
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import (
+        ChatCompletionMessageParam,
+        ChatCompletionSystemMessageParam,
+        ChatCompletionToolChoiceOptionParam,
+        ChatCompletionToolParam,
+    )
+
+
+class TokenCounter:
+    """
+    A token counter bound to one model, which resolves the model's encoding and token limit once
+    and owns a cache of message token counts. It holds no other state, so one instance can be
+    created at startup and shared by every request and thread.
+    Attributes:
+        model (str): The model name to use for token calculation, like gpt-4o.
+        encoding (tiktoken.Encoding): The encoding of the model.
+        max_tokens (int): The maximum number of tokens allowed for built messages.
+        fallback_to_default (bool): Whether unknown models fall back to the CL100k encoding and the minimum limit.
+        cache (CacheBackend[int]): The cache of message token counts.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        *,
+        max_tokens: int | None = None,
+        fallback_to_default: bool = False,
+        cache: CacheBackend[int] | None = None,
+        parallel_min_chars: int | None = None,
+        num_threads: int = 8,
+    ):
+        """
+        Args:
+            model (str): The model name to use for token calculation, like gpt-4o.
+            max_tokens (int): The maximum number of tokens allowed for built messages. Defaults to the model's limit.
+            fallback_to_default (bool): Whether to fallback to the default encoding and limit if the model is not found.
+            cache (CacheBackend[int]): The cache of message token counts, like one shared with other counters.
+                Defaults to a new cache.
+            parallel_min_chars (int): If given, texts of at least this many characters are encoded on a thread pool,
+                as in `count_tokens_for_message`.
+            num_threads (int): The number of threads to encode large texts with.
+        """
+        # Resolving the model logs its warnings once, instead of on every count
+        _warn_if_reasoning_model(model)
+        self.model = model
+        self.fallback_to_default = fallback_to_default
+        self.encoding: tiktoken.Encoding = encoding_for_model(model, default_to_cl100k=fallback_to_default)
+        if max_tokens is None:
+            max_tokens = get_token_limit(model, default_to_minimum=fallback_to_default)
+        self.max_tokens = max_tokens
+        self.cache: CacheBackend[int] = cache if cache is not None else LRUCache()
+        self.parallel_min_chars = parallel_min_chars
+        self.num_threads = num_threads
+
+    def count_message(self, message: ChatCompletionMessageParam, *, limit: int | None = None) -> int:
+        """
+        Calculate the number of tokens required to encode a message, as in `count_tokens_for_message`.
+        Args:
+            message (Mapping): The message to encode, in a dictionary-like object.
+            limit (int): If given, stop encoding as soon as the count exceeds the limit.
+        Returns:
+            int: The total number of tokens required to encode the message, or a count over the limit.
+        """
+        return _count_message(
+            self.model,
+            self.encoding,
+            message,
+            cache=self.cache,
+            limit=limit,
+            parallel_min_chars=self.parallel_min_chars,
+            num_threads=self.num_threads,
+        )
+
+    def count_system_and_tools(
+        self,
+        system_message: ChatCompletionSystemMessageParam | None = None,
+        tools: list[ChatCompletionToolParam] | ToolSet | None = None,
+        tool_choice: ChatCompletionToolChoiceOptionParam | None = None,
+    ) -> int:
+        """
+        Calculate the number of tokens required to encode a system message and tools,
+        as in `count_tokens_for_system_and_tools`.
+        Args:
+            system_message (dict): The system message to encode.
+            tools (list[dict[str, dict]] | ToolSet): The tools to encode, or a ToolSet with their memoized count.
+            tool_choice (str | dict): The tool choice to encode.
+        Returns:
+            int: The total number of tokens required to encode the system message and tools.
+        """
+        tokens = 0
+        if system_message:
+            tokens += self.count_message(system_message)
+        return tokens + count_tokens_for_tools(
+            self.encoding, tools, tool_choice, has_system_message=bool(system_message)
+        )
+
+    def count_image(self, image_uri: str, detail: str = "auto") -> int:
+        """
+        Calculate the number of tokens for an image, as in `count_tokens_for_image`.
+        Args:
+            image_uri (str): The data URI of the image.
+            detail (str): The detail level of the image, "low", "high" or "auto".
+        Returns:
+            int: The number of tokens for the image.
+        """
+        return count_tokens_for_image(image_uri, detail, self.model)
+
+    def build_messages(self, system_prompt: str, **kwargs: Any) -> list[ChatCompletionMessageParam]:
+        """
+        Build a list of messages for a chat conversation, as in `build_messages`,
+        with the counter's model, token limit, fallback policy and cache.
+        The model's warnings are logged once for the build, not for every message counted.
+        Args:
+            system_prompt (str): The initial system prompt message.
+            **kwargs: The same keyword arguments as `build_messages`, where max_tokens defaults to the counter's.
+        Returns:
+            list[ChatCompletionMessageParam]: The messages, with the history truncated to fit.
+        """
+        kwargs.setdefault("max_tokens", self.max_tokens)
+        return build_messages(
+            self.model, system_prompt, fallback_to_default=self.fallback_to_default, cache=self.cache, **kwargs
+        )
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from collections.abc import Iterable, Iterator
+from typing import TYPE_CHECKING
+
+from . import instrumentation
+from .function_format import format_function_definition, format_function_definitions
+
+if TYPE_CHECKING:
+    import tiktoken
+    from openai.types.chat import ChatCompletionToolParam
+
+
+class ToolSet:
+    """
+    A list of tools compiled once into the function definitions that the model sees,
+    with their token counts memoized per encoding, so that sending the same tools on
+    every turn doesn't format and encode them again.
+    Attributes:
+        tools (list[ChatCompletionToolParam]): The tools, in order.
+        formatted (str): The function definitions namespace for all of the tools.
+        formatted_tools (list[str]): The function definition of each tool.
+    """
+
+    def __init__(self, tools: Iterable[ChatCompletionToolParam]):
+        self.tools = list(tools)
+        self.formatted = format_function_definitions(self.tools)
+        self.formatted_tools = [format_function_definition(tool) for tool in self.tools]
+        self._token_counts: dict[str, int] = {}
+        self._tool_token_counts: dict[str, list[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.tools)
+
+    def __iter__(self) -> Iterator[ChatCompletionToolParam]:
+        return iter(self.tools)
+
+    def token_count(self, encoding: tiktoken.Encoding) -> int:
+        """
+        Get the number of tokens in the function definitions namespace, encoding it only once per encoding.
+        Args:
+            encoding (tiktoken.Encoding): The encoding to use.
+        Returns:
+            int: The number of tokens in the formatted function definitions.
+        """
+        token_count = self._token_counts.get(encoding.name)
+        if token_count is None:
+            if instrumentation.tracer is not None:
+                instrumentation.record_encode(self.formatted)
+            token_count = self._token_counts[encoding.name] = len(encoding.encode(self.formatted))
+        return token_count
+
+    def tool_token_counts(self, encoding: tiktoken.Encoding) -> list[int]:
+        """
+        Get the number of tokens contributed by each tool's function definition, encoding them only once per encoding.
+        The sum is close to, but not always exactly, the count of the whole namespace,
+        since tokens can merge across the boundaries between definitions.
+        Args:
+            encoding (tiktoken.Encoding): The encoding to use.
+        Returns:
+            list[int]: The number of tokens in each tool's function definition.
+        """
+        tool_token_counts = self._tool_token_counts.get(encoding.name)
+        if tool_token_counts is None:
+            if instrumentation.tracer is not None:
+                instrumentation.record_encode(*self.formatted_tools)
+            tool_token_counts = [len(tokens) for tokens in encoding.encode_batch(self.formatted_tools)]
+            self._tool_token_counts[encoding.name] = tool_token_counts
+        return list(tool_token_counts)
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from openai_messages_token_helper import (
+    LRUCache,
+    async_build_messages,
+    async_count_tokens_for_message,
+    build_messages,
+)
+from openai_messages_token_helper import async_helper as async_helper_module
+
+from .messages import assistant_message_perf, system_message_short, user_message, user_message_perf, user_message_pm
+
+
+def test_async_build_messages():
+    kwargs = dict(
+        past_messages=[user_message_perf["message"], assistant_message_perf["message"]],
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=50,
+    )
+    expected = build_messages("gpt-35-turbo", system_message_short["message"]["content"], **kwargs)
+    messages = asyncio.run(async_build_messages("gpt-35-turbo", system_message_short["message"]["content"], **kwargs))
+    assert messages == expected
+
+
+def test_async_count_tokens_for_message():
+    cache: LRUCache[int] = LRUCache()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="counter") as executor:
+        count = asyncio.run(
+            async_count_tokens_for_message("gpt-4", user_message["message"], executor=executor, cache=cache)
+        )
+    assert count == user_message["count"]
+    assert cache.stats().misses == 1
+
+
+def test_async_build_messages_does_not_block_event_loop(monkeypatch):
+    """The blocking work only finishes once another coroutine runs, which requires the event loop to be free."""
+    other_coroutine_ran = threading.Event()
+    threads = []
+
+    def blocking_build_messages(model, system_prompt, **kwargs):
+        threads.append(threading.current_thread().name)
+        assert other_coroutine_ran.wait(timeout=5)
+        return []
+
+    monkeypatch.setattr(async_helper_module, "build_messages", blocking_build_messages)
+
+    async def other_coroutine():
+        await asyncio.sleep(0)
+        other_coroutine_ran.set()
+
+    async def main():
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="builder") as executor:
+            await asyncio.gather(async_build_messages("gpt-4", "You are a bot.", executor=executor), other_coroutine())
+
+    asyncio.run(main())
+    assert threads[0].startswith("builder")
@@ -0,0 +1,63 @@
+import pytest
+import tiktoken
+
+from openai_messages_token_helper import export_bpe_files, set_bpe_directory
+from openai_messages_token_helper.bpe_helper import BPE_DIRECTORY_ENV, read_compact_ranks, write_compact_ranks
+from openai_messages_token_helper.model_helper import encoding_for_model
+
+TEXT = "Ünïcödé text with <|endoftext|> and code: def f(x):\n    return x ** 2  🎉"
+
+
+@pytest.fixture
+def bpe_directory(tmp_path):
+    export_bpe_files(tmp_path, ["cl100k_base"])
+    yield tmp_path
+    set_bpe_directory(None)
+
+
+@pytest.mark.parametrize("encoding_name", ["cl100k_base", "o200k_base"])
+def test_compact_ranks_round_trip(tmp_path, encoding_name):
+    expected = tiktoken.get_encoding(encoding_name)
+    path = tmp_path / "ranks"
+    write_compact_ranks(expected, path)
+    encoding = read_compact_ranks(path)
+    assert encoding.name == expected.name
+    assert encoding.n_vocab == expected.n_vocab
+    assert encoding._mergeable_ranks == expected._mergeable_ranks
+    assert encoding._special_tokens == expected._special_tokens
+    assert encoding.encode(TEXT, allowed_special="all") == expected.encode(TEXT, allowed_special="all")
+
+
+def test_read_compact_ranks_error(tmp_path):
+    path = tmp_path / "cl100k_base.tiktoken"
+    path.write_bytes(b"IQ== 0\n")
+    with pytest.raises(ValueError, match="Not a compact rank file"):
+        read_compact_ranks(path)
+
+
+def test_export_bpe_files(tmp_path):
+    paths = export_bpe_files(tmp_path / "bpe")
+    assert sorted(path.rsplit("/", 1)[-1] for path in paths) == ["cl100k_base.ranks", "o200k_base.ranks"]
+
+
+def test_set_bpe_directory(bpe_directory):
+    tiktoken_encoding = encoding_for_model("gpt-4")
+    set_bpe_directory(bpe_directory)
+    encoding = encoding_for_model("gpt-4")
+    assert encoding is not tiktoken_encoding
+    assert encoding.encode_ordinary(TEXT) == tiktoken_encoding.encode_ordinary(TEXT)
+    # Models that use the same encoding share it
+    assert encoding_for_model("gpt-35-turbo") is encoding
+    # Encodings without a file are still loaded by tiktoken
+    assert encoding_for_model("gpt-4o") is tiktoken.get_encoding("o200k_base")
+    set_bpe_directory(None)
+    assert encoding_for_model("gpt-4") is tiktoken_encoding
+
+
+def test_bpe_directory_env(bpe_directory, monkeypatch):
+    monkeypatch.setenv(BPE_DIRECTORY_ENV, str(bpe_directory))
+    set_bpe_directory(None)
+    assert encoding_for_model("gpt-4") is not tiktoken.get_encoding("cl100k_base")
+    monkeypatch.delenv(BPE_DIRECTORY_ENV)
+    set_bpe_directory(None)
+    assert encoding_for_model("gpt-4") is tiktoken.get_encoding("cl100k_base")
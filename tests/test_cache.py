@@ -0,0 +1,188 @@
+import gc
+import multiprocessing
+import os
+
+import pytest
+
+from openai_messages_token_helper import LRUCache, SQLiteCache, count_tokens_for_message
+from openai_messages_token_helper import cache as cache_module
+from openai_messages_token_helper.cache import message_cache_key
+
+
+def test_lrucache_get_put():
+    cache: LRUCache[int] = LRUCache()
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    assert len(cache) == 1
+    stats = cache.stats()
+    assert stats.hits == 1
+    assert stats.misses == 1
+    assert stats.hit_rate == 0.5
+
+
+def test_lrucache_evicts_by_entries():
+    cache: LRUCache[int] = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats().evictions == 1
+
+
+def test_lrucache_evicts_by_bytes():
+    cache: LRUCache[int] = LRUCache(max_bytes=100)
+    cache.put("a", 1, size=60)
+    cache.put("b", 2, size=30)
+    cache.put("b", 2, size=30)
+    assert cache.stats().total_bytes == 90
+    cache.put("c", 3, size=30)
+    assert "a" not in cache
+    assert cache.stats().total_bytes == 60
+    # Entries larger than the whole cache are never stored
+    cache.put("d", 4, size=101)
+    assert "d" not in cache
+    assert len(cache) == 2
+
+
+def test_lrucache_clear():
+    cache: LRUCache[int] = LRUCache()
+    cache.put("a", 1, size=10)
+    cache.get("a")
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats() == cache.stats().__class__(hits=0, misses=0, evictions=0, entries=0, total_bytes=0)
+    assert cache.stats().hit_rate == 0.0
+
+
+def test_lrucache_invalid_bounds():
+    with pytest.raises(ValueError, match="Cache bounds must be positive"):
+        LRUCache(max_entries=0)
+
+
+def test_message_cache_key():
+    key, size = message_cache_key("cl100k_base", {"role": "user", "content": "Hello"})
+    assert key.startswith("cl100k_base:")
+    assert size == len('{"content":"Hello","role":"user"}')
+    # Key order doesn't matter, but namespace and content do
+    assert message_cache_key("cl100k_base", {"content": "Hello", "role": "user"})[0] == key
+    assert message_cache_key("o200k_base", {"role": "user", "content": "Hello"})[0] != key
+    assert message_cache_key("cl100k_base", {"role": "user", "content": "Hello!"})[0] != key
+
+
+def test_message_cache_key_values():
+    class Model:
+        def model_dump(self, mode):
+            return {"role": "user", "content": "Hello"}
+
+    # Pydantic models are keyed by their content, and bytes by their value rather than their repr
+    assert message_cache_key("cl100k_base", {"message": Model()})[0] == (
+        message_cache_key("cl100k_base", {"message": {"role": "user", "content": "Hello"}})[0]
+    )
+    assert message_cache_key("cl100k_base", {"data": b"Hello"})[0] == (
+        message_cache_key("cl100k_base", {"data": bytearray(b"Hello")})[0]
+    )
+    assert message_cache_key("cl100k_base", {"data": b"Hello"})[0] != (
+        message_cache_key("cl100k_base", {"data": b"Hello!"})[0]
+    )
+    # Other objects have no stable key
+    with pytest.raises(TypeError, match="Could not compute a cache key for message value of type object"):
+        message_cache_key("cl100k_base", {"role": "user", "content": object()})
+
+
+def test_sqlitecache_get_put(tmp_path):
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db")
+    assert cache.get("a") is None
+    cache.put("a", 1, size=10)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    assert len(cache) == 1
+    assert cache.stats() == cache.stats().__class__(hits=1, misses=1, evictions=0, entries=1, total_bytes=10)
+    # Lists are read back as tuples, like image dimensions
+    cache.put("dims", (300, 200))
+    assert cache.get("dims") == (300, 200)
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats().hits == 0
+
+
+def test_sqlitecache_shared(tmp_path):
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db")
+    other_cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db")
+    message = {"role": "user", "content": "Hello, how are you?"}
+    count = count_tokens_for_message("gpt-4o", message, cache=cache)
+    assert count_tokens_for_message("gpt-4o", message, cache=other_cache) == count
+    assert other_cache.stats().hits == 1
+    other_cache.close()
+    assert other_cache.get(message_cache_key("o200k_base", message)[0]) == count
+
+
+def put_in_child(cache: SQLiteCache[int]):
+    inherited_connection = cache._connection
+    cache.put(f"child-{os.getpid()}", os.getpid())
+    cache.close()
+    gc.collect()
+    # The parent's connection was replaced, but is never closed in the child
+    assert cache._connection is None
+    assert any(connection is inherited_connection for connection in cache_module._INHERITED_CONNECTIONS)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="Needs fork")
+def test_sqlitecache_fork(tmp_path):
+    # Like a server that creates the cache before forking its workers
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db")
+    # The connection is only opened on first use
+    assert not (tmp_path / "cache.db").exists()
+    cache.put("parent", 1)
+    processes = [multiprocessing.get_context("fork").Process(target=put_in_child, args=(cache,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+        assert cache.get(f"child-{process.pid}") == process.pid
+    assert len(cache) == 5
+
+
+def test_sqlitecache_evicts_by_entries(tmp_path):
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db", max_entries=2, touch_interval=0, check_interval=1)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.stats().evictions == 1
+
+
+def test_sqlitecache_evicts_by_bytes(tmp_path):
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db", max_bytes=100, check_interval=1)
+    cache.put("a", 1, size=60)
+    cache.put("b", 2, size=30)
+    cache.put("b", 2, size=30)
+    assert cache.stats().total_bytes == 90
+    cache.put("c", 3, size=30)
+    assert "a" not in cache
+    assert cache.stats().total_bytes == 60
+    # Entries larger than the whole cache are never stored
+    cache.put("d", 4, size=101)
+    assert "d" not in cache
+
+
+def test_sqlitecache_check_interval(tmp_path):
+    cache: SQLiteCache[int] = SQLiteCache(tmp_path / "cache.db", max_entries=10, check_interval=20)
+    for i in range(30):
+        cache.put(str(i), i)
+    # The bounds are checked on the first put, and then every 20 puts
+    assert len(cache) == 19
+    assert cache.stats().evictions == 11
+
+
+def test_sqlitecache_invalid_bounds(tmp_path):
+    with pytest.raises(ValueError, match="Cache bounds must be positive"):
+        SQLiteCache(tmp_path / "cache.db", max_bytes=0)
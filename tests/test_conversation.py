@@ -0,0 +1,107 @@
+import pytest
+
+from openai_messages_token_helper import Conversation, build_messages
+from openai_messages_token_helper import conversation as conversation_module
+
+from .functions import search_sources_toolchoice_auto
+from .messages import (
+    assistant_message_dresscode,
+    assistant_message_perf,
+    system_message_short,
+    user_message_dresscode,
+    user_message_perf,
+    user_message_pm,
+)
+
+PAST_MESSAGES = [
+    user_message_perf["message"],  # 14 tokens
+    assistant_message_perf["message"],  # 106 tokens
+    user_message_dresscode["message"],  # 13 tokens
+    assistant_message_dresscode["message"],  # 30 tokens
+]
+
+FEW_SHOTS = [
+    {"role": "user", "content": "How did crypto do last year?"},
+    {"role": "assistant", "content": "Summarize Cryptocurrency Market Dynamics from last year"},
+]
+
+
+@pytest.mark.parametrize("max_tokens", [10, 69, 160, 300, 3000])
+def test_conversation_matches_build_messages(max_tokens):
+    conversation = Conversation(
+        "gpt-35-turbo",
+        search_sources_toolchoice_auto["system_message"]["content"],
+        tools=search_sources_toolchoice_auto["tools"],
+        tool_choice=search_sources_toolchoice_auto["tool_choice"],
+        few_shots=FEW_SHOTS,
+        max_tokens=max_tokens,
+    )
+    conversation.extend(PAST_MESSAGES)
+    expected = build_messages(
+        "gpt-35-turbo",
+        search_sources_toolchoice_auto["system_message"]["content"],
+        tools=search_sources_toolchoice_auto["tools"],
+        tool_choice=search_sources_toolchoice_auto["tool_choice"],
+        few_shots=FEW_SHOTS,
+        past_messages=PAST_MESSAGES,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=max_tokens,
+    )
+    assert conversation.build_messages(user_message_pm["message"]["content"]) == expected
+
+
+def test_conversation_ledger():
+    conversation = Conversation("gpt-35-turbo", system_message_short["message"]["content"])
+    assert conversation.max_tokens == 4000
+    assert conversation.prefix_token_count == system_message_short["count"]
+    conversation.extend(PAST_MESSAGES)
+    assert len(conversation) == 4
+    assert conversation.messages == PAST_MESSAGES
+    assert conversation.token_counts == [14, 106, 13, 30]
+    assert conversation.total_token_count == system_message_short["count"] + 14 + 106 + 13 + 30
+    assert conversation.build_messages() == [system_message_short["message"], *PAST_MESSAGES]
+
+
+def test_conversation_counts_only_new_messages(monkeypatch):
+    counted = []
+    original_count = conversation_module.count_tokens_for_message
+
+    def spy_count(model, message, **kwargs):
+        counted.append(message)
+        return original_count(model, message, **kwargs)
+
+    monkeypatch.setattr(conversation_module, "count_tokens_for_message", spy_count)
+    conversation = Conversation("gpt-35-turbo", system_message_short["message"]["content"])
+    for turn in range(50):
+        counted.clear()
+        question = f"Question number {turn}"
+        messages = conversation.build_messages(question)
+        assert len(messages) == 2 + 2 * turn
+        conversation.append({"role": "user", "content": question})
+        conversation.append({"role": "assistant", "content": f"Answer number {turn}"})
+        # Only the new user message and the assistant reply are counted, never the history
+        assert counted == [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": f"Answer number {turn}"},
+        ]
+
+
+def test_conversation_truncates_to_max_tokens():
+    conversation = Conversation("gpt-35-turbo", system_message_short["message"]["content"], max_tokens=69)
+    conversation.extend(PAST_MESSAGES)
+    assert conversation.build_messages(user_message_pm["message"]["content"]) == [
+        system_message_short["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+        user_message_pm["message"],
+    ]
+
+
+def test_conversation_append_error():
+    conversation = Conversation("gpt-35-turbo", system_message_short["message"]["content"])
+    with pytest.raises(ValueError, match="Conversation messages must have role and either content or tool_calls"):
+        conversation.append({"role": "assistant", "content": None})
+    with pytest.raises(ValueError, match="tool_call_id must be a string value"):
+        conversation.append({"role": "tool", "tool_call_id": 123, "content": "Results"})  # type: ignore[typeddict-item]
+    with pytest.raises(ValueError, match="tool_calls must be a list of tool calls"):
+        conversation.append({"role": "assistant", "tool_calls": 123})  # type: ignore[typeddict-item]
@@ -0,0 +1,138 @@
+import random
+
+import pytest
+import tiktoken
+
+from openai_messages_token_helper.encoding_helper import (
+    count_tokens_bounded,
+    count_tokens_parallel,
+    iter_text_chunks,
+    split_for_threads,
+)
+
+TEXT = (
+    "Some prose, with punctuation!\nA new line\n/path/to/file and\r\n123 numbers\n\n  indented code\n"
+    "Ünïcödé and 日本語 text\x1cwith separators　and wide spaces. It's done, isn't it? "
+) * 20
+
+# Scripts with and without spaces between words, with combining marks, and the punctuation around them
+ALPHABETS = [
+    "абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГД",
+    "这是一个测试中文文本的句子我们需要很多汉字",
+    "ひらがなカタカナ漢字",
+    "العربيةمرحبابكمًَِ",
+    "नमस्तेहिन्दी्ाि",
+    "ภาษาไทยิี",
+    "αβγδεΑΒΓ",
+    "abcXYZßǅʰ",
+    "0123٤٥²½Ⅻ",
+    " ",
+    "\n",
+    "\r\n",
+    "\t　\x1c",
+    "'’",
+    "，。、；：？！「」『』（）《》【】",
+    '.,;:!?-/()"_…—“”',
+    "🎉\u0301",
+]
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(rng.choice(ALPHABETS)) for _ in range(length))
+
+
+RUSSIAN = "Это предложение о снаряжении для скалолазания. Верёвка, обвязка и карабины! " * 200
+CHINESE = "这是一个关于攀岩装备的句子。绳子、安全带和铁锁都很重要！" * 200
+
+
+@pytest.mark.parametrize("encoding_name", ["cl100k_base", "o200k_base", "o200k_harmony", "p50k_base"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 100_000])
+def test_iter_text_chunks(encoding_name, chunk_size):
+    encoding = tiktoken.get_encoding(encoding_name)
+    chunks = list(iter_text_chunks(encoding, TEXT, chunk_size))
+    assert "".join(chunks) == TEXT
+    assert [token for chunk in chunks for token in encoding.encode(chunk)] == encoding.encode(TEXT)
+
+
+@pytest.mark.parametrize("encoding_name", ["cl100k_base", "o200k_base", "o200k_harmony"])
+def test_safe_boundary_fuzz(encoding_name):
+    encoding = tiktoken.get_encoding(encoding_name)
+    rng = random.Random(0)
+    for _ in range(500):
+        text = random_text(rng, rng.randint(1, 200))
+        chunks = list(iter_text_chunks(encoding, text, 1))
+        assert "".join(chunks) == text
+        assert [token for chunk in chunks for token in encoding.encode_ordinary(chunk)] == encoding.encode_ordinary(
+            text
+        )
+
+
+@pytest.mark.parametrize("text", [RUSSIAN, CHINESE], ids=["russian", "chinese"])
+def test_iter_text_chunks_non_latin(text):
+    encoding = tiktoken.get_encoding("o200k_base")
+    chunks = list(iter_text_chunks(encoding, text, 64))
+    # Scripts without ASCII letters still have boundaries between words or before punctuation
+    assert max(len(chunk) for chunk in chunks) < 128
+    assert [token for chunk in chunks for token in encoding.encode(chunk)] == encoding.encode(text)
+
+
+def test_iter_text_chunks_unsafe_encoding():
+    encoding = tiktoken.get_encoding("p50k_base")
+    assert list(iter_text_chunks(encoding, TEXT, 7)) == [TEXT]
+
+
+def test_iter_text_chunks_no_boundary():
+    encoding = tiktoken.get_encoding("o200k_base")
+    assert list(iter_text_chunks(encoding, "x" * 100, 7)) == ["x" * 100]
+    assert list(iter_text_chunks(encoding, "", 7)) == [""]
+
+
+def test_count_tokens_bounded():
+    encoding = tiktoken.get_encoding("o200k_base")
+    count = len(encoding.encode(TEXT))
+    assert count_tokens_bounded(encoding, TEXT, count, chunk_size=64) == count
+    assert count_tokens_bounded(encoding, TEXT, 10_000, chunk_size=64) == count
+    partial_count = count_tokens_bounded(encoding, TEXT, 100, chunk_size=64)
+    assert 100 < partial_count < count
+
+
+@pytest.mark.parametrize("text", [RUSSIAN, CHINESE], ids=["russian", "chinese"])
+def test_count_tokens_bounded_non_latin(text):
+    encoding = tiktoken.get_encoding("o200k_base")
+    assert count_tokens_bounded(encoding, text, 10**6, chunk_size=64) == len(encoding.encode(text))
+    # Encoding stops soon after the limit, instead of encoding the whole text
+    assert 100 < count_tokens_bounded(encoding, text, 100, chunk_size=64) < 200
+
+
+@pytest.mark.parametrize("encoding_name", ["cl100k_base", "o200k_base", "p50k_base"])
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_count_tokens_parallel(encoding_name, num_threads):
+    encoding = tiktoken.get_encoding(encoding_name)
+    text = TEXT * 100
+    assert count_tokens_parallel(encoding, text, num_threads) == len(encoding.encode(text))
+
+
+def test_count_tokens_parallel_limit():
+    encoding = tiktoken.get_encoding("o200k_base")
+    text = TEXT * 100
+    count = len(encoding.encode(text))
+    assert count_tokens_parallel(encoding, text, 4, limit=count) == count
+    partial_count = count_tokens_parallel(encoding, text, 4, limit=100)
+    assert 100 < partial_count < count
+
+
+def test_split_for_threads():
+    encoding = tiktoken.get_encoding("o200k_base")
+    text = TEXT * 100
+    chunks = split_for_threads(encoding, text, 4)
+    assert "".join(chunks) == text
+    # Several chunks per thread, but none shorter than the default chunk size
+    assert 4 < len(chunks) <= len(text) // 16_384 + 1
+
+
+@pytest.mark.parametrize("text", [RUSSIAN, CHINESE], ids=["russian", "chinese"])
+def test_count_tokens_parallel_non_latin(text):
+    encoding = tiktoken.get_encoding("o200k_base")
+    text *= 200_000 // len(text)
+    assert len(split_for_threads(encoding, text, 4)) > 4
+    assert count_tokens_parallel(encoding, text, 4) == len(encoding.encode(text))
@@ -0,0 +1,108 @@
+import pytest
+
+from openai_messages_token_helper import TokenEstimate, build_messages, count_tokens_for_message, estimate_tokens
+from openai_messages_token_helper import message_builder as message_builder_module
+from openai_messages_token_helper.model_helper import _count_message
+
+from .image_messages import IMAGE_MESSAGE_COUNTS
+from .messages import (
+    assistant_message_dresscode,
+    assistant_message_perf,
+    system_message,
+    system_message_short,
+    system_message_unicode,
+    system_message_with_name,
+    user_message,
+    user_message_dresscode,
+    user_message_perf,
+    user_message_pm,
+    user_message_unicode,
+)
+
+TEXTS = [
+    "",
+    "Hello, world!",
+    "    indented\n\n\tcode = {'a': [1, 2, 3]}  # comment\r\n",
+    "path/to\n/file and\n//comments",
+    "Ünïcödé text, 日本語のテキスト, and emoji 🎉🎉",
+    "separators\x1c\x1dinside\x1e\x1fwords　and wide spaces",
+    "-" * 500 + " " * 500 + "aaaa" * 200,
+]
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o", "gpt-4o-mini"])
+@pytest.mark.parametrize(
+    "message",
+    [
+        system_message["message"],
+        system_message_short["message"],
+        system_message_unicode["message"],
+        system_message_with_name["message"],
+        user_message["message"],
+        user_message_unicode["message"],
+        assistant_message_perf["message"],
+        *[{"role": "user", "content": text} for text in TEXTS],
+        *[pair["message"] for pair in IMAGE_MESSAGE_COUNTS],
+    ],
+)
+def test_estimate_tokens_bounds(model, message):
+    estimate = estimate_tokens(model, message)
+    count = count_tokens_for_message(model, message)
+    assert estimate.lower <= count <= estimate.upper
+    assert estimate.lower <= estimate.expected <= estimate.upper
+
+
+def test_estimate_tokens_fits():
+    estimate = TokenEstimate(lower=10, upper=20, expected=15)
+    assert estimate.fits(20) is True
+    assert estimate.fits(9) is False
+    assert estimate.fits(15) is None
+
+
+def test_estimate_tokens_error():
+    with pytest.raises(ValueError, match="Could not encode unsupported message value type"):
+        estimate_tokens("gpt-4o", {"role": "user", "content": 1})  # type: ignore[typeddict-item]
+
+
+@pytest.mark.parametrize("max_tokens", [10, 69, 160, 3000])
+def test_messagebuilder_use_estimates(max_tokens):
+    past_messages = [
+        user_message_perf["message"],
+        assistant_message_perf["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+    ]
+    kwargs = dict(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=max_tokens,
+    )
+    assert build_messages(**kwargs, use_estimates=True) == build_messages(**kwargs)
+
+
+def test_messagebuilder_use_estimates_skips_encoding(monkeypatch):
+    past_messages = [{"role": "user", "content": "word " * 100}, {"role": "assistant", "content": "Okay."}] * 50
+    counted = []
+
+    def spy_count_message(model, encoding, message, **kwargs):
+        if message["role"] != "system":
+            counted.append(message)
+        return _count_message(model, encoding, message, **kwargs)
+
+    monkeypatch.setattr(message_builder_module, "_count_message", spy_count_message)
+
+    # Every past message surely fits, so none of them are encoded
+    messages = build_messages(
+        model="gpt-4o", system_prompt="You are a bot.", past_messages=past_messages, use_estimates=True
+    )
+    assert messages[1:] == past_messages
+    assert counted == []
+
+    # The oldest long message surely doesn't fit, and only the newest messages are encoded until then
+    messages = build_messages(
+        model="gpt-4o", system_prompt="You are a bot.", past_messages=past_messages, max_tokens=200, use_estimates=True
+    )
+    assert messages[1:] == past_messages[-3:]
+    assert counted == past_messages[-3:][::-1]
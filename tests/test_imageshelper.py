@@ -1,8 +1,17 @@
 import base64
+from io import BytesIO
 
 import pytest
+from PIL import Image
 
-from openai_messages_token_helper import count_tokens_for_image
+from openai_messages_token_helper import LRUCache, SQLiteCache, count_tokens_for_image, set_image_dims_cache
+from openai_messages_token_helper.images_helper import IMAGE_DIMS_CACHE, get_image_dims, sniff_image_dims
+
+
+def image_uri(image: Image.Image, format: str, **save_kwargs) -> str:
+    buffer = BytesIO()
+    image.save(buffer, format=format, **save_kwargs)
+    return f"data:image/{format.lower()};base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
 
 
 @pytest.fixture
@@ -28,3 +37,78 @@ def test_count_tokens_for_image(small_image, large_image):
         assert count_tokens_for_image(large_image, "medium")
     with pytest.raises(ValueError, match="Image must be a base64 string."):
         assert count_tokens_for_image("http://domain.com/image.png")
+
+
+@pytest.mark.parametrize(
+    "format, save_kwargs",
+    [
+        ("PNG", {}),
+        ("GIF", {}),
+        ("JPEG", {}),
+        ("JPEG", {"progressive": True}),
+        # A large application segment before the start-of-frame marker
+        ("JPEG", {"exif": b"Exif\x00\x00" + b"\x00" * 60000}),
+        ("WEBP", {}),
+        ("WEBP", {"lossless": True}),
+        ("WEBP", {"exif": b"Exif\x00\x00" + b"\x00" * 100}),
+    ],
+)
+@pytest.mark.parametrize("size", [(1, 1), (37, 1500), (4000, 3000)])
+def test_sniff_image_dims(format, save_kwargs, size):
+    uri = image_uri(Image.new("RGB", size, "blue"), format, **save_kwargs)
+    assert sniff_image_dims(uri, uri.index(",") + 1) == size
+    assert get_image_dims(uri) == size
+
+
+def test_sniff_image_dims_large_image(large_image):
+    assert sniff_image_dims(large_image, large_image.index(",") + 1) == Image.open("tests/image_large.png").size
+
+
+def test_get_image_dims_fallback():
+    uri = image_uri(Image.new("RGB", (300, 200)), "BMP")
+    assert sniff_image_dims(uri, uri.index(",") + 1) is None
+    assert get_image_dims(uri) == (300, 200)
+
+
+def test_sniff_image_dims_truncated_jpeg():
+    uri = image_uri(Image.new("RGB", (300, 200)), "JPEG")
+    # A JPEG that ends before its start-of-frame marker can't be sniffed
+    assert sniff_image_dims(uri[:40], uri.index(",") + 1) is None
+
+
+def test_get_image_dims_cache():
+    cache: LRUCache[tuple[int, int]] = LRUCache()
+    uri = image_uri(Image.new("RGB", (300, 200)), "BMP")
+    assert get_image_dims(uri, cache) == (300, 200)
+    assert get_image_dims(uri, cache) == (300, 200)
+    assert cache.stats().hits == 1
+    assert cache.stats().misses == 1
+    # Sniffed images don't need the cache
+    assert get_image_dims(image_uri(Image.new("RGB", (300, 200)), "PNG"), cache) == (300, 200)
+    assert cache.stats().misses == 1
+    assert get_image_dims(uri, cache=None) == (300, 200)
+
+
+def test_count_tokens_for_image_reuses_dims():
+    uri = image_uri(Image.new("RGB", (1000, 1000)), "BMP")
+    IMAGE_DIMS_CACHE.clear()
+    assert count_tokens_for_image(uri, "high") == 765
+    assert count_tokens_for_image(uri, "auto", "gpt-4o") == 765
+    assert count_tokens_for_image(uri, "high", "gpt-4o-mini") == 25500
+    assert IMAGE_DIMS_CACHE.stats().misses == 1
+    assert IMAGE_DIMS_CACHE.stats().hits == 2
+
+
+def test_set_image_dims_cache(tmp_path):
+    uri = image_uri(Image.new("RGB", (1000, 1000)), "BMP")
+    cache: SQLiteCache[tuple[int, int]] = SQLiteCache(tmp_path / "cache.db")
+    set_image_dims_cache(cache)
+    try:
+        assert count_tokens_for_image(uri, "high") == 765
+        assert count_tokens_for_image(uri, "high") == 765
+        assert cache.stats().hits == 1
+        set_image_dims_cache(None)
+        assert count_tokens_for_image(uri, "high") == 765
+        assert cache.stats().hits == 1
+    finally:
+        set_image_dims_cache(IMAGE_DIMS_CACHE)
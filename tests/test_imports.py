@@ -0,0 +1,40 @@
+import base64
+import subprocess
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+HEAVY_MODULES = ["openai", "tiktoken", "PIL", "asyncio"]
+PNG_URI = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z/C/HgAGgwJ/lK3Q6wAAAABJRU5ErkJggg=="
+
+
+def bmp_uri() -> str:
+    buffer = BytesIO()
+    Image.new("RGB", (2, 2)).save(buffer, format="BMP")
+    return f"data:image/bmp;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
+
+
+def imported_heavy_modules(statement: str) -> list[str]:
+    # Each statement runs in a fresh interpreter, since the test process has already imported everything
+    check = f"{statement}; import sys; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    process = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True)
+    return process.stdout.split()
+
+
+@pytest.mark.parametrize(
+    "statement, expected",
+    [
+        ("import openai_messages_token_helper", []),
+        ("from openai_messages_token_helper import get_token_limit; get_token_limit('gpt-4o')", []),
+        ("from openai_messages_token_helper import build_messages; build_messages('gpt-4o', 'Hi')", ["tiktoken"]),
+        (f"from openai_messages_token_helper import count_tokens_for_image; count_tokens_for_image('{PNG_URI}')", []),
+        (
+            f"from openai_messages_token_helper import count_tokens_for_image; count_tokens_for_image('{bmp_uri()}')",
+            ["PIL"],
+        ),
+    ],
+)
+def test_lazy_imports(statement, expected):
+    assert imported_heavy_modules(statement) == expected
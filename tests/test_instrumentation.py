@@ -0,0 +1,123 @@
+import pytest
+
+from openai_messages_token_helper import (
+    LRUCache,
+    RecordingTracer,
+    ToolSet,
+    build_messages,
+    build_messages_many,
+    count_tokens_for_message,
+    instrumentation,
+    pack_sources,
+    set_tracer,
+)
+
+from .functions import search_sources_toolchoice_auto
+from .image_messages import text_and_tiny_image_message
+from .messages import assistant_message_perf, system_message_short, user_message_perf, user_message_pm
+
+
+@pytest.fixture
+def tracer():
+    tracer = RecordingTracer()
+    set_tracer(tracer)
+    yield tracer
+    set_tracer(None)
+
+
+def test_build_messages_spans(tracer):
+    past_messages = [user_message_perf["message"], assistant_message_perf["message"]] * 3
+    build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        tools=search_sources_toolchoice_auto["tools"],
+        past_messages=past_messages,
+        new_user_content=text_and_tiny_image_message["message"]["content"],
+        max_tokens=500,
+    )
+    assert [span.name for span in tracer.spans] == [
+        "normalize",
+        "format_tools",
+        "count_tokens_for_image",
+        "count_required",
+        "truncate_history",
+        "build_messages",
+    ]
+    build_span = tracer.spans[-1]
+    phases = [span for span in tracer.spans if span.name in ("normalize", "count_required", "truncate_history")]
+    assert build_span.duration >= sum(span.duration for span in phases)
+    assert build_span.attributes["token_helper.messages_kept"] == 2
+    assert build_span.attributes["token_helper.messages_dropped"] == 4
+    # Each message's role and text, the tools, and only the three newest past messages
+    assert build_span.attributes["token_helper.encode_calls"] == 11
+    assert build_span.attributes["token_helper.encoded_bytes"] > 1000
+    assert build_span.attributes["token_helper.cache_hits"] == 0
+
+
+def test_build_messages_cache_hits(tracer):
+    cache: LRUCache[int] = LRUCache()
+    tool_set = ToolSet(search_sources_toolchoice_auto["tools"])
+    for _ in range(2):
+        build_messages(
+            model="gpt-35-turbo",
+            system_prompt=system_message_short["message"]["content"],
+            tools=tool_set,
+            past_messages=[user_message_perf["message"], assistant_message_perf["message"]],
+            new_user_content=user_message_pm["message"]["content"],
+            cache=cache,
+        )
+    first, second = [span.attributes for span in tracer.spans if span.name == "build_messages"]
+    assert first["token_helper.cache_misses"] == 4
+    assert first["token_helper.encode_calls"] == 9
+    assert second["token_helper.cache_hits"] == 4
+    assert second["token_helper.encode_calls"] == 0
+
+
+def test_build_messages_many_spans(tracer):
+    conversation = {
+        "system_prompt": system_message_short["message"]["content"],
+        "past_messages": [user_message_perf["message"], assistant_message_perf["message"]],
+        "new_user_content": user_message_pm["message"]["content"],
+    }
+    build_messages_many("gpt-35-turbo", [conversation, {**conversation, "max_tokens": 100}])
+    assert [span.name for span in tracer.spans] == ["normalize", "count", "truncate_history", "build_messages_many"]
+    attributes = tracer.spans[-1].attributes
+    assert attributes["token_helper.encode_calls"] == 1
+    assert attributes["token_helper.messages_kept"] == 2
+    assert attributes["token_helper.messages_dropped"] == 2
+
+
+def test_pack_sources_spans(tracer):
+    pack_sources(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        sources=["Ropes are in aisle 3.", "Harnesses are in aisle 4."],
+        past_messages=[user_message_perf["message"], assistant_message_perf["message"]],
+        new_user_content=user_message_pm["message"]["content"],
+    )
+    assert [span.name for span in tracer.spans] == [
+        "normalize",
+        "count_required",
+        "pack_sources",
+        "truncate_history",
+        "build_messages",
+    ]
+    # The role and text of the system, new user and past messages, and the sources in one batch
+    assert tracer.spans[-1].attributes["token_helper.encode_calls"] == 9
+
+
+def test_operation_error(tracer):
+    with pytest.raises(ValueError, match="Unsupported conversation keys"):
+        build_messages_many("gpt-35-turbo", [{"system_prompt": "You are a bot.", "temperature": 0.5}])
+    assert tracer.spans[-1].name == "build_messages_many"
+    assert instrumentation._current_stats.get() is None
+
+
+def test_disabled():
+    assert instrumentation.tracer is None
+    assert instrumentation.phase("normalize") is instrumentation.operation("build_messages")
+    with instrumentation.operation("build_messages") as stats:
+        assert stats is None
+        count_tokens_for_message("gpt-35-turbo", user_message_pm["message"])
+        instrumentation.record_encode("text")
+        instrumentation.record_cache_lookup(True)
@@ -7,7 +7,17 @@ from openai.types.chat import (
     ChatCompletionToolParam,
 )
 
-from openai_messages_token_helper import build_messages, count_tokens_for_message
+from openai_messages_token_helper import (
+    LRUCache,
+    build_messages,
+    build_messages_many,
+    build_messages_with_report,
+    count_tokens_for_message,
+    count_tokens_for_messages,
+    count_tokens_for_system_and_tools,
+    pack_sources,
+)
+from openai_messages_token_helper.model_helper import encoding_for_model
 
 from .functions import search_sources_toolchoice_auto
 from .image_messages import text_and_tiny_image_message
@@ -335,3 +345,403 @@ def test_messagebuilder_typing() -> None:
     assert isinstance(messages, list)
     if hasattr(typing, "assert_type"):
         typing.assert_type(messages[0], ChatCompletionMessageParam)
+
+
+def test_messagebuilder_cache():
+    cache: LRUCache[int] = LRUCache()
+    past_messages: list[ChatCompletionMessageParam] = []
+    for turn in range(200):
+        new_user_content = f"Question number {turn}"
+        build_messages(
+            model="gpt-35-turbo",
+            system_prompt=system_message_short["message"]["content"],
+            new_user_content=new_user_content,
+            past_messages=past_messages,
+            cache=cache,
+        )
+        past_messages.append({"role": "user", "content": new_user_content})
+        past_messages.append({"role": "assistant", "content": f"Answer number {turn}"})
+    stats = cache.stats()
+    # Every message is encoded once: the system prompt, plus each new user message and answer
+    assert stats.misses == 1 + 200 + 199
+    assert stats.entries == stats.misses
+
+    uncached = build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        max_tokens=500,
+    )
+    cached = build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        max_tokens=500,
+        cache=cache,
+    )
+    assert cached == uncached
+
+
+def test_messagebuilder_pastmessages_tools():
+    past_messages: list[ChatCompletionMessageParam] = [
+        {"role": "user", "content": "good options for climbing gear that can be used outside?"},
+        {
+            "role": "assistant",
+            "tool_calls": [
+                {
+                    "id": "call_abc123",
+                    "type": "function",
+                    "function": {"arguments": '{"search_query":"climbing gear outside"}', "name": "search_database"},
+                }
+            ],
+        },
+        {"role": "tool", "tool_call_id": "call_abc123", "content": "Search results for climbing gear: ..."},
+        {"role": "assistant", "content": "Here are some options for climbing gear."},
+    ]
+    messages = build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+    )
+    assert messages == [system_message_short["message"], *past_messages, user_message_pm["message"]]
+
+
+def test_messagebuilder_pastmessages_error():
+    with pytest.raises(ValueError, match="Invalid message for builder"):
+        build_messages(
+            model="gpt-35-turbo",
+            system_prompt=system_message_short["message"]["content"],
+            past_messages=[{"role": "tool", "content": "Results"}],  # type: ignore[typeddict-item]
+        )
+
+
+@pytest.mark.parametrize("max_tokens", [10, 69, 160, 3000])
+def test_messagebuilder_past_message_counts(max_tokens):
+    past_messages = [
+        user_message_perf["message"],
+        assistant_message_perf["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+    ]
+    expected = build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=max_tokens,
+    )
+    messages = build_messages(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=max_tokens,
+        past_message_counts=count_tokens_for_messages("gpt-35-turbo", past_messages),
+    )
+    assert messages == expected
+
+
+def test_messagebuilder_past_message_counts_error():
+    with pytest.raises(ValueError, match="past_message_counts must have one count for each past message"):
+        build_messages(
+            model="gpt-35-turbo",
+            system_prompt=system_message_short["message"]["content"],
+            past_messages=[user_message_perf["message"]],
+            past_message_counts=[],
+        )
+
+
+def test_messagebuilder_many():
+    past_messages = [
+        user_message_perf["message"],
+        assistant_message_perf["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+    ]
+    conversations: list[dict[str, typing.Any]] = [
+        {"system_prompt": system_message_short["message"]["content"]},
+        {
+            "system_prompt": system_message_short["message"]["content"],
+            "past_messages": past_messages,
+            "new_user_content": user_message_pm["message"]["content"],
+            "max_tokens": 69,
+        },
+        {
+            "system_prompt": search_sources_toolchoice_auto["system_message"]["content"],
+            "tools": search_sources_toolchoice_auto["tools"],
+            "tool_choice": search_sources_toolchoice_auto["tool_choice"],
+            "past_messages": past_messages,
+            "new_user_content": text_and_tiny_image_message["message"]["content"],
+        },
+        {
+            "system_prompt": system_message_unicode["message"]["content"],
+            "few_shots": [
+                {"role": "user", "content": "How did crypto do last year?"},
+                {"role": "assistant", "content": "Summarize Cryptocurrency Market Dynamics from last year"},
+            ],
+            "past_messages": past_messages,
+            "new_user_content": user_message_unicode["message"]["content"],
+            "tool_choice": "none",
+        },
+    ]
+    cache: LRUCache[int] = LRUCache()
+    all_messages = build_messages_many("gpt-4o", conversations, max_tokens=200, cache=cache, num_threads=2)
+    assert all_messages == [
+        build_messages("gpt-4o", **{"max_tokens": 200, **conversation}) for conversation in conversations
+    ]
+    assert len(all_messages[1]) == 4
+    # Messages repeated across conversations are only encoded once
+    assert cache.stats().misses == cache.stats().entries == 11
+
+
+def test_messagebuilder_many_max_tokens_none():
+    conversation = {
+        "system_prompt": system_message_short["message"]["content"],
+        "past_messages": [user_message_perf["message"], assistant_message_perf["message"]],
+        "new_user_content": user_message["message"]["content"],
+    }
+    # A conversation's max_tokens of None falls back to the shared max_tokens, and then to the model's limit
+    assert build_messages_many("gpt-4o", [{**conversation, "max_tokens": None}], max_tokens=30) == [
+        build_messages("gpt-4o", **{**conversation, "max_tokens": 30})
+    ]
+    assert build_messages_many("gpt-4o", [{**conversation, "max_tokens": None}]) == [
+        build_messages("gpt-4o", **conversation)
+    ]
+
+
+def test_messagebuilder_many_error():
+    with pytest.raises(ValueError, match="Unsupported conversation keys: model, temperature"):
+        build_messages_many(
+            "gpt-4o", [{"system_prompt": "You are a bot.", "model": "gpt-4", "temperature": 0.5}]  # type: ignore
+        )
+
+
+@pytest.mark.parametrize("max_tokens", [69, 160, 3000])
+@pytest.mark.parametrize("with_counts", [False, True])
+def test_messagebuilder_with_report(max_tokens, with_counts):
+    past_messages = [
+        user_message_perf["message"],
+        assistant_message_perf["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+    ]
+    kwargs = dict(
+        model="gpt-35-turbo",
+        system_prompt=system_message_short["message"]["content"],
+        tools=search_sources_toolchoice_auto["tools"],
+        tool_choice=search_sources_toolchoice_auto["tool_choice"],
+        few_shots=[user_message["message"], assistant_message_perf_short["message"]],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=max_tokens + 200,
+    )
+    if with_counts:
+        kwargs["past_message_counts"] = count_tokens_for_messages("gpt-35-turbo", past_messages)
+    result = build_messages_with_report(**kwargs)
+    kwargs.pop("past_message_counts", None)
+    assert result.messages == build_messages(**kwargs)
+    assert result.message_token_counts == [
+        count_tokens_for_message("gpt-35-turbo", message) for message in result.messages
+    ]
+    assert result.system_and_tools_token_count == count_tokens_for_system_and_tools(
+        "gpt-35-turbo",
+        result.messages[0],
+        search_sources_toolchoice_auto["tools"],
+        search_sources_toolchoice_auto["tool_choice"],
+    )
+    assert result.prompt_tokens == sum(result.message_token_counts) + result.tools_token_count
+    assert result.prompt_tokens <= max_tokens + 200
+    kept_count = len(result.messages) - 4
+    assert result.messages[3 : 3 + kept_count] == past_messages[len(past_messages) - kept_count :]
+    assert result.dropped_count == len(past_messages) - kept_count
+    assert result.truncation_index == (result.dropped_count or None)
+
+
+@pytest.mark.parametrize("keep", ["head", "tail", "middle"])
+def test_messagebuilder_truncate_newest_message(keep):
+    long_content = "A long pasted document. " * 1000
+    result = build_messages_with_report(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=[user_message_perf["message"], assistant_message_perf["message"]],
+        new_user_content=long_content,
+        max_tokens=500,
+        truncate_newest_message=keep,
+    )
+    assert result.dropped_count == 2
+    assert result.messages[-1]["role"] == "user"
+    assert len(result.messages[-1]["content"]) < len(long_content)
+    assert 490 <= result.prompt_tokens <= 500
+    assert result.message_token_counts[-1] == count_tokens_for_message("gpt-4o", result.messages[-1])
+
+
+@pytest.mark.parametrize("fits", [False, True])
+def test_messagebuilder_truncate_newest_message_encodes_once(monkeypatch, fits):
+    long_content = "A long pasted document. " * 1000
+    tool_result = "Search result for climbing gear. " * 1000
+    encoding = encoding_for_model("gpt-4o")
+    encoded_texts = []
+
+    def encode(text, **kwargs):
+        encoded_texts.append(text)
+        return type(encoding).encode(encoding, text, **kwargs)
+
+    monkeypatch.setattr(encoding, "encode", encode)
+    max_tokens = 20_000 if fits else 500
+    build_messages(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        new_user_content=long_content,
+        max_tokens=max_tokens,
+        truncate_newest_message="tail",
+    )
+    # The long text is encoded once, both to count the new message and to truncate it
+    assert encoded_texts.count(long_content) == 1
+    build_messages(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=[
+            {"role": "user", "content": "Find climbing gear"},
+            {"role": "tool", "tool_call_id": "call_abc123", "content": tool_result},
+        ],
+        max_tokens=max_tokens,
+        truncate_newest_message="tail",
+    )
+    # So is a tool result, which isn't counted again when the history is truncated
+    assert encoded_texts.count(tool_result) == 1
+
+
+def test_messagebuilder_truncate_newest_message_parts():
+    content = [
+        {"type": "text", "text": "Describe this image. " * 500},
+        *text_and_tiny_image_message["message"]["content"][1:],
+    ]
+    messages = build_messages(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        new_user_content=content,  # type: ignore[arg-type]
+        max_tokens=400,
+        truncate_newest_message="head",
+    )
+    assert messages[1]["content"][1] == content[1]
+    assert len(messages[1]["content"][0]["text"]) < len(content[0]["text"])
+    assert content[0]["text"] == "Describe this image. " * 500
+    assert sum(count_tokens_for_message("gpt-4o", message) for message in messages) <= 400
+
+
+@pytest.mark.parametrize("with_counts", [False, True])
+def test_messagebuilder_truncate_newest_tool_message(with_counts):
+    past_messages: list[ChatCompletionMessageParam] = [
+        {"role": "user", "content": "Find climbing gear"},
+        {
+            "role": "assistant",
+            "tool_calls": [
+                {"id": "call_abc123", "type": "function", "function": {"arguments": "{}", "name": "search"}}
+            ],
+        },
+        {"role": "tool", "tool_call_id": "call_abc123", "content": "Search result for climbing gear. " * 1000},
+    ]
+    kwargs: dict[str, typing.Any] = dict(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        max_tokens=300,
+    )
+    if with_counts:
+        kwargs["past_message_counts"] = count_tokens_for_messages("gpt-4o", past_messages)
+    assert build_messages(**kwargs) == [system_message_short["message"]]
+    messages = build_messages(**kwargs, truncate_newest_message="tail")
+    # The assistant message with the tool call is kept, so the tool result isn't orphaned
+    assert [message["role"] for message in messages] == ["system", "assistant", "tool"]
+    assert messages[1] == past_messages[1]
+    assert past_messages[-1]["content"].endswith(messages[-1]["content"])
+    assert 250 < sum(count_tokens_for_message("gpt-4o", message) for message in messages) <= 300
+
+
+def test_messagebuilder_truncate_newest_parallel_tool_messages():
+    tool_calls = [
+        {"id": f"call_{i}", "type": "function", "function": {"arguments": "{}", "name": "search"}} for i in range(2)
+    ]
+    past_messages: list[ChatCompletionMessageParam] = [
+        {"role": "user", "content": "Find climbing gear"},
+        {"role": "assistant", "tool_calls": tool_calls},  # type: ignore[typeddict-item]
+        {"role": "tool", "tool_call_id": "call_0", "content": "No results."},
+        {"role": "tool", "tool_call_id": "call_1", "content": "Search result for climbing gear. " * 1000},
+    ]
+    result = build_messages_with_report(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        max_tokens=200,
+        truncate_newest_message="tail",
+    )
+    assert [message["role"] for message in result.messages] == ["system", "assistant", "tool", "tool"]
+    assert result.messages[1:3] == past_messages[1:3]
+    assert result.message_token_counts[-1] == count_tokens_for_message("gpt-4o", result.messages[-1])
+    assert result.prompt_tokens <= 200
+
+
+SOURCES = [
+    f"source{i}.pdf: The climbing gear in aisle {i} includes {'ropes, harnesses and shoes, ' * (2 * i + 4)}"
+    for i in range(8)
+]
+
+
+@pytest.mark.parametrize("sources_share", [0.3, 0.6, 1.0])
+def test_messagebuilder_pack_sources(sources_share):
+    past_messages = [
+        user_message_perf["message"],
+        assistant_message_perf["message"],
+        user_message_dresscode["message"],
+        assistant_message_dresscode["message"],
+    ]
+    kwargs: dict[str, typing.Any] = dict(
+        model="gpt-4o",
+        system_prompt=system_message_short["message"]["content"],
+        past_messages=past_messages,
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=400,
+    )
+    pack = pack_sources(**kwargs, sources=SOURCES, sources_share=sources_share)
+    required_token_count = sum(
+        count_tokens_for_message("gpt-4o", message) for message in [pack.messages[0], pack.messages[-1]]
+    )
+    remaining_token_count = 400 - required_token_count
+    encoding = encoding_for_model("gpt-4o")
+    assert pack.source_token_counts == [len(encoding.encode(source)) for source in pack.sources]
+    assert 0 < pack.sources_token_count <= remaining_token_count * sources_share
+    assert pack.sources[:-1] == SOURCES[: len(pack.sources) - 1]
+    assert pack.truncated
+    assert SOURCES[len(pack.sources) - 1].startswith(pack.sources[-1])
+    # The history gets the rest of the tokens, including what the sources didn't use
+    assert pack.messages == build_messages(**{**kwargs, "max_tokens": 400 - pack.sources_token_count})
+
+
+def test_messagebuilder_pack_sources_all_fit():
+    pack = pack_sources(
+        "gpt-4o", system_message_short["message"]["content"], sources=SOURCES[:2], new_user_content="Any ropes?"
+    )
+    assert pack.sources == SOURCES[:2]
+    assert not pack.truncated
+
+
+def test_messagebuilder_pack_sources_without_truncation():
+    kwargs: dict[str, typing.Any] = dict(
+        model="gpt-4o", system_prompt=system_message_short["message"]["content"], sources=SOURCES, max_tokens=300
+    )
+    truncated_pack = pack_sources(**kwargs)
+    pack = pack_sources(**kwargs, truncate_last_source=False)
+    assert pack.sources == truncated_pack.sources[:-1] == SOURCES[: len(pack.sources)]
+    assert not pack.truncated
+
+
+def test_messagebuilder_pack_sources_no_room():
+    pack = pack_sources("gpt-4o", system_message_long["message"]["content"], sources=SOURCES, max_tokens=10)
+    assert pack.sources == []
+    assert pack.sources_token_count == 0
+
+
+def test_messagebuilder_pack_sources_error():
+    with pytest.raises(ValueError, match="sources_share must be between 0 and 1"):
+        pack_sources("gpt-4o", "You are a bot.", sources=SOURCES, sources_share=1.5)
@@ -1,10 +1,20 @@
 import pytest
 
-from openai_messages_token_helper import count_tokens_for_message, count_tokens_for_system_and_tools, get_token_limit
+from openai_messages_token_helper import (
+    LRUCache,
+    count_tokens_for_message,
+    count_tokens_for_messages,
+    count_tokens_for_system_and_tools,
+    get_token_limit,
+    preload,
+    truncate_text_to_tokens,
+    warmup,
+)
+from openai_messages_token_helper.model_helper import _ENCODINGS, MODELS_2_TOKEN_LIMITS, encoding_for_model
 
 from .functions import FUNCTION_COUNTS, search_sources_toolchoice_auto
 from .image_messages import IMAGE_MESSAGE_COUNTS
-from .messages import system_message, system_message_with_name, user_message
+from .messages import system_message, system_message_unicode, system_message_with_name, user_message
 
 
 def test_get_token_limit():
@@ -153,3 +163,138 @@ def test_count_tokens_for_message_non_reasoning_model_no_warning(caplog):
         warning_messages = [record.message for record in caplog.records if record.levelname == "WARNING"]
         reasoning_warnings = [msg for msg in warning_messages if "reasoning model" in msg]
         assert len(reasoning_warnings) == 0
+
+
+def test_count_tokens_for_message_cache():
+    cache: LRUCache[int] = LRUCache()
+    assert count_tokens_for_message("gpt-4", user_message["message"], cache=cache) == user_message["count"]
+    assert count_tokens_for_message("gpt-4", user_message["message"], cache=cache) == user_message["count"]
+    assert cache.stats().hits == 1
+    assert cache.stats().misses == 1
+    # Models with different encodings don't share entries
+    assert count_tokens_for_message("gpt-4o", user_message["message"], cache=cache) == user_message["count_omni"]
+    assert cache.stats().misses == 2
+
+
+def test_count_tokens_for_message_cache_image_models():
+    cache: LRUCache[int] = LRUCache()
+    for message_count_pair in IMAGE_MESSAGE_COUNTS:
+        message = message_count_pair["message"]
+        assert count_tokens_for_message("gpt-4o", message, cache=cache) == message_count_pair["count"]
+        # gpt-4o-mini shares the encoding of gpt-4o, but charges differently for images
+        assert count_tokens_for_message("gpt-4o-mini", message, cache=cache) == message_count_pair["count_4o_mini"]
+
+
+def test_count_tokens_for_message_limit():
+    cache: LRUCache[int] = LRUCache()
+    message = {"role": "user", "content": "A line of a long pasted log\n" * 10_000}
+    count = count_tokens_for_message("gpt-4o", message)
+    assert count_tokens_for_message("gpt-4o", message, limit=count) == count
+    # Counts over the limit are partial, and aren't cached
+    partial_count = count_tokens_for_message("gpt-4o", message, cache=cache, limit=100)
+    assert 100 < partial_count < count
+    assert len(cache) == 0
+    assert count_tokens_for_message("gpt-4o", message, cache=cache, limit=count + 1) == count
+    assert count_tokens_for_message("gpt-4o", message, cache=cache, limit=100) == count
+    assert count_tokens_for_message("gpt-4o", user_message["message"], limit=1) > 1
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "gpt-4o"])
+def test_count_tokens_for_message_parallel(model):
+    message = {"role": "tool", "tool_call_id": "call_1", "content": "A line of a large tool result\n" * 20_000}
+    count = count_tokens_for_message(model, message)
+    assert count_tokens_for_message(model, message, parallel_min_chars=100_000, num_threads=4) == count
+    partial_count = count_tokens_for_message(model, message, limit=100, parallel_min_chars=100_000)
+    assert 100 < partial_count < count
+    messages = [user_message["message"], message]
+    assert count_tokens_for_messages(model, messages, parallel_min_chars=100_000) == count_tokens_for_messages(
+        model, messages
+    )
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "gpt-4o", "gpt-4o-mini"])
+def test_count_tokens_for_messages(model):
+    messages = [
+        user_message["message"],
+        system_message_with_name["message"],
+        system_message_unicode["message"],
+        *[message_count_pair["message"] for message_count_pair in IMAGE_MESSAGE_COUNTS],
+    ]
+    assert count_tokens_for_messages(model, messages) == [
+        count_tokens_for_message(model, message) for message in messages
+    ]
+    assert count_tokens_for_messages(model, []) == []
+
+
+def test_count_tokens_for_messages_cache():
+    cache: LRUCache[int] = LRUCache()
+    count_tokens_for_message("gpt-4", user_message["message"], cache=cache)
+    counts = count_tokens_for_messages("gpt-4", [user_message["message"], system_message["message"]], cache=cache)
+    assert counts == [user_message["count"], system_message["count"]]
+    assert cache.stats().hits == 1
+    assert count_tokens_for_message("gpt-4", system_message["message"], cache=cache) == system_message["count"]
+    assert cache.stats().hits == 2
+    # Messages repeated within a batch are only encoded once
+    cache.clear()
+    counts = count_tokens_for_messages("gpt-4", [system_message["message"]] * 3, cache=cache)
+    assert counts == [system_message["count"]] * 3
+    assert cache.stats().misses == 1
+
+
+def test_encoding_for_model_memoized():
+    encoding = encoding_for_model("gpt-4")
+    assert encoding.name == "cl100k_base"
+    assert encoding_for_model("gpt-4") is encoding
+    assert encoding_for_model("gpt-35-turbo") is encoding
+    assert encoding_for_model("gpt-4o").name == "o200k_base"
+
+
+def test_encoding_for_model_memoized_fallback(caplog):
+    with caplog.at_level("WARNING"):
+        assert encoding_for_model("mistral-7b", default_to_cl100k=True).name == "cl100k_base"
+        caplog.clear()
+        assert encoding_for_model("mistral-7b", default_to_cl100k=True).name == "cl100k_base"
+        # The warning is still logged when the memoized fallback is used
+        assert "Model mistral-7b not found, defaulting to CL100k encoding" in caplog.text
+    # A memoized fallback doesn't apply when the caller doesn't ask for it
+    with pytest.raises(ValueError, match="Expected valid OpenAI GPT model name"):
+        encoding_for_model("mistral-7b")
+
+
+def test_preload():
+    encodings = preload(["gpt-4", "gpt-4o"])
+    assert {model: encoding.name for model, encoding in encodings.items()} == {
+        "gpt-4": "cl100k_base",
+        "gpt-4o": "o200k_base",
+    }
+    assert encodings["gpt-4o"] is encoding_for_model("gpt-4o")
+    assert preload().keys() == MODELS_2_TOKEN_LIMITS.keys()
+
+
+def test_warmup():
+    warmup(["gpt-4", "phi-3"], default_to_cl100k=True)
+    assert ("phi-3", True) in _ENCODINGS
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "gpt-4o"])
+@pytest.mark.parametrize("keep", ["head", "tail", "middle"])
+def test_truncate_text_to_tokens(model, keep):
+    encoding = encoding_for_model(model)
+    text = "Ünïcödé 日本語 🎉 and some plain words, to be truncated. " * 20
+    assert truncate_text_to_tokens(text, 10_000, model, keep) == text
+    assert truncate_text_to_tokens(text, 0, model, keep) == ""
+    for max_tokens in [1, 2, 5, 17, 100]:
+        truncated_text = truncate_text_to_tokens(text, max_tokens, model, keep)
+        assert 0 < len(encoding.encode(truncated_text)) <= max_tokens
+        if keep == "head":
+            assert text.startswith(truncated_text)
+        elif keep == "tail":
+            assert text.endswith(truncated_text)
+    assert truncate_text_to_tokens(text, 6, model, "middle") == (
+        truncate_text_to_tokens(text, 3, model, "head") + truncate_text_to_tokens(text, 3, model, "tail")
+    )
+
+
+def test_truncate_text_to_tokens_error():
+    with pytest.raises(ValueError, match="Unsupported keep value: end"):
+        truncate_text_to_tokens("Hello", 1, "gpt-4o", "end")  # type: ignore[arg-type]
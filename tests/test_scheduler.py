@@ -0,0 +1,230 @@
+import asyncio
+import random
+from collections import deque
+
+import pytest
+
+from openai_messages_token_helper import Deployment, TPMScheduler, build_messages_with_report
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        assert seconds > 0
+        self.now += seconds
+
+    async def async_sleep(self, seconds: float):
+        self.sleep(seconds)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class FakeClient:
+    """
+    A fake chat completions client for several deployments, which enforces their tokens per minute
+    over a sliding minute like a real service, and reports usage with fewer completion tokens than the maximum.
+    """
+
+    def __init__(self, clock: FakeClock, deployments: list[Deployment], counts_max_tokens: bool, seed: int = 0):
+        self.clock = clock
+        self.limits = {deployment.name: deployment.tokens_per_minute for deployment in deployments}
+        self.counted: dict[str, deque[tuple[float, int]]] = {name: deque() for name in self.limits}
+        # Whether the service counts a request's maximum completion tokens, or its actual usage
+        self.counts_max_tokens = counts_max_tokens
+        self.rng = random.Random(seed)
+        self.requests: dict[str, int] = {name: 0 for name in self.limits}
+        self.counted_tokens = 0
+
+    def create(self, deployment: str, prompt_tokens: int, max_tokens: int) -> dict:
+        completion_tokens = self.rng.randint(1, max_tokens)
+        counted_tokens = prompt_tokens + (max_tokens if self.counts_max_tokens else completion_tokens)
+        counted = self.counted[deployment]
+        while counted and counted[0][0] <= self.clock.now - 60:
+            counted.popleft()
+        if sum(tokens for _, tokens in counted) + counted_tokens > self.limits[deployment]:
+            raise RateLimitError(deployment)
+        counted.append((self.clock.now, counted_tokens))
+        self.requests[deployment] += 1
+        self.counted_tokens += counted_tokens
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+
+DEPLOYMENTS = [Deployment("eastus", 30_000), Deployment("westus", 10_000)]
+
+
+def run_requests(scheduler: TPMScheduler, client: FakeClient, count: int) -> int:
+    rng = random.Random(1)
+    errors = 0
+    for _ in range(count):
+        prompt_tokens, max_tokens = rng.randint(100, 1000), 500
+        reservation = scheduler.acquire(prompt_tokens, max_tokens)
+        try:
+            usage = client.create(reservation.deployment, prompt_tokens, max_tokens)
+        except RateLimitError:
+            errors += 1
+            scheduler.release(reservation)
+            continue
+        scheduler.reconcile(reservation, usage)
+    return errors
+
+
+@pytest.mark.parametrize("counts_max_tokens", [False, True])
+def test_scheduler_avoids_rate_limits(counts_max_tokens):
+    clock = FakeClock()
+    client = FakeClient(clock, DEPLOYMENTS, counts_max_tokens)
+    scheduler = TPMScheduler(DEPLOYMENTS, refund_unused=not counts_max_tokens, clock=clock, sleep=clock.sleep)
+    assert run_requests(scheduler, client, 400) == 0
+    assert scheduler.outstanding == []
+    # Requests are spread across the deployments in proportion to their limits
+    assert 2.5 < client.requests["eastus"] / client.requests["westus"] < 3.5
+    # The requests take about as long as their counted tokens at the combined limit
+    assert clock.now <= 60 * client.counted_tokens / 40_000 + 60
+
+
+def test_scheduler_refund_unused_raises_throughput():
+    elapsed = []
+    for refund_unused in (False, True):
+        clock = FakeClock()
+        client = FakeClient(clock, DEPLOYMENTS, counts_max_tokens=False)
+        scheduler = TPMScheduler(DEPLOYMENTS, refund_unused=refund_unused, clock=clock, sleep=clock.sleep)
+        assert run_requests(scheduler, client, 400) == 0
+        elapsed.append(clock.now)
+    assert elapsed[1] < elapsed[0] * 0.9
+
+
+def test_scheduler_without_refunds_trips_rate_limits():
+    clock = FakeClock()
+    client = FakeClient(clock, DEPLOYMENTS, counts_max_tokens=True)
+    # Refunding unused tokens to a service that counts the maximum completion tokens admits too much
+    scheduler = TPMScheduler(DEPLOYMENTS, refund_unused=True, clock=clock, sleep=clock.sleep)
+    assert run_requests(scheduler, client, 400) > 0
+
+
+def test_scheduler_try_reserve():
+    clock = FakeClock()
+    scheduler = TPMScheduler(DEPLOYMENTS, clock=clock)
+    first = scheduler.try_reserve(20_000)
+    assert first is not None and first.deployment == "eastus"
+    # The next request goes to the deployment with the most tokens left
+    second = scheduler.try_reserve(5_000, 1_000)
+    assert second is not None and second.deployment == "westus"
+    assert second.tokens == 6_000
+    assert scheduler.available_tokens() == {"eastus": 10_000, "westus": 4_000}
+    assert scheduler.try_reserve(15_000) is None
+    clock.now = 60
+    assert scheduler.available_tokens() == {"eastus": 30_000, "westus": 10_000}
+    assert scheduler.try_reserve(15_000) is not None
+
+
+def test_scheduler_reconcile():
+    clock = FakeClock()
+    scheduler = TPMScheduler([Deployment("eastus", 10_000)], clock=clock)
+    reservation = scheduler.acquire(1_000, 4_000)
+    scheduler.reconcile(reservation, {"total_tokens": 1_500})
+    assert scheduler.available_tokens() == {"eastus": 8_500}
+    with pytest.raises(ValueError, match="Reservation is not outstanding"):
+        scheduler.reconcile(reservation, {"total_tokens": 1_500})
+    # Usage over the reservation takes more tokens, and usage of None keeps the reservation
+    reservation = scheduler.acquire(1_000, 1_000)
+    scheduler.reconcile(reservation, {"total_tokens": 2_500})
+    reservation = scheduler.acquire(1_000)
+    scheduler.reconcile(reservation, None)
+    assert scheduler.available_tokens() == {"eastus": 5_000}
+    reservation = scheduler.acquire(1_000)
+    scheduler.release(reservation)
+    assert scheduler.available_tokens() == {"eastus": 5_000}
+    # Reconciling after the window has passed doesn't free tokens in the new window
+    reservation = scheduler.acquire(1_000, 1_000)
+    clock.now = 61
+    scheduler.reconcile(reservation, {"total_tokens": 10})
+    assert scheduler.available_tokens() == {"eastus": 10_000}
+
+
+def test_scheduler_requests_per_minute():
+    clock = FakeClock()
+    scheduler = TPMScheduler([Deployment("eastus", 100_000, requests_per_minute=6)], window_seconds=10, clock=clock)
+    assert scheduler.try_reserve(100) is not None
+    assert scheduler.try_reserve(100) is None
+    clock.now = 10
+    assert scheduler.try_reserve(100) is not None
+
+
+def test_scheduler_requests_per_minute_short_window():
+    clock = FakeClock()
+    # A 10 second window is too short for one of 5 requests per minute, so requests are 12 seconds apart
+    scheduler = TPMScheduler(
+        [Deployment("eastus", 60_000, requests_per_minute=5)], window_seconds=10, clock=clock, sleep=clock.sleep
+    )
+    assert scheduler.try_reserve(100) is not None
+    assert scheduler.try_reserve(100) is None
+    assert scheduler.acquire(100, timeout=60) is not None
+    assert clock.now == 12
+
+
+def test_scheduler_cooldown():
+    clock = FakeClock()
+    scheduler = TPMScheduler(DEPLOYMENTS, clock=clock, sleep=clock.sleep)
+    scheduler.cooldown("eastus", 30)
+    assert scheduler.acquire(100).deployment == "westus"
+    scheduler.cooldown("westus", 10)
+    assert scheduler.acquire(100).deployment == "westus"
+    assert clock.now == 10
+
+
+def test_scheduler_acquire_timeout():
+    clock = FakeClock()
+    scheduler = TPMScheduler([Deployment("eastus", 10_000)], clock=clock, sleep=clock.sleep)
+    scheduler.acquire(10_000)
+    with pytest.raises(TimeoutError):
+        scheduler.acquire(1_000, timeout=5)
+    assert clock.now == 5
+    assert scheduler.acquire(1_000, timeout=60).deployment == "eastus"
+    assert clock.now == 60
+
+
+def test_scheduler_async_acquire():
+    clock = FakeClock()
+    scheduler = TPMScheduler([Deployment("eastus", 10_000)], clock=clock, async_sleep=clock.async_sleep)
+
+    async def acquire_all():
+        return [await scheduler.async_acquire(4_000) for _ in range(3)]
+
+    reservations = asyncio.run(acquire_all())
+    assert len(reservations) == 3
+    assert clock.now == 60
+
+
+def test_scheduler_with_build_messages():
+    clock = FakeClock()
+    scheduler = TPMScheduler([Deployment("gpt-4o", 10_000)], clock=clock)
+    result = build_messages_with_report("gpt-4o", "You are a bot.", new_user_content="Hello!")
+    reservation = scheduler.acquire(result.prompt_tokens, 1_000)
+    assert reservation.prompt_tokens == result.prompt_tokens
+    assert scheduler.available_tokens() == {"gpt-4o": 10_000 - 1_000 - result.prompt_tokens}
+
+
+def test_scheduler_errors():
+    with pytest.raises(ValueError, match="At least one deployment is required"):
+        TPMScheduler([])
+    with pytest.raises(ValueError, match="Deployment names must be unique"):
+        TPMScheduler([Deployment("eastus", 1_000), Deployment("eastus", 2_000)])
+    with pytest.raises(ValueError, match="Rate limits and window_seconds must be positive"):
+        TPMScheduler([Deployment("eastus", 0)])
+    with pytest.raises(ValueError, match="Rate limits and window_seconds must be positive"):
+        TPMScheduler([Deployment("eastus", 1_000, requests_per_minute=0)])
+    scheduler = TPMScheduler(DEPLOYMENTS)
+    with pytest.raises(ValueError, match="Token counts must not be negative"):
+        scheduler.try_reserve(-1)
+    with pytest.raises(ValueError, match="over the rate limit of every deployment"):
+        scheduler.acquire(30_001)
@@ -0,0 +1,116 @@
+import random
+from itertools import zip_longest
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+
+from openai_messages_token_helper import StreamingTokenCounter
+from openai_messages_token_helper.model_helper import encoding_for_model
+from openai_messages_token_helper.stream_helper import _StreamedText
+
+TEXT = (
+    "Here are some options for climbing gear that can be used outside:\n\n"
+    "1. **Harness**: A comfortable harness, like the Black Diamond Momentum.\n"
+    "2. **Shoes**: Shoes with sticky rubber soles.\n/path/to/file\n"
+    "```python\ndef climb(height: int) -> str:\n    return f'Climbed {height}m!'\n```\n"
+    "Ünïcödé text, 日本語, and emoji 🎉 work too. "
+) * 10
+
+RUSSIAN = "Это предложение о снаряжении для скалолазания. Верёвка, обвязка и карабины! " * 250
+CHINESE = "这是一个关于攀岩装备的句子。绳子、安全带和铁锁都很重要！" * 700
+# A long run of text without any safe boundary
+HAN_RUN = "".join(random.Random(0).choice("这是一个关于攀岩装备的句子绳子安全带和铁锁都很重要") for _ in range(20_000))
+
+
+class CountingEncoding:
+    """An encoding that counts the characters it encodes."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.encoded_chars = 0
+
+    def encode(self, text):
+        self.encoded_chars += len(text)
+        return self.encoding.encode(text)
+
+    def encode_ordinary(self, text):
+        self.encoded_chars += len(text)
+        return self.encoding.encode_ordinary(text)
+
+    def decode_bytes(self, tokens):
+        return self.encoding.decode_bytes(tokens)
+
+
+def stream(text, seed=0):
+    rng = random.Random(seed)
+    index = 0
+    while index < len(text):
+        size = rng.randint(1, 12)
+        yield text[index : index + size]
+        index += size
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o"])
+def test_streaming_token_counter_content(model):
+    encoding = encoding_for_model(model)
+    counter = StreamingTokenCounter(model)
+    streamed = ""
+    for delta in stream(TEXT):
+        streamed += delta
+        assert counter.add_content(delta) == len(encoding.encode(streamed))
+    assert counter.add_content("") == len(encoding.encode(TEXT))
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o"])
+@pytest.mark.parametrize("text", [RUSSIAN, CHINESE, HAN_RUN], ids=["russian", "chinese", "no_boundaries"])
+def test_streamed_text_non_latin(model, text):
+    encoding = CountingEncoding(encoding_for_model(model))
+    streamed_text = _StreamedText(encoding)
+    for index in range(0, len(text), 4):
+        streamed_text.add(text[index : index + 4])
+        if index % 4000 == 0:
+            assert streamed_text.token_count == len(encoding.encoding.encode(text[: index + 4]))
+    assert streamed_text.token_count == len(encoding.encoding.encode(text))
+    # Each delta only re-encodes a short tail, instead of all the text so far
+    assert len(streamed_text.pending) <= 256
+    assert encoding.encoded_chars < 50 * len(text)
+
+
+def test_streaming_token_counter_tool_calls():
+    encoding = encoding_for_model("gpt-4o")
+    arguments = ['{"search_query":"climbing gear outside"}', '{"search_query":"hiking boots", "limit": 10}']
+    counter = StreamingTokenCounter("gpt-4o")
+    for deltas in zip_longest(stream(arguments[0], seed=1), stream(arguments[1], seed=2), fillvalue=""):
+        for index, delta in enumerate(deltas):
+            counter.add_tool_call_arguments(index, delta)
+    assert counter.token_count == sum(len(encoding.encode(text)) for text in arguments)
+
+
+def test_streaming_token_counter_chunks():
+    encoding = encoding_for_model("gpt-4o")
+    counter = StreamingTokenCounter("gpt-4o")
+
+    def chunk(delta):
+        return ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-123",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "gpt-4o",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+            }
+        )
+
+    counter.add_chunk(chunk({"role": "assistant", "content": ""}))
+    counter.add_chunk(chunk({"content": "Let me search "}))
+    counter.add_chunk(chunk({"content": "for that."}))
+    tool_call = {"index": 0, "id": "call_abc123", "type": "function", "function": {"name": "search", "arguments": ""}}
+    counter.add_chunk(chunk({"tool_calls": [tool_call]}))
+    counter.add_chunk(chunk({"tool_calls": [{"index": 0, "function": {"arguments": '{"query":'}}]}))
+    counter.add_chunk(chunk({"tool_calls": [{"index": 0, "function": {"arguments": ' "gear"}'}}]}))
+    token_count = counter.add_chunk(
+        ChatCompletionChunk.model_validate(
+            {"id": "chatcmpl-123", "object": "chat.completion.chunk", "created": 0, "model": "gpt-4o", "choices": []}
+        )
+    )
+    assert token_count == len(encoding.encode("Let me search for that.")) + len(encoding.encode('{"query": "gear"}'))
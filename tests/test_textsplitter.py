@@ -0,0 +1,135 @@
+import io
+import random
+
+import pytest
+
+from openai_messages_token_helper import split_text_by_tokens
+from openai_messages_token_helper.model_helper import encoding_for_model
+from openai_messages_token_helper.text_splitter import _read_blocks
+
+
+def make_document(seed=0, paragraphs=60):
+    rng = random.Random(seed)
+    words = ["climbing", "gear", "harness", "rope", "Ünïcödé", "日本語", "🎉", "/path/to/file", "trail"]
+    document = []
+    for p in range(paragraphs):
+        sentences = []
+        for s in range(rng.randint(1, 6)):
+            # Numbering the words keeps every chunk unique, so chunks can be found in the document
+            sentence = " ".join(f"{rng.choice(words)}{rng.randrange(10**6)}" for _ in range(rng.randint(3, 40)))
+            sentences.append(f"Sentence {p}-{s} {sentence}{rng.choice(['.', '!', '?', ''])}")
+        document.append(" ".join(sentences))
+    # A long string without any boundaries can only be cut in the middle
+    return "\n\n".join(document) + "\n" + "".join(rng.choice("abc+/=") for _ in range(3000))
+
+
+DOCUMENT = make_document()
+RUSSIAN = " ".join(f"Предложение номер {i} о снаряжении для скалолазания, верёвках и обвязках." for i in range(2000))
+CHINESE_SENTENCES = [
+    "这是关于攀岩装备的第{}个句子。",
+    "绳子和安全带在第{}排货架上。",
+    "我们推荐第{}款登山鞋！",
+    "你们可以试试第{}号头盔吗？",
+    "攀岩之前请检查第{}个铁锁。",
+    "如果下雨，第{}条路线会关闭。",
+]
+CHINESE = "".join(random.Random(0).choice(CHINESE_SENTENCES).format(i) for i in range(3000))
+# A long run of text without any safe boundary
+HAN_RUN = "".join(random.Random(0).choice("这是一个关于攀岩装备的句子绳子安全带和铁锁都很重要") for _ in range(50_000))
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o"])
+@pytest.mark.parametrize("max_tokens", [4, 50, 500])
+@pytest.mark.parametrize("read_size", [100, 65_536])
+def test_split_text_by_tokens(model, max_tokens, read_size):
+    encoding = encoding_for_model(model)
+    chunks = list(split_text_by_tokens(DOCUMENT, model, max_tokens, read_size=read_size))
+    assert "".join(chunks) == DOCUMENT
+    assert all(0 < len(encoding.encode_ordinary(chunk)) <= max_tokens for chunk in chunks)
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o"])
+def test_split_text_by_tokens_overlap(model):
+    encoding = encoding_for_model(model)
+    chunks = list(split_text_by_tokens(DOCUMENT, model, 200, overlap=50, read_size=1000))
+    start, end = -1, 0
+    for chunk in chunks:
+        assert len(encoding.encode_ordinary(chunk)) <= 200
+        # Each chunk starts after the previous one and no later than its end, and ends after it
+        position = DOCUMENT.rfind(chunk, start + 1, end + len(chunk))
+        assert position != -1
+        assert position + len(chunk) > end
+        start, end = position, position + len(chunk)
+    assert end == len(DOCUMENT)
+    assert len(chunks) > len(list(split_text_by_tokens(DOCUMENT, model, 200)))
+
+
+def test_split_text_by_tokens_boundaries():
+    paragraphs = [f"Paragraph {i} is about climbing. It has two sentences about gear" for i in range(50)]
+    document = "\n\n".join(paragraphs)
+    chunks = list(split_text_by_tokens(document, "gpt-4o", 40))
+    # Whole paragraphs fit in each chunk, so every chunk but the last ends at a paragraph
+    assert all(chunk.endswith("gear\n\n") for chunk in chunks[:-1])
+
+    sentences = " ".join(f"Sentence {i} is about climbing gear and rope." for i in range(100))
+    chunks = list(split_text_by_tokens(sentences, "gpt-4o", 30))
+    assert all(chunk.endswith("rope.") for chunk in chunks[:-1])
+
+
+@pytest.mark.parametrize("text", [RUSSIAN, CHINESE, HAN_RUN], ids=["russian", "chinese", "no_boundaries"])
+def test_read_blocks_non_latin(text):
+    blocks = list(_read_blocks(text, 1000, encoding_for_model("gpt-4o")))
+    assert "".join(block for block, _ in blocks) == text
+    # Blocks are bounded by the read size, so the whole document is never encoded at once
+    assert max(len(block) for block, _ in blocks) < 3000
+
+
+@pytest.mark.parametrize("model", ["gpt-35-turbo", "gpt-4o"])
+def test_split_text_by_tokens_non_latin(model):
+    encoding = encoding_for_model(model)
+    chunks = list(split_text_by_tokens(RUSSIAN, model, 100, read_size=1000))
+    assert "".join(chunks) == RUSSIAN
+    assert all(len(encoding.encode_ordinary(chunk)) <= 100 for chunk in chunks)
+    # Chunks end at the end of a sentence
+    assert all(chunk.endswith("обвязках.") for chunk in chunks[:-1])
+
+    chunks = list(split_text_by_tokens(CHINESE, model, 100, read_size=1000))
+    assert "".join(chunks) == CHINESE
+    assert all(len(encoding.encode_ordinary(chunk)) <= 100 for chunk in chunks)
+    # o200k merges a full-width ending with some words after it into one token, where a chunk can't end
+    aligned_count = sum(chunk[-1] in "。！？" for chunk in chunks[:-1])
+    assert aligned_count >= (len(chunks) - 1) * (1 if model == "gpt-35-turbo" else 0.95)
+
+    chunks = list(split_text_by_tokens(HAN_RUN, model, 100, read_size=1000))
+    assert "".join(chunks) == HAN_RUN
+    assert all(0 < len(encoding.encode_ordinary(chunk)) <= 100 for chunk in chunks)
+
+
+def test_split_text_by_tokens_file():
+    chunks = list(split_text_by_tokens(io.StringIO(DOCUMENT), "gpt-4o", 100, overlap=20, read_size=500))
+    assert chunks == list(split_text_by_tokens(DOCUMENT, "gpt-4o", 100, overlap=20, read_size=500))
+
+
+def test_split_text_by_tokens_special_tokens():
+    assert list(split_text_by_tokens("Some text <|endoftext|>", "gpt-4o", 100)) == ["Some text <|endoftext|>"]
+
+
+@pytest.mark.parametrize(
+    "text, max_tokens, chunks",
+    [("🙂🙂", 1, ["🙂", "🙂"]), ("ि।", 1, ["ि", "।"]), ("ab🙂cd", 1, ["ab", "🙂", "cd"])],
+    ids=["emoji", "devanagari", "mixed"],
+)
+def test_split_text_by_tokens_multi_token_characters(text, max_tokens, chunks):
+    # 🙂 and । take 2 tokens each, so each is a chunk of its own, over max_tokens, rather than split into empty chunks
+    assert list(split_text_by_tokens(text, "gpt-4", max_tokens)) == chunks
+
+
+def test_split_text_by_tokens_empty():
+    assert list(split_text_by_tokens("", "gpt-4o", 100)) == []
+
+
+def test_split_text_by_tokens_error():
+    with pytest.raises(ValueError, match="max_tokens must be positive"):
+        list(split_text_by_tokens(DOCUMENT, "gpt-4o", 0))
+    with pytest.raises(ValueError, match="overlap must be at least 0 and less than max_tokens"):
+        list(split_text_by_tokens(DOCUMENT, "gpt-4o", 100, overlap=100))
@@ -0,0 +1,129 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from openai_messages_token_helper import (
+    LRUCache,
+    TokenCounter,
+    ToolSet,
+    build_messages,
+    count_tokens_for_system_and_tools,
+)
+from openai_messages_token_helper.model_helper import encoding_for_model
+
+from .functions import FUNCTION_COUNTS, search_sources_toolchoice_auto
+from .image_messages import IMAGE_MESSAGE_COUNTS
+from .messages import (
+    assistant_message_dresscode,
+    assistant_message_perf,
+    system_message,
+    user_message,
+    user_message_dresscode,
+    user_message_perf,
+)
+
+PAST_MESSAGES = [
+    user_message_perf["message"],
+    assistant_message_perf["message"],
+    user_message_dresscode["message"],
+    assistant_message_dresscode["message"],
+]
+
+
+def test_token_counter():
+    counter = TokenCounter("gpt-4o")
+    assert counter.encoding is encoding_for_model("gpt-4o")
+    assert counter.max_tokens == 128000
+    assert counter.count_message(user_message["message"]) == user_message["count_omni"]
+    assert counter.count_message(system_message["message"]) == system_message["count_omni"]
+    # Counts are cached by the counter
+    assert counter.count_message(user_message["message"]) == user_message["count_omni"]
+    assert counter.cache.stats().hits == 1
+
+
+def test_token_counter_shared_cache():
+    cache: LRUCache[int] = LRUCache()
+    TokenCounter("gpt-4", cache=cache).count_message(user_message["message"])
+    assert TokenCounter("gpt-4", cache=cache).cache is cache
+    assert len(cache) == 1
+
+
+def test_token_counter_count_message_limit():
+    counter = TokenCounter("gpt-4o", parallel_min_chars=10_000, num_threads=4)
+    message = {"role": "tool", "tool_call_id": "call_1", "content": "A line of a large tool result\n" * 5_000}
+    partial_count = counter.count_message(message, limit=100)
+    assert 100 < partial_count < counter.count_message(message)
+
+
+@pytest.mark.parametrize("function_count_pair", FUNCTION_COUNTS)
+def test_token_counter_count_system_and_tools(function_count_pair):
+    counter = TokenCounter("gpt-35-turbo")
+    system_message, tools, tool_choice = (
+        function_count_pair["system_message"],
+        function_count_pair["tools"],
+        function_count_pair["tool_choice"],
+    )
+    expected = count_tokens_for_system_and_tools("gpt-35-turbo", system_message, tools, tool_choice)
+    assert counter.count_system_and_tools(system_message, tools, tool_choice) == expected
+    assert counter.count_system_and_tools(system_message, ToolSet(tools), tool_choice) == expected
+    assert counter.count_system_and_tools(None, tools, tool_choice) == count_tokens_for_system_and_tools(
+        "gpt-35-turbo", None, tools, tool_choice
+    )
+
+
+def test_token_counter_count_image():
+    image_url = IMAGE_MESSAGE_COUNTS[0]["message"]["content"][1]["image_url"]["url"]
+    assert TokenCounter("gpt-4o").count_image(image_url, "low") == 85
+    assert TokenCounter("gpt-4o-mini").count_image(image_url, "low") == 2833
+
+
+@pytest.mark.parametrize("max_tokens", [None, 60, 200])
+def test_token_counter_build_messages(max_tokens):
+    counter = TokenCounter("gpt-35-turbo", max_tokens=max_tokens)
+    kwargs = {
+        "tools": search_sources_toolchoice_auto["tools"],
+        "tool_choice": "auto",
+        "new_user_content": "What is in my plan?",
+        "past_messages": PAST_MESSAGES,
+    }
+    expected = build_messages("gpt-35-turbo", "You are a bot.", max_tokens=max_tokens, **kwargs)
+    assert counter.build_messages("You are a bot.", **kwargs) == expected
+    # The limit can still be overridden per call
+    assert counter.build_messages("You are a bot.", max_tokens=60, **kwargs) == build_messages(
+        "gpt-35-turbo", "You are a bot.", max_tokens=60, **kwargs
+    )
+
+
+def test_token_counter_build_messages_reasoning_model_warning(caplog):
+    counter = TokenCounter("gpt-5")
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        counter.build_messages("You are a bot.", new_user_content="What is in my plan?", past_messages=PAST_MESSAGES)
+    # The warning is logged once for the build, not for each of its messages
+    assert [record.getMessage() for record in caplog.records] == [
+        "Model gpt-5 is a reasoning model. Token usage estimates may not reflect actual costs due to reasoning tokens."
+    ]
+
+
+def test_token_counter_fallback(caplog):
+    with pytest.raises(ValueError, match="Expected valid OpenAI GPT model name"):
+        TokenCounter("my-deployment")
+    with caplog.at_level(logging.WARNING):
+        counter = TokenCounter("my-deployment", fallback_to_default=True)
+    assert counter.encoding.name == "cl100k_base"
+    assert counter.max_tokens == 4000
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        assert counter.count_message(user_message["message"]) == user_message["count"]
+    # The fallback was only logged when the counter was created
+    assert caplog.text == ""
+
+
+def test_token_counter_threads():
+    counter = TokenCounter("gpt-4o", cache=LRUCache(max_entries=50))
+    messages = [{"role": "user", "content": f"Message number {i} about climbing gear"} for i in range(200)]
+    expected = [TokenCounter("gpt-4o").count_message(message) for message in messages]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(3):
+            assert list(executor.map(counter.count_message, messages)) == expected
@@ -0,0 +1,64 @@
+import pytest
+
+from openai_messages_token_helper import ToolSet, build_messages, count_tokens_for_system_and_tools
+from openai_messages_token_helper.function_format import format_function_definitions
+from openai_messages_token_helper.model_helper import encoding_for_model
+
+from .functions import FUNCTION_COUNTS, search_sources_toolchoice_auto
+from .messages import assistant_message_perf, user_message_perf, user_message_pm
+
+
+@pytest.mark.parametrize("function_count_pair", FUNCTION_COUNTS)
+def test_toolset_count_tokens_for_system_and_tools(function_count_pair):
+    expected = count_tokens_for_system_and_tools(
+        "gpt-35-turbo",
+        function_count_pair["system_message"],
+        function_count_pair["tools"],
+        function_count_pair["tool_choice"],
+    )
+    tool_set = ToolSet(function_count_pair["tools"])
+    counted = count_tokens_for_system_and_tools(
+        "gpt-35-turbo", function_count_pair["system_message"], tool_set, function_count_pair["tool_choice"]
+    )
+    assert counted == expected
+
+
+def test_toolset_memoizes_counts(monkeypatch):
+    tool_set = ToolSet(FUNCTION_COUNTS[0]["tools"] + search_sources_toolchoice_auto["tools"])
+    assert len(tool_set) == 2
+    assert list(tool_set) == tool_set.tools
+    assert tool_set.formatted == format_function_definitions(tool_set.tools)
+
+    encoding = encoding_for_model("gpt-4")
+    token_count = tool_set.token_count(encoding)
+    assert token_count == len(encoding.encode(tool_set.formatted))
+    tool_token_counts = tool_set.tool_token_counts(encoding)
+    assert len(tool_token_counts) == 2
+    assert abs(sum(tool_token_counts) - token_count) <= 10
+
+    def fail_encode(*args, **kwargs):
+        raise AssertionError("Tools should not be encoded again")
+
+    monkeypatch.setattr(encoding, "encode", fail_encode)
+    monkeypatch.setattr(encoding, "encode_batch", fail_encode)
+    assert tool_set.token_count(encoding) == token_count
+    assert tool_set.tool_token_counts(encoding) == tool_token_counts
+
+
+def test_toolset_empty():
+    assert count_tokens_for_system_and_tools("gpt-4", {"role": "system", "content": "You are a bot."}, ToolSet([])) == (
+        count_tokens_for_system_and_tools("gpt-4", {"role": "system", "content": "You are a bot."})
+    )
+
+
+def test_toolset_build_messages():
+    kwargs = dict(
+        system_prompt=search_sources_toolchoice_auto["system_message"]["content"],
+        tool_choice=search_sources_toolchoice_auto["tool_choice"],
+        past_messages=[user_message_perf["message"], assistant_message_perf["message"]],
+        new_user_content=user_message_pm["message"]["content"],
+        max_tokens=90,
+    )
+    expected = build_messages("gpt-35-turbo", tools=search_sources_toolchoice_auto["tools"], **kwargs)
+    tool_set = ToolSet(search_sources_toolchoice_auto["tools"])
+    assert build_messages("gpt-35-turbo", tools=tool_set, **kwargs) == expected